@@ -9,6 +9,7 @@ import time
 import json
 import logging
 import re # Importado para limpeza de CNPJ
+from routing import sessao_http
 
 # Configuração básica do logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -141,7 +142,7 @@ def buscar_endereco_cnpj(cnpj):
     for api in apis:
         logging.info(f"Tentando API {api['nome']} para CNPJ {cnpj_limpo}")
         try:
-            resp = requests.get(api["url"], timeout=10)
+            resp = sessao_http.get(api["url"], servico="cnpj")
             resp.raise_for_status()
 
             data = resp.json()
@@ -1,6 +1,8 @@
 import sqlite3
 import pandas as pd
+import numpy as np
 import os
+import shutil
 import logging
 import toml
 
@@ -9,6 +11,8 @@ CONFIG_PATH = os.path.join(os.path.dirname(__file__), '..', 'config.toml')
 config = toml.load(CONFIG_PATH)
 db_config = config.get('database', {})
 DB_PATH = os.path.join(os.path.dirname(__file__), '..', 'database', db_config.get('DB_NAME', 'wazelog.db'))
+# Matrizes de cada cenário ficam em database/cenarios/<id_cenario>/<nome>.npy
+CENARIOS_DIR = os.path.join(os.path.dirname(__file__), '..', 'database', 'cenarios')
 
 # Conexão e criação das tabelas
 
@@ -75,6 +79,14 @@ def init_db():
         latitude REAL,
         longitude REAL
     )''')
+    # Tabela de cenários de roteirização (as matrizes ficam em arquivos .npy em CENARIOS_DIR)
+    cur.execute('''CREATE TABLE IF NOT EXISTS cenarios (
+        id_cenario TEXT PRIMARY KEY,
+        data TEXT,
+        tipo TEXT,
+        n_pontos INTEGER,
+        matrizes TEXT
+    )''')
     conn.commit()
     conn.close()
 
@@ -374,3 +386,108 @@ def buscar_cnpj_no_banco(cnpj):
     finally:
         conn.close()
     return None
+
+# Funções para Cenários (matrizes persistidas em .npy)
+
+def salvar_matrizes_cenario(id_cenario, matrizes, data=None, tipo=None, rotas=None):
+    """
+    Grava as matrizes de um cenário como arquivos .npy (e as rotas em rotas.csv) e registra o cenário no banco.
+
+    Args:
+        id_cenario (str): Identificador do cenário (usado como nome do diretório).
+        matrizes (dict): {nome: numpy.ndarray}, ex: {"distancias": ..., "tempos": ...}. Valores None são ignorados.
+        data (str, optional): Data/hora do cenário.
+        tipo (str, optional): Tipo de roteirização do cenário.
+        rotas (pd.DataFrame, optional): Rotas do cenário, relidas por carregar_rotas_cenario.
+
+    Returns:
+        str: Diretório onde as matrizes foram gravadas.
+    """
+    diretorio = os.path.join(CENARIOS_DIR, str(id_cenario))
+    os.makedirs(diretorio, exist_ok=True)
+    nomes = []
+    n_pontos = 0
+    for nome, matriz in matrizes.items():
+        if matriz is None:
+            continue
+        matriz = np.asarray(matriz)
+        caminho = os.path.join(diretorio, f"{nome}.npy")
+        # Grava em arquivo temporário e renomeia, para nunca deixar um .npy pela metade
+        temporario = caminho + ".tmp"
+        with open(temporario, 'wb') as f:
+            np.save(f, matriz)
+        os.replace(temporario, caminho)
+        nomes.append(nome)
+        n_pontos = max(n_pontos, matriz.shape[0] if matriz.ndim else 0)
+    if rotas is not None:
+        caminho = os.path.join(diretorio, "rotas.csv")
+        rotas.to_csv(caminho + ".tmp", index=False)
+        os.replace(caminho + ".tmp", caminho)
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute('''INSERT OR REPLACE INTO cenarios (id_cenario, data, tipo, n_pontos, matrizes)
+                   VALUES (?, ?, ?, ?, ?)''', (str(id_cenario), data, tipo, n_pontos, ",".join(nomes)))
+    conn.commit()
+    conn.close()
+    return diretorio
+
+def carregar_matrizes_cenario(id_cenario, nomes=None):
+    """
+    Reabre as matrizes de um cenário com np.load(mmap_mode='r'): os dados só são lidos do
+    disco quando acessados, então matrizes grandes não ocupam RAM até serem usadas.
+
+    Args:
+        id_cenario (str): Identificador do cenário.
+        nomes (list, optional): Matrizes a carregar (ex: ["distancias"]). Se None, carrega todas.
+
+    Returns:
+        dict: {nome: numpy.memmap} (somente leitura); vazio se o cenário não tiver matrizes salvas.
+    """
+    diretorio = os.path.join(CENARIOS_DIR, str(id_cenario))
+    if not os.path.isdir(diretorio):
+        return {}
+    if nomes is None:
+        nomes = [arq[:-4] for arq in sorted(os.listdir(diretorio)) if arq.endswith('.npy')]
+    matrizes = {}
+    for nome in nomes:
+        caminho = os.path.join(diretorio, f"{nome}.npy")
+        if not os.path.exists(caminho):
+            continue
+        try:
+            matrizes[nome] = np.load(caminho, mmap_mode='r')
+        except Exception as e:
+            logging.error(f"Erro ao carregar matriz '{nome}' do cenário {id_cenario}: {e}")
+    return matrizes
+
+def carregar_rotas_cenario(id_cenario):
+    """
+    Lê as rotas gravadas com o cenário.
+
+    Args:
+        id_cenario (str): Identificador do cenário.
+
+    Returns:
+        pd.DataFrame: Rotas do cenário; vazio se não houver rotas salvas.
+    """
+    caminho = os.path.join(CENARIOS_DIR, str(id_cenario), "rotas.csv")
+    if not os.path.exists(caminho):
+        return pd.DataFrame()
+    try:
+        return pd.read_csv(caminho, dtype={'ID_Cenario': str})
+    except Exception as e:
+        logging.error(f"Erro ao carregar rotas do cenário {id_cenario}: {e}")
+        return pd.DataFrame()
+
+def listar_cenarios():
+    conn = get_connection()
+    df = pd.read_sql('SELECT * FROM cenarios ORDER BY data DESC', conn)
+    conn.close()
+    return df
+
+def excluir_cenario(id_cenario):
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute('DELETE FROM cenarios WHERE id_cenario = ?', (str(id_cenario),))
+    conn.commit()
+    conn.close()
+    shutil.rmtree(os.path.join(CENARIOS_DIR, str(id_cenario)), ignore_errors=True)
@@ -1,12 +1,14 @@
 import streamlit as st
 import pandas as pd
-from database import carregar_pedidos, carregar_endereco_partida
+from database import carregar_pedidos, carregar_endereco_partida, carregar_matrizes_cenario, carregar_rotas_cenario, listar_cenarios, excluir_cenario
 import folium
 from folium.plugins import MarkerCluster
 from streamlit_folium import st_folium
 import random
 import time # Necessário para o sleep
 import os # <<< ADICIONADO para verificar existência do arquivo
+from routing.apis_externas import consultar_osrm_route
+from routing.distancias import calcular_distancias_pares, INFINITE_VALUE
 
 # Função para gerar cores aleatórias
 def gerar_cor_aleatoria():
@@ -92,7 +94,7 @@ st.divider()
 ROTEIRIZACAO_CSV_PATH = "/workspaces/WazeLog/data/Roteirizacao.csv"
 
 # <<< ADICIONADO: URL do servidor OSRM >>>
-OSRM_SERVER_URL = os.environ.get("OSRM_BASE_URL", "https://router.project-osrm.org")
+OSRM_SERVER_URL = os.environ.get("OSRM_BASE_URL", "https://router.project-osrm.org")  # Vários servidores: separados por vírgula
 
 def show():
     st.header("Mapas de Rotas", divider="rainbow")
@@ -255,40 +257,38 @@ def show():
                                 popup=pedido_info,   # Mostra ao clicar
                                 icon=folium.Icon(color='red', icon='info-sign') # Mantém ícone vermelho
                             ).add_to(m)
-                        # Trajeto real por ruas (OSRM)
-                        # Calcular distância total (km) e tempo total (min) da rota
+                        # Trajeto real por ruas (OSRM): uma única chamada /route para a sequência inteira
+                        # (geometria de cada trecho a partir dos steps) em vez de uma chamada por trecho
+                        resposta_rota = consultar_osrm_route(coords, osrm_url=OSRM_SERVER_URL)
+                        if resposta_rota and resposta_rota.get('routes'):
+                            rota_osrm = resposta_rota['routes'][0]
+                            legs = rota_osrm.get('legs', [])
+                            for i, leg in enumerate(legs):
+                                trecho = [(lat, lon) for step in leg.get('steps', []) for lon, lat in step.get('geometry', {}).get('coordinates', [])]
+                                if trecho:
+                                    # Define cor: vermelho para ida, azul para volta
+                                    cor_linha = 'red' if i < len(legs) - 1 else 'blue'
+                                    folium.PolyLine(locations=trecho, color=cor_linha, weight=4, opacity=0.8).add_to(m)
+                            if not any(leg.get('steps') for leg in legs) and rota_osrm.get('geometry'):
+                                folium.PolyLine(
+                                    locations=[(lat, lon) for lon, lat in rota_osrm['geometry']['coordinates']],
+                                    color='red', weight=4, opacity=0.8
+                                ).add_to(m)
+                        else:
+                            st.error(f"Erro ao obter o trajeto do servidor OSRM ({OSRM_SERVER_URL}). Verifique se o serviço está acessível.")
+
+                        # Distância total (km) e tempo total (min): todos os trechos em uma requisição Table (ou do cache)
                         distancia_total_km = 0
                         tempo_total_min = 0
-                        import requests
-                        for i in range(len(coords)-1):
-                            origem = coords[i]
-                            destino = coords[i+1]
-                            url = f"{OSRM_SERVER_URL}/route/v1/driving/{origem[1]},{origem[0]};{destino[1]},{destino[0]}?overview=full&geometries=geojson"
-                            try:
-                                resp = requests.get(url, timeout=10)
-                                if resp.status_code == 200:
-                                    data = resp.json()
-                                    if data.get('routes'):
-                                        route = data['routes'][0]
-                                        geometry = route['geometry']
-                                        # Define cor: vermelho para ida, azul para volta
-                                        if i < len(coords)-2:
-                                            cor_linha = 'red'  # Ida
-                                        else:
-                                            cor_linha = 'blue' # Volta para base
-                                        folium.PolyLine(
-                                            locations=[(lat, lon) for lon, lat in geometry['coordinates']],
-                                            color=cor_linha, weight=4, opacity=0.8
-                                        ).add_to(m)
-                                        distancia_total_km += route.get('distance', 0) / 1000
-                                        tempo_total_min += route.get('duration', 0) / 60
-                                else:
-                                     pass # Continua tentando os próximos segmentos
-                            except requests.exceptions.ConnectionError:
-                                 st.error(f"Erro de conexão com o servidor OSRM ({OSRM_SERVER_URL}). Verifique se o serviço está acessível.")
-                                 break # Para de tentar calcular rotas se OSRM não está acessível
-                            except Exception as osrm_err:
-                                 pass # Continua tentando os próximos segmentos
+                        trechos = list(zip(map(tuple, coords[:-1]), map(tuple, coords[1:])))
+                        # Mesmo(s) servidor(es) do trajeto acima
+                        metricas_trechos = calcular_distancias_pares(trechos, metrica="duration,distance", osrm_url=OSRM_SERVER_URL)
+                        if metricas_trechos is not None:
+                            com_rota = metricas_trechos['distance'] < INFINITE_VALUE
+                            distancia_total_km = metricas_trechos['distance'][com_rota].sum() / 1000
+                            tempo_total_min = metricas_trechos['duration'][com_rota].sum() / 60
+                        else:
+                            st.error(f"Erro ao calcular distância e tempo totais no servidor OSRM ({OSRM_SERVER_URL}). Verifique se o serviço está acessível.")
 
                         # <<< MODIFICADO: Adiciona chave dinâmica ao st_folium >>>
                         # Cria chave única baseada na seleção para evitar erro de chave duplicada
@@ -354,16 +354,44 @@ pedidos_todos = carregar_pedidos()
 endereco_partida_salvo, lat_partida_salva, lon_partida_salva = carregar_endereco_partida()
 default_depot_location = [lat_partida_salva, lon_partida_salva] if lat_partida_salva and lon_partida_salva else [-23.5505, -46.6333]
 
+# --- Seletor de Cenário ---
+# Os cenários vêm do banco (rotas e matrizes ficam em disco), então continuam disponíveis depois de reiniciar a sessão
+cenarios_disponiveis = st.session_state.get('cenarios_roteirizacao', [])
+try:
+    cenarios_salvos = listar_cenarios()
+except Exception as e:
+    st.error(f"Erro ao listar cenários salvos: {e}")
+    cenarios_salvos = pd.DataFrame()
+
+id_cenario = None
+rotas_cenario = pd.DataFrame()
+if cenarios_salvos.empty:
+    st.info("Nenhum cenário salvo. Roteirize os pedidos na página de Roteirização para analisar os veículos.")
+else:
+    rotulos_cenarios = {
+        linha.id_cenario: f"{linha.data} - {linha.tipo} ({max(int(linha.n_pontos or 0) - 1, 0)} pedidos)"
+        for linha in cenarios_salvos.itertuples()
+    }
+    col_cenario, col_excluir = st.columns([4, 1])
+    with col_cenario:
+        id_cenario = st.selectbox(
+            "Selecione o cenário:",
+            options=list(rotulos_cenarios),
+            format_func=rotulos_cenarios.get,
+            key="cenario_analise_veiculo"
+        )
+    with col_excluir:
+        if st.button("Excluir cenário", key="excluir_cenario_analise"):
+            excluir_cenario(id_cenario)
+            st.session_state['cenarios_roteirizacao'] = [c for c in cenarios_disponiveis if c.get('id_cenario') != id_cenario]
+            st.success("Cenário excluído.")
+            st.rerun()
+    rotas_cenario = carregar_rotas_cenario(id_cenario)
+
 # --- Seletor de Veículo ---
 placas_disponiveis = []
-cenarios_disponiveis = st.session_state.get('cenarios_roteirizacao', [])
-for cenario in cenarios_disponiveis:
-    rotas = cenario.get('rotas')
-    if rotas is not None and not rotas.empty and 'Veículo' in rotas.columns:
-        placas = rotas['Veículo'].dropna().unique().tolist()
-        placas_disponiveis.extend(placas)
-placas_disponiveis = list(set(placas_disponiveis)) # Remove duplicatas
-placas_disponiveis.sort()
+if not rotas_cenario.empty and 'Veículo' in rotas_cenario.columns:
+    placas_disponiveis = sorted(rotas_cenario['Veículo'].dropna().unique().tolist())
 
 veiculo_selecionado = st.selectbox(
     "Selecione o veículo para análise detalhada:",
@@ -375,16 +403,9 @@ veiculo_selecionado = st.selectbox(
 # --- Processa Seleção de Veículo ---
 if veiculo_selecionado:
     st.info(f"Analisando dados para o veículo: {veiculo_selecionado}")
-    rotas_veiculo = []
-    for cenario in cenarios_disponiveis:
-        rotas = cenario.get('rotas')
-        if rotas is not None and not rotas.empty:
-            # Filtra apenas as rotas do veículo selecionado
-            rotas_veiculo.append(rotas[rotas['Veículo'] == veiculo_selecionado])
-
-    if rotas_veiculo:
-        # Concatena todos os DataFrames de rotas do veículo selecionado
-        rota_veiculo_selecionado = pd.concat(rotas_veiculo, ignore_index=True)
+    rota_veiculo_selecionado = rotas_cenario[rotas_cenario['Veículo'] == veiculo_selecionado].reset_index(drop=True)
+
+    if not rota_veiculo_selecionado.empty:
         st.success(f"Foram encontradas {len(rota_veiculo_selecionado)} rotas para o veículo selecionado.")
 
         # --- Tabela da Rota Selecionada ---
@@ -394,18 +415,13 @@ if veiculo_selecionado:
         # --- Cálculo da Distância Total ---
         distancia_total_m = 0
         matriz_distancias = None
+        depot_index = 0  # O depósito é sempre o nó 0 das matrizes do cenário
         if 'Node_Index_OR' in rota_veiculo_selecionado.columns:
-            # Tenta carregar a matriz de distâncias correspondente
+            # Reabre o .npy salvo do cenário com mmap: só as células usadas são lidas do disco
             try:
-                id_cenario = rota_veiculo_selecionado['ID_Cenario'].iloc[0] if not rota_veiculo_selecionado.empty else None
-                if id_cenario is not None:
-                    matriz_distancias = st.session_state.get(f"matriz_distancias_{id_cenario}")
-                    if matriz_distancias is not None:
-                        st.info("Matriz de distâncias encontrada na sessão.")
-                    else:
-                        st.warning("Matriz de distâncias não encontrada na sessão.")
-                else:
-                    st.error("ID do cenário não encontrado na rota selecionada.")
+                matriz_distancias = carregar_matrizes_cenario(id_cenario, ["distancias"]).get("distancias")
+                if matriz_distancias is None:
+                    st.warning("Matriz de distâncias não encontrada no cenário salvo.")
             except Exception as e:
                 st.error(f"Erro ao carregar matriz de distâncias: {e}")
 
@@ -482,18 +498,12 @@ if veiculo_selecionado:
         with col2_met:
             # Tenta buscar a capacidade da frota do cenário, se disponível
             capacidade_veiculo = 0
-            frota_cenario = None
-            id_cenario_atual = None
-            # Encontra o cenário correspondente para buscar a frota
-            for i, c in enumerate(cenarios_disponiveis):
-                rotas_c = c.get('rotas')
-                if rotas_c is not None and not rotas_c.empty and veiculo_selecionado in rotas_c['Veículo'].unique():
-                    # Assume que a frota usada está no mesmo cenário (pode precisar de ajuste se não for o caso)
-                    # Idealmente, a frota usada deveria ser salva junto com o cenário
-                    # Tenta buscar a frota do estado da sessão se não foi salva no cenário
-                    frota_cenario = c.get('frota_usada', st.session_state.get('frota_carregada')) # Exemplo
-                    id_cenario_atual = i
-                    break # Usa o primeiro cenário encontrado com o veículo
+            frota_cenario = st.session_state.get('frota_carregada')
+            # Se o cenário ainda estiver na sessão, usa a frota guardada com ele
+            for c in cenarios_disponiveis:
+                if c.get('id_cenario') == id_cenario:
+                    frota_cenario = c.get('frota_usada', frota_cenario)
+                    break
 
             if frota_cenario is not None and not frota_cenario.empty:
                 id_col_frota = 'ID Veículo' if 'ID Veículo' in frota_cenario.columns else 'Placa'
@@ -527,10 +537,10 @@ if veiculo_selecionado:
             st.metric("Tempo Estimado (h)", f"{horas:02d}:{minutos:02d}")
 
     else:
-        st.warning(f"Nenhuma rota encontrada nos cenários para o veículo selecionado: {veiculo_selecionado}")
+        st.warning(f"Nenhuma rota encontrada no cenário para o veículo selecionado: {veiculo_selecionado}")
 
 else: # Fim do if veiculo_selecionado
     if placas_disponiveis:
         st.info("Selecione um veículo na lista acima para ver a análise detalhada.")
     else:
-        st.warning("Nenhum veículo com rotas encontradas nos cenários disponíveis para análise.")
+        st.warning("Nenhum veículo com rotas encontradas no cenário selecionado para análise.")
@@ -7,6 +7,7 @@ import streamlit as st
 import threading
 import time
 import logging
+from routing import sessao_http
 
 logging.basicConfig(level=logging.INFO)
 
@@ -30,7 +31,7 @@ def obter_coordenadas_opencage(endereco):
     key = next(key_cycle)
     url = f"https://api.opencagedata.com/geocode/v1/json?q={requests.utils.quote(str(endereco or ''))}&key={key}&language=pt&countrycode=br&limit=1"
     try:
-        resp = requests.get(url, timeout=10)
+        resp = sessao_http.get(url, servico="geocodificacao")
         if resp.status_code == 200:
             results = resp.json().get("results")
             if results:
@@ -44,7 +45,7 @@ def obter_coordenadas_nominatim(endereco):
     try:
         url = f"https://nominatim.openstreetmap.org/search?format=json&q={requests.utils.quote(endereco)}&addressdetails=0&limit=1"
         headers = {"User-Agent": "roteirizador_entregas"}
-        resp = requests.get(url, headers=headers, timeout=10)
+        resp = sessao_http.get(url, servico="geocodificacao", headers=headers)
         if resp.status_code == 200:
             results = resp.json()
             if results:
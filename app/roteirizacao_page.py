@@ -10,12 +10,15 @@ from database import (
     carregar_pedidos,
     carregar_frota,
     salvar_endereco_partida,
-    carregar_endereco_partida
+    carregar_endereco_partida,
+    salvar_matrizes_cenario
 )
 # Ajuste na importação dos solvers para pegar do módulo correto
-from routing.cvrp import solver_cvrp
+from routing.cvrp import solver_cvrp, PRESETS_BUSCA, PRESET_PADRAO, MAX_PROCESSOS
 from routing.cvrp_flex import solver_cvrp_flex
-from routing.distancias import calcular_matriz_distancias
+from routing.decomposicao import solver_cvrp_decomposto, LIMIAR_DECOMPOSICAO
+from routing.portfolio import solver_cvrp_portfolio
+from routing.distancias import calcular_matrizes_tempo_distancia, K_VIZINHOS_PADRAO, LIMIAR_MATRIZ_ESPARSA
 from pedidos import obter_coordenadas # Para geocodificação do endereço de partida
 
 # Constantes para endereço de partida padrão
@@ -188,6 +191,22 @@ def show():
                 min_value=80, max_value=120, value=100, step=1,
                 help="Permite simular veículos carregando menos ou até 20% a mais que a capacidade cadastrada."
             )
+        preset_busca = st.selectbox(
+            "Esforço de busca do solver",
+            list(PRESETS_BUSCA),
+            index=list(PRESETS_BUSCA).index(PRESET_PADRAO),
+            help="Rascunho: plano em poucos segundos. Padrão: bom equilíbrio. Intensivo: busca mais longa para melhores rotas. O tempo limite cresce com o número de pedidos."
+        )
+        usar_decomposicao = st.checkbox(
+            "Dividir em clusters e resolver em paralelo (muitos pedidos)",
+            value=len(pedidos_validos) > LIMIAR_DECOMPOSICAO,
+            help="Agrupa pedidos e veículos por proximidade e resolve cada grupo em um processo separado, com reparo nas fronteiras. Recomendado acima de algumas centenas de pedidos."
+        ) if tipo == "CVRP" else False
+        usar_portfolio = st.checkbox(
+            f"Portfólio de estratégias em paralelo ({MAX_PROCESSOS} núcleos)",
+            value=False,
+            help="Roda várias estratégias do solver ao mesmo tempo, uma por núcleo, e mantém o melhor plano, sem aumentar o tempo de espera."
+        ) if tipo == "CVRP" and not usar_decomposicao and MAX_PROCESSOS > 1 else False
 
         # --- Agrupamento Inicial de Pedidos (sempre exibe se existir coluna 'Cluster') ---
         st.subheader("Agrupamento Inicial de Pedidos (por proximidade geográfica)")
@@ -293,11 +312,28 @@ def show():
                 depot_index = 0 # Índice do depósito na lista all_locations
 
                 matriz_distancias = None
+                matriz_tempos = None
 
-                # Calcular Matriz de Distâncias (necessária para VRP, CVRP, TSP e cálculo final de distância)
+                # Calcular Matrizes de Distâncias e Tempos em uma única passada pelo OSRM
+                # (distância para os solvers; tempo para simulação de custos/tempo de operação)
                 with st.spinner("Calculando matriz de distâncias..."):
                     try:
-                        matriz_distancias = calcular_matriz_distancias(all_locations, metrica='distance')
+                        # Muitos pontos: arcos exatos só entre vizinhos próximos e o depósito (O(N·k) chamadas OSRM)
+                        k_vizinhos = K_VIZINHOS_PADRAO if len(all_locations) > LIMIAR_MATRIZ_ESPARSA else None
+                        # Reaproveita a última matriz calculada: só pedidos novos (ou depósito alterado) vão ao OSRM
+                        matriz_tempos, matriz_distancias, pares_exatos = calcular_matrizes_tempo_distancia(
+                            all_locations, k_vizinhos=k_vizinhos,
+                            anterior=st.session_state.get('matrizes_anteriores'),
+                            retornar_mascara=True
+                        )
+                        if matriz_distancias is not None and matriz_tempos is not None:
+                            # A máscara limita o reaproveitamento aos pares exatos (sem estimativas nem falhas)
+                            st.session_state['matrizes_anteriores'] = {
+                                'pontos': list(all_locations),
+                                'duration': matriz_tempos,
+                                'distance': matriz_distancias,
+                                'exatas': pares_exatos,
+                            }
                         if matriz_distancias is None or len(matriz_distancias) != len(all_locations):
                              st.error("Falha ao calcular a matriz de distâncias completa.")
                              matriz_distancias = None # Garante que não prossiga se falhar
@@ -329,13 +365,44 @@ def show():
                                 elif 'Capacidade (Kg)' not in frota.columns:
                                      st.error("Coluna 'Capacidade (Kg)' necessária para CVRP não encontrada na frota.")
                                      raise ValueError("Faltando 'Capacidade (Kg)'")
+                                elif usar_decomposicao:
+                                     rotas = solver_cvrp_decomposto(
+                                         pedidos_validos, frota, matriz_distancias,
+                                         ajuste_capacidade_pct=ajuste_capacidade_pct,
+                                         preset=preset_busca,
+                                         pos_processamento=aplicar_pos,
+                                         tipo_heuristica=tipo_heuristica if aplicar_pos else '2opt',
+                                         kwargs_heuristica={"max_paradas_por_subrota": max_paradas_split} if aplicar_pos and tipo_heuristica == "split" else {}
+                                     )
+                                     rotas_df = rotas
+                                     status_solver = "OK" if rotas_df is not None and not rotas_df.empty else "Falha ou Sem Solução"
+                                elif usar_portfolio:
+                                     rotas = solver_cvrp_portfolio(
+                                         pedidos_validos, frota, matriz_distancias,
+                                         ajuste_capacidade_pct=ajuste_capacidade_pct,
+                                         preset=preset_busca,
+                                         pos_processamento=aplicar_pos,
+                                         tipo_heuristica=tipo_heuristica if aplicar_pos else '2opt',
+                                         kwargs_heuristica={"max_paradas_por_subrota": max_paradas_split} if aplicar_pos and tipo_heuristica == "split" else {}
+                                     )
+                                     rotas_df = rotas
+                                     status_solver = "OK" if rotas_df is not None and not rotas_df.empty else "Falha ou Sem Solução"
                                 else:
+                                     # Modo anytime: mostra cada solução melhor enquanto o solver refina o plano
+                                     progresso_busca = st.empty()
+                                     def mostrar_progresso(info):
+                                         progresso_busca.info(
+                                             f"Solução {info['solucao']}: {info['custo'] / 1000:.1f} km, "
+                                             f"{len(info['rotas'])} veículos ({info['segundos']:.1f}s)"
+                                         )
                                      rotas = solver_cvrp(
                                          pedidos_validos, frota, matriz_distancias,
                                          pos_processamento=aplicar_pos,
                                          tipo_heuristica=tipo_heuristica if aplicar_pos else '2opt',
                                          kwargs_heuristica={"max_paradas_por_subrota": max_paradas_split} if aplicar_pos and tipo_heuristica == "split" else {},
-                                         ajuste_capacidade_pct=ajuste_capacidade_pct
+                                         ajuste_capacidade_pct=ajuste_capacidade_pct,
+                                         preset=preset_busca,
+                                         ao_melhorar=mostrar_progresso
                                      )
                                      rotas_df = rotas # Resultado já é DataFrame
                                      status_solver = "OK" if rotas_df is not None and not rotas_df.empty else "Falha ou Sem Solução"
@@ -344,7 +411,8 @@ def show():
                                     pedidos_validos, frota, matriz_distancias, depot_index=depot_index, ajuste_capacidade_pct=ajuste_capacidade_pct,
                                     pos_processamento=aplicar_pos,
                                     tipo_heuristica=tipo_heuristica if aplicar_pos else '2opt',
-                                    kwargs_heuristica={"max_paradas_por_subrota": max_paradas_split} if aplicar_pos and tipo_heuristica == "split" else {}
+                                    kwargs_heuristica={"max_paradas_por_subrota": max_paradas_split} if aplicar_pos and tipo_heuristica == "split" else {},
+                                    preset=preset_busca
                                 )
                                 # Se o solver retornar dict, tenta extrair o DataFrame
                                 if isinstance(rotas, dict):
@@ -545,8 +613,27 @@ def show():
                                 st.warning(f"Erro ao gerar resumo por veículo: {resumo_err}")
                         # --- Fim Resumo por Veículo ---
 
+                        # --- Persistência do cenário ---
+                        # Matrizes e rotas ficam em disco; a sessão guarda só o ID do cenário, e a análise
+                        # por veículo (mapas_page) reabre a matriz com mmap, mesmo depois de reiniciar a sessão.
+                        agora = pd.Timestamp.now()
+                        id_cenario = agora.strftime('%Y%m%d%H%M%S%f')
+                        if isinstance(rotas_df, pd.DataFrame):
+                            rotas_df['ID_Cenario'] = id_cenario
+                        try:
+                            salvar_matrizes_cenario(
+                                id_cenario,
+                                {'distancias': matriz_distancias, 'tempos': matriz_tempos},
+                                data=agora.strftime('%Y-%m-%d %H:%M:%S'),
+                                tipo=tipo,
+                                rotas=rotas_df if isinstance(rotas_df, pd.DataFrame) else None
+                            )
+                        except Exception as salvar_err:
+                            st.warning(f"Não foi possível salvar o cenário em disco: {salvar_err}")
+
                         cenario = {
-                            'data': pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'),
+                            'id_cenario': id_cenario,
+                            'data': agora.strftime('%Y-%m-%d %H:%M:%S'),
                             'tipo': tipo,
                             'rotas': rotas_df,
                             'qtd_pedidos_roteirizados': len(pedidos_validos),
@@ -1,13 +1,55 @@
 import sys
 import os
+from contextlib import asynccontextmanager
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException
+from pydantic import BaseModel
+from typing import List, Tuple
+
+from routing.osrm_async import criar_sessao, calcular_matriz_distancias_async, consultar_rotas_async
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Uma sessão aiohttp (pool de conexões ao OSRM) compartilhada por todas as requisições
+    app.state.sessao_osrm = criar_sessao()
+    yield
+    await app.state.sessao_osrm.close()
+
+app = FastAPI(lifespan=lifespan)
+
+
+class PedidoMatriz(BaseModel):
+    pontos: List[Tuple[float, float]]
+    metrica: str = "duration"
+
+
+class PedidoRotas(BaseModel):
+    rotas: List[List[Tuple[float, float]]]
 
-app = FastAPI()
 
 @app.get("/")
 def read_root():
     return {"message": "Wazelog FastAPI backend online!"}
+
+
+@app.post("/matriz")
+async def matriz(pedido: PedidoMatriz):
+    try:
+        resultado = await calcular_matriz_distancias_async(pedido.pontos, pedido.metrica, sessao=app.state.sessao_osrm)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if resultado is None:
+        raise HTTPException(status_code=502, detail="Falha ao calcular a matriz no OSRM.")
+    if isinstance(resultado, dict):
+        return {m: matriz.tolist() for m, matriz in resultado.items()}
+    return {pedido.metrica: resultado.tolist()}
+
+
+@app.post("/rotas")
+async def rotas(pedido: PedidoRotas):
+    respostas = await consultar_rotas_async(pedido.rotas, sessao=app.state.sessao_osrm)
+    return {"rotas": respostas}
@@ -1,9 +1,12 @@
-import requests
 import logging
 import os
+from routing import sessao_http, balanceador_osrm
+from routing.balanceador_osrm import ler_servidores
+from routing.distancias import formatar_coordenadas
 
-# URL base do OSRM pode ser configurada por variável de ambiente
-OSRM_SERVER_URL = os.environ.get("OSRM_BASE_URL", "https://router.project-osrm.org")
+# URL base do OSRM pode ser configurada por variável de ambiente (vários servidores separados por vírgula)
+OSRM_SERVIDORES = ler_servidores(os.environ.get("OSRM_BASE_URL", "https://router.project-osrm.org"))
+OSRM_SERVER_URL = OSRM_SERVIDORES[0]
 
 def consultar_google_maps_directions(origem, destino, api_key):
     """
@@ -18,7 +21,7 @@ def consultar_google_maps_directions(origem, destino, api_key):
     url = "https://maps.googleapis.com/maps/api/directions/json"
     params = {"origin": origem, "destination": destino, "key": api_key}
     try:
-        resp = requests.get(url, params=params, timeout=10)
+        resp = sessao_http.get(url, params=params)
         resp.raise_for_status()
         return resp.json()
     except Exception as e:
@@ -38,7 +41,7 @@ def consultar_mapbox_directions(origem, destino, access_token):
     url = f"https://api.mapbox.com/directions/v5/mapbox/driving/{origem[1]},{origem[0]};{destino[1]},{destino[0]}"
     params = {"access_token": access_token, "geometries": "geojson"}
     try:
-        resp = requests.get(url, params=params, timeout=10)
+        resp = sessao_http.get(url, params=params)
         resp.raise_for_status()
         return resp.json()
     except Exception as e:
@@ -58,7 +61,7 @@ def consultar_api_rastreamento(placa, token):
     url = f"https://api.rastreamento.com/veiculo/{placa}"
     headers = {"Authorization": f"Bearer {token}"}
     try:
-        resp = requests.get(url, headers=headers, timeout=10)
+        resp = sessao_http.get(url, headers=headers)
         resp.raise_for_status()
         return resp.json()
     except Exception as e:
@@ -70,19 +73,17 @@ def consultar_osrm_route(coordenadas, osrm_url=None):  # Exemplo: [(lat, lon), (
     Consulta rota real por ruas usando OSRM local.
     Args:
         coordenadas (list): Lista de tuplas (lat, lon) na ordem da rota.
-        osrm_url (str): URL base do OSRM local (ex: http://localhost:5000).
+        osrm_url (str): URL base do OSRM local (ex: http://localhost:5000); várias separadas por vírgula.
     Returns:
         dict: Resposta da API OSRM ou None em caso de erro.
     """
-    if osrm_url is None:
-        osrm_url = OSRM_SERVER_URL
+    servidores = ler_servidores(osrm_url) if osrm_url else OSRM_SERVIDORES
     if not coordenadas or len(coordenadas) < 2:
         return None
-    coords_str = ";".join(f"{lon},{lat}" for lat, lon in coordenadas)
-    url = f"{osrm_url}/route/v1/driving/{coords_str}"
+    coords_str = formatar_coordenadas(coordenadas)
     params = {"overview": "full", "geometries": "geojson", "steps": "true"}
     try:
-        resp = requests.get(url, params=params, timeout=10)
+        resp = balanceador_osrm.get(f"/route/v1/driving/{coords_str}", servidores, params=params, timeout=10)
         resp.raise_for_status()
         return resp.json()
     except Exception as e:
@@ -94,19 +95,17 @@ def consultar_osrm_table(coordenadas, osrm_url=None):  # Matriz de distâncias/t
     Consulta matriz de distâncias e tempos usando OSRM local.
     Args:
         coordenadas (list): Lista de tuplas (lat, lon).
-        osrm_url (str): URL base do OSRM local.
+        osrm_url (str): URL base do OSRM local; várias separadas por vírgula.
     Returns:
         dict: Resposta da API OSRM ou None em caso de erro.
     """
-    if osrm_url is None:
-        osrm_url = OSRM_SERVER_URL
+    servidores = ler_servidores(osrm_url) if osrm_url else OSRM_SERVIDORES
     if not coordenadas or len(coordenadas) < 2:
         return None
-    coords_str = ";".join(f"{lon},{lat}" for lat, lon in coordenadas)
-    url = f"{osrm_url}/table/v1/driving/{coords_str}"
+    coords_str = formatar_coordenadas(coordenadas)
     params = {"annotations": "duration,distance"}
     try:
-        resp = requests.get(url, params=params, timeout=20)
+        resp = balanceador_osrm.get(f"/table/v1/driving/{coords_str}", servidores, params=params, timeout=20)
         resp.raise_for_status()
         return resp.json()
     except Exception as e:
@@ -0,0 +1,196 @@
+"""
+Balanceamento de carga entre vários servidores OSRM.
+
+OSRM_BASE_URL aceita uma lista separada por vírgulas (ex: "http://osrm1:5000,http://osrm2:5000").
+Cada requisição Table/Route vai para o servidor com menos requisições em andamento
+(least outstanding requests), entre os que o disjuntor (routing.disjuntor) permite chamar.
+Servidores que falham saem do rodízio automaticamente: pelas falhas das próprias requisições
+ou pela verificação de saúde periódica, que também os devolve ao rodízio quando voltam.
+"""
+import os
+import logging
+import threading
+
+from routing import sessao_http
+from routing.disjuntor import obter_disjuntor, DisjuntorAbertoError, ABERTO, FECHADO
+
+# --- Constantes ---
+INTERVALO_SAUDE = float(os.environ.get("OSRM_INTERVALO_SAUDE", 15))  # Segundos entre verificações; 0 desativa
+TIMEOUT_SAUDE = (2, 5)
+# Rota mínima usada na verificação: qualquer resposta HTTP < 500 (inclusive 400 NoSegment) indica servidor vivo
+CAMINHO_SAUDE = "/route/v1/driving/-46.6333,-23.5505;-46.6334,-23.5506?overview=false"
+
+
+def ler_servidores(valor):
+    """Converte "url1,url2" (ou uma lista) em lista de URLs base sem barra final e sem repetição."""
+    itens = valor.split(",") if isinstance(valor, str) else list(valor)
+    servidores = []
+    for item in itens:
+        url = item.strip().rstrip("/")
+        if url and url not in servidores:
+            servidores.append(url)
+    return servidores
+
+
+class BalanceadorOSRM:
+    """
+    Escolhe o servidor de cada requisição (menos requisições em andamento; empate em rodízio)
+    e mantém a contagem de requisições em andamento por servidor. Thread-safe.
+    """
+
+    def __init__(self, servidores):
+        self.servidores = ler_servidores(servidores)
+        if not self.servidores:
+            raise ValueError("Informe ao menos um servidor OSRM.")
+        self._lock = threading.Lock()
+        self._pendentes = {s: 0 for s in self.servidores}
+        self._requisicoes = {s: 0 for s in self.servidores}
+        self._proximo = 0
+        self._parar = threading.Event()
+        self._thread_saude = None
+
+    def adquirir(self, excluir=()):
+        """
+        Reserva o servidor com menos requisições em andamento cujo disjuntor permite a chamada.
+        Quem adquire deve chamar `liberar(servidor)` ao terminar.
+
+        Args:
+            excluir (iterable): Servidores a não considerar (ex: já tentados nesta requisição).
+
+        Returns:
+            str or None: URL base do servidor, ou None se todos estiverem fora do rodízio.
+        """
+        with self._lock:
+            n = len(self.servidores)
+            ordem = sorted(range(n), key=lambda i: (self._pendentes[self.servidores[i]], (i - self._proximo) % n))
+            self._proximo = (self._proximo + 1) % n
+            for i in ordem:
+                servidor = self.servidores[i]
+                if servidor not in excluir and obter_disjuntor(servidor).permitir():
+                    self._pendentes[servidor] += 1
+                    self._requisicoes[servidor] += 1
+                    return servidor
+        return None
+
+    def liberar(self, servidor):
+        """Encerra uma requisição reservada por `adquirir` (chamar em `finally`), inclusive a de teste do disjuntor."""
+        with self._lock:
+            if self._pendentes.get(servidor, 0) > 0:
+                self._pendentes[servidor] -= 1
+        obter_disjuntor(servidor).liberar_teste()
+
+    def todos_abertos(self):
+        """True se o disjuntor de todos os servidores estiver aberto."""
+        return all(obter_disjuntor(s).estado == ABERTO for s in self.servidores)
+
+    def estatisticas(self):
+        """Returns: dict {servidor: {'pendentes', 'requisicoes', 'estado'}}."""
+        with self._lock:
+            return {s: {'pendentes': self._pendentes[s], 'requisicoes': self._requisicoes[s],
+                        'estado': obter_disjuntor(s).estado} for s in self.servidores}
+
+    def verificar_saude(self):
+        """
+        Faz uma requisição mínima a cada servidor: servidores que não respondem (ou respondem 5xx)
+        saem do rodízio na hora; os que respondem voltam a ele.
+
+        Returns:
+            dict: {servidor: True se saudável}.
+        """
+        resultado = {}
+        for servidor in self.servidores:
+            disjuntor = obter_disjuntor(servidor)
+            try:
+                resp = sessao_http.get(f"{servidor}{CAMINHO_SAUDE}", servico="osrm", timeout=TIMEOUT_SAUDE)
+                saudavel = resp.status_code < 500
+            except Exception as e:
+                logging.warning(f"Verificação de saúde do OSRM {servidor} falhou: {e}")
+                saudavel = False
+            if saudavel:
+                if disjuntor.estado != FECHADO:
+                    disjuntor.registrar_sucesso()
+            else:
+                disjuntor.abrir()
+            resultado[servidor] = saudavel
+        return resultado
+
+    def iniciar_verificacao(self, intervalo=INTERVALO_SAUDE):
+        """Inicia a verificação de saúde periódica em uma thread de fundo (daemon)."""
+        if intervalo <= 0 or (self._thread_saude is not None and self._thread_saude.is_alive()):
+            return
+        self._parar.clear()
+
+        def _laco():
+            while not self._parar.wait(intervalo):
+                try:
+                    self.verificar_saude()
+                except Exception as e:
+                    logging.error(f"Erro na verificação de saúde dos servidores OSRM: {e}")
+
+        self._thread_saude = threading.Thread(target=_laco, name="saude-osrm", daemon=True)
+        self._thread_saude.start()
+
+    def parar_verificacao(self):
+        self._parar.set()
+
+
+_balanceadores = {}
+_balanceadores_lock = threading.Lock()
+
+
+def obter_balanceador(servidores):
+    """
+    Retorna o balanceador compartilhado de um conjunto de servidores (criado sob demanda).
+    Com mais de um servidor, a verificação de saúde periódica é iniciada automaticamente.
+    """
+    chave = tuple(ler_servidores(servidores))
+    with _balanceadores_lock:
+        balanceador = _balanceadores.get(chave)
+        if balanceador is None:
+            balanceador = BalanceadorOSRM(chave)
+            if len(chave) > 1:
+                balanceador.iniciar_verificacao()
+            _balanceadores[chave] = balanceador
+        return balanceador
+
+
+def get(caminho, servidores, **kwargs):
+    """
+    GET balanceado: `caminho` (ex: "/route/v1/driving/...") é enviado ao servidor escolhido;
+    em erro de conexão ou HTTP 5xx, tenta uma vez cada um dos outros servidores disponíveis.
+
+    Returns:
+        requests.Response: Resposta do primeiro servidor que respondeu (status < 500 ou o último 5xx).
+
+    Raises:
+        DisjuntorAbertoError: Se nenhum servidor estiver disponível.
+        requests.exceptions.RequestException: Erro do último servidor tentado.
+    """
+    balanceador = obter_balanceador(servidores)
+    ultimo_erro = None
+    resposta = None
+    tentados = set()
+    for _ in range(len(balanceador.servidores)):
+        servidor = balanceador.adquirir(excluir=tentados)
+        if servidor is None:
+            break
+        tentados.add(servidor)
+        disjuntor = obter_disjuntor(servidor)
+        try:
+            resposta = sessao_http.get(f"{servidor}{caminho}", servico="osrm", **kwargs)
+        except Exception as e:
+            disjuntor.registrar_falha()
+            ultimo_erro = e
+            logging.warning(f"Requisição ao OSRM {servidor} falhou; tentando outro servidor: {e}")
+            continue
+        finally:
+            balanceador.liberar(servidor)
+        if resposta.status_code < 500:
+            disjuntor.registrar_sucesso()
+            return resposta
+        disjuntor.registrar_falha()
+    if resposta is not None:
+        return resposta
+    if ultimo_erro is not None:
+        raise ultimo_erro
+    raise DisjuntorAbertoError(f"Nenhum servidor OSRM disponível ({', '.join(balanceador.servidores)}).")
@@ -0,0 +1,476 @@
+"""
+Cache de resultados OSRM por par de coordenadas: persistente (SQLite) e em memória (LRU
+limitado em bytes, com TTL), combinados em camadas no cache padrão.
+"""
+import os
+import sys
+import sqlite3
+import logging
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+# --- Constantes ---
+# Caminho do banco de cache; pode ser sobrescrito pela variável de ambiente OSRM_CACHE_PATH
+CACHE_DB_PATH = os.environ.get(
+    "OSRM_CACHE_PATH",
+    os.path.join(os.path.dirname(__file__), '..', 'database', 'cache_osrm.db')
+)
+PRECISAO_CACHE = 5  # Casas decimais usadas para arredondar lat/lon (~1 m)
+PERFIL_PADRAO = "driving"
+# Cache em memória (L1) na frente do SQLite
+CACHE_MEMORIA_MAX_BYTES = int(float(os.environ.get("OSRM_CACHE_MEMORIA_MB", 64)) * 1024 * 1024)
+# Além da chave e do valor (medidos com sys.getsizeof), cada par ocupa um slot na tabela hash e um
+# nó da lista ligada do OrderedDict (~120 bytes no CPython 3, medido com tracemalloc)
+BYTES_ENTRADA_ORDEREDDICT = 120
+LOTE_BUSCA_MEMORIA = 4096  # Chaves consultadas por aquisição do lock (as demais threads intercalam entre lotes)
+CACHE_MEMORIA_TTL = float(os.environ.get("OSRM_CACHE_TTL", 6 * 3600))  # Segundos; 0 desativa a expiração
+
+
+class CacheParesOSRM:
+    """
+    Cache em disco de valores OSRM (duração/distância) indexado por
+    (origem arredondada, destino arredondado, métrica, perfil).
+
+    As coordenadas são guardadas como inteiros (lat/lon * 10^precisao) para que a
+    chave seja exata e o índice da tabela seja compacto.
+    """
+
+    def __init__(self, caminho=None, precisao=PRECISAO_CACHE):
+        self.caminho = caminho or CACHE_DB_PATH
+        self.precisao = precisao
+        self._escala = 10 ** precisao
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(os.path.abspath(self.caminho)), exist_ok=True)
+        conn = self._conectar()
+        conn.execute('''CREATE TABLE IF NOT EXISTS pares_osrm (
+            olat INTEGER,
+            olon INTEGER,
+            dlat INTEGER,
+            dlon INTEGER,
+            metrica TEXT,
+            perfil TEXT,
+            valor REAL,
+            PRIMARY KEY (olat, olon, dlat, dlon, metrica, perfil)
+        ) WITHOUT ROWID''')
+        conn.commit()
+        conn.close()
+
+    def _conectar(self):
+        return sqlite3.connect(self.caminho, check_same_thread=False, timeout=30)
+
+    def _chaves(self, pontos):
+        """Converte [(lat, lon), ...] em uma lista de tuplas inteiras (lat, lon) arredondadas."""
+        arr = np.asarray(pontos, dtype=float).reshape(-1, 2)
+        return [tuple(p) for p in np.rint(arr * self._escala).astype(np.int64).tolist()]
+
+    def buscar_matriz(self, pontos, metrica, perfil=PERFIL_PADRAO):
+        """
+        Busca no cache todos os pares (i, j) entre os pontos informados.
+
+        Args:
+            pontos (list): Lista de tuplas (latitude, longitude).
+            metrica (str): "duration" ou "distance".
+            perfil (str): Perfil de roteamento OSRM (ex: "driving").
+
+        Returns:
+            tuple: (valores, encontrados) — matriz NxN float com os valores em cache
+                   (NaN onde não há) e máscara booleana NxN dos pares encontrados.
+        """
+        n = len(pontos)
+        valores = np.full((n, n), np.nan)
+        encontrados = np.zeros((n, n), dtype=bool)
+        if n == 0:
+            return valores, encontrados
+
+        chaves = self._chaves(pontos)
+        conn = self._conectar()
+        try:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS pts (idx INTEGER, lat INTEGER, lon INTEGER)")
+            conn.execute("DELETE FROM pts")
+            conn.executemany("INSERT INTO pts (idx, lat, lon) VALUES (?, ?, ?)",
+                             [(i, lat, lon) for i, (lat, lon) in enumerate(chaves)])
+            cur = conn.execute('''
+                SELECT o.idx, d.idx, c.valor
+                FROM pts o
+                JOIN pts d
+                JOIN pares_osrm c
+                  ON c.olat = o.lat AND c.olon = o.lon
+                 AND c.dlat = d.lat AND c.dlon = d.lon
+                 AND c.metrica = ? AND c.perfil = ?
+            ''', (metrica, perfil))
+            linhas = cur.fetchall()
+        finally:
+            conn.close()
+
+        if linhas:
+            dados = np.array(linhas, dtype=float)
+            i_idx = dados[:, 0].astype(np.intp)
+            j_idx = dados[:, 1].astype(np.intp)
+            valores[i_idx, j_idx] = dados[:, 2]
+            encontrados[i_idx, j_idx] = True
+
+        fora_diagonal = n * n - n
+        acertos = int(encontrados.sum() - encontrados.diagonal().sum())
+        with self._lock:
+            self.hits += acertos
+            self.misses += fora_diagonal - acertos
+        return valores, encontrados
+
+    def buscar_pares(self, pontos_origem, pontos_destino, metrica, perfil=PERFIL_PADRAO):
+        """
+        Busca no cache uma lista arbitrária de pares (origem_k, destino_k), sem montar a matriz NxN.
+
+        Args:
+            pontos_origem (list): Lista de tuplas (latitude, longitude) de origem.
+            pontos_destino (list): Lista de tuplas (latitude, longitude) de destino, mesmo tamanho.
+            metrica (str): "duration" ou "distance".
+            perfil (str): Perfil de roteamento OSRM.
+
+        Returns:
+            tuple: (valores, encontrados) — arrays 1D float (NaN onde não há) e bool.
+        """
+        k = len(pontos_origem)
+        valores = np.full(k, np.nan)
+        encontrados = np.zeros(k, dtype=bool)
+        if k == 0:
+            return valores, encontrados
+
+        orig = self._chaves(pontos_origem)
+        dest = self._chaves(pontos_destino)
+        conn = self._conectar()
+        try:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS pares_busca (idx INTEGER, olat INTEGER, olon INTEGER, dlat INTEGER, dlon INTEGER)")
+            conn.execute("DELETE FROM pares_busca")
+            conn.executemany("INSERT INTO pares_busca (idx, olat, olon, dlat, dlon) VALUES (?, ?, ?, ?, ?)",
+                             [(i, o[0], o[1], d[0], d[1]) for i, (o, d) in enumerate(zip(orig, dest))])
+            linhas = conn.execute('''
+                SELECT p.idx, c.valor
+                FROM pares_busca p
+                JOIN pares_osrm c
+                  ON c.olat = p.olat AND c.olon = p.olon
+                 AND c.dlat = p.dlat AND c.dlon = p.dlon
+                 AND c.metrica = ? AND c.perfil = ?
+            ''', (metrica, perfil)).fetchall()
+        finally:
+            conn.close()
+
+        if linhas:
+            dados = np.array(linhas, dtype=float)
+            idx = dados[:, 0].astype(np.intp)
+            valores[idx] = dados[:, 1]
+            encontrados[idx] = True
+
+        acertos = int(encontrados.sum())
+        with self._lock:
+            self.hits += acertos
+            self.misses += k - acertos
+        return valores, encontrados
+
+    def salvar_bloco(self, pontos_origem, pontos_destino, valores, metrica, perfil=PERFIL_PADRAO, valor_invalido=None):
+        """
+        Grava no cache um bloco de resultados (origens x destinos).
+        Valores None, NaN ou iguais a `valor_invalido` não são gravados.
+        """
+        escala = self._escala
+        orig = np.rint(np.asarray(pontos_origem, dtype=float).reshape(-1, 2) * escala).astype(np.int64)
+        dest = np.rint(np.asarray(pontos_destino, dtype=float).reshape(-1, 2) * escala).astype(np.int64)
+        valores = np.array(valores, dtype=float)  # None -> NaN
+        validos = np.isfinite(valores)
+        if valor_invalido is not None:
+            validos &= valores != valor_invalido
+        i_idx, j_idx = np.nonzero(validos)
+        registros = list(zip(
+            orig[i_idx, 0].tolist(), orig[i_idx, 1].tolist(),
+            dest[j_idx, 0].tolist(), dest[j_idx, 1].tolist(),
+            [metrica] * len(i_idx), [perfil] * len(i_idx),
+            valores[i_idx, j_idx].tolist(),
+        ))
+        if not registros:
+            return 0
+        conn = self._conectar()
+        try:
+            conn.executemany('''INSERT OR REPLACE INTO pares_osrm
+                                (olat, olon, dlat, dlon, metrica, perfil, valor)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)''', registros)
+            conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Erro ao gravar pares no cache OSRM ({self.caminho}): {e}")
+            return 0
+        finally:
+            conn.close()
+        return len(registros)
+
+    def listar_pares(self, metrica, perfil=PERFIL_PADRAO, limite=200000):
+        """
+        Retorna até `limite` pares gravados para uma métrica, já em graus.
+
+        Returns:
+            numpy.ndarray: Array (k, 5) com colunas [lat_origem, lon_origem, lat_destino, lon_destino, valor].
+        """
+        conn = self._conectar()
+        try:
+            linhas = conn.execute('''SELECT olat, olon, dlat, dlon, valor FROM pares_osrm
+                                     WHERE metrica = ? AND perfil = ? LIMIT ?''',
+                                  (metrica, perfil, int(limite))).fetchall()
+        finally:
+            conn.close()
+        if not linhas:
+            return np.empty((0, 5))
+        dados = np.array(linhas, dtype=float)
+        dados[:, :4] /= self._escala
+        return dados
+
+    def estatisticas(self):
+        """Retorna contadores acumulados de acertos/faltas do cache."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'taxa_acerto': (self.hits / total) if total else 0.0,
+            }
+
+    def limpar(self):
+        """Remove todos os pares gravados e zera as estatísticas."""
+        conn = self._conectar()
+        conn.execute("DELETE FROM pares_osrm")
+        conn.commit()
+        conn.close()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+class CacheMemoriaPares:
+    """
+    Cache em memória (LRU) de valores OSRM por par de coordenadas, limitado em bytes e com TTL.
+
+    O tamanho de cada par é medido ao gravar (chave, valor e a entrada do OrderedDict; ver
+    _tamanho_par) e os menos usados são despejados enquanto o total passar de max_bytes.
+
+    Mesma interface de leitura/gravação de CacheParesOSRM (buscar_matriz, buscar_pares,
+    salvar_bloco, estatisticas, limpar), de modo que pares já consultados no processo sejam
+    reaproveitados independentemente da ordem/lote em que os pontos aparecem.
+    """
+
+    def __init__(self, max_bytes=CACHE_MEMORIA_MAX_BYTES, ttl=CACHE_MEMORIA_TTL, precisao=PRECISAO_CACHE):
+        self.max_bytes = int(max_bytes)
+        self.bytes_usados = 0
+        self.ttl = float(ttl)
+        self._escala = 10 ** precisao
+        self._pares = OrderedDict()  # (olat, olon, dlat, dlon, metrica, perfil) -> (valor, expira_em)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirados = 0
+
+    def _chaves(self, pontos):
+        arr = np.asarray(pontos, dtype=float).reshape(-1, 2)
+        return [tuple(p) for p in np.rint(arr * self._escala).astype(np.int64).tolist()]
+
+    @staticmethod
+    def _tamanho_par(chave, item):
+        """Bytes ocupados por um par: tuplas e números da chave e do valor mais a entrada do OrderedDict.
+        metrica e perfil são strings compartilhadas por todos os pares e não entram na conta."""
+        return (sys.getsizeof(chave) + sum(sys.getsizeof(c) for c in chave[:4])
+                + sys.getsizeof(item) + sum(sys.getsizeof(v) for v in item) + BYTES_ENTRADA_ORDEREDDICT)
+
+    def _remover(self, chave):
+        """Remove um par e desconta seu tamanho (chamar com o lock)."""
+        self.bytes_usados -= self._tamanho_par(chave, self._pares.pop(chave))
+
+    def _buscar_chaves(self, chaves):
+        """Busca uma lista de chaves completas; retorna (valores, encontrados) 1D. Chamar sem o lock.
+
+        O lock é tomado por lotes de LOTE_BUSCA_MEMORIA chaves, para que uma matriz grande não
+        bloqueie as demais threads durante a busca inteira."""
+        valores = np.full(len(chaves), np.nan)
+        encontrados = np.zeros(len(chaves), dtype=bool)
+        agora = time.monotonic()
+        for inicio in range(0, len(chaves), LOTE_BUSCA_MEMORIA):
+            with self._lock:
+                for k in range(inicio, min(inicio + LOTE_BUSCA_MEMORIA, len(chaves))):
+                    chave = chaves[k]
+                    item = self._pares.get(chave)
+                    if item is None:
+                        continue
+                    if item[1] < agora:
+                        self._remover(chave)
+                        self.expirados += 1
+                        continue
+                    self._pares.move_to_end(chave)
+                    valores[k] = item[0]
+                    encontrados[k] = True
+        return valores, encontrados
+
+    def buscar_pares(self, pontos_origem, pontos_destino, metrica, perfil=PERFIL_PADRAO):
+        """Busca pares arbitrários (origem_k, destino_k). Returns: (valores, encontrados) 1D."""
+        chaves = [o + d + (metrica, perfil) for o, d in zip(self._chaves(pontos_origem), self._chaves(pontos_destino))]
+        valores, encontrados = self._buscar_chaves(chaves)
+        acertos = int(encontrados.sum())
+        with self._lock:
+            self.hits += acertos
+            self.misses += len(chaves) - acertos
+        return valores, encontrados
+
+    def buscar_matriz(self, pontos, metrica, perfil=PERFIL_PADRAO):
+        """Busca todos os pares (i, j) entre os pontos. Returns: (valores NxN, encontrados NxN)."""
+        n = len(pontos)
+        chaves_pontos = self._chaves(pontos)
+        # As n² chaves são montadas fora do lock; _buscar_chaves só o toma para consultar o dicionário
+        chaves = [o + d + (metrica, perfil) for o in chaves_pontos for d in chaves_pontos]
+        valores, encontrados = self._buscar_chaves(chaves)
+        valores, encontrados = valores.reshape(n, n), encontrados.reshape(n, n)
+        acertos = int(encontrados.sum() - encontrados.diagonal().sum())
+        with self._lock:
+            self.hits += acertos
+            self.misses += n * n - n - acertos
+        return valores, encontrados
+
+    def salvar_pares(self, pontos_origem, pontos_destino, valores, metrica, perfil=PERFIL_PADRAO, valor_invalido=None):
+        """Grava pares arbitrários (origem_k, destino_k, valor_k), descartando inválidos."""
+        valores = np.array(valores, dtype=float).ravel()
+        validos = np.isfinite(valores)
+        if valor_invalido is not None:
+            validos &= valores != valor_invalido
+        orig = self._chaves(pontos_origem)
+        dest = self._chaves(pontos_destino)
+        expira = time.monotonic() + self.ttl if self.ttl > 0 else float("inf")
+        with self._lock:
+            for k in np.flatnonzero(validos).tolist():
+                chave = orig[k] + dest[k] + (metrica, perfil)
+                if chave in self._pares:
+                    self._remover(chave)
+                item = (float(valores[k]), expira)
+                self._pares[chave] = item
+                self.bytes_usados += self._tamanho_par(chave, item)
+            self._despejar()
+        return int(validos.sum())
+
+    def salvar_bloco(self, pontos_origem, pontos_destino, valores, metrica, perfil=PERFIL_PADRAO, valor_invalido=None):
+        """Grava um bloco origens x destinos (mesma semântica de CacheParesOSRM.salvar_bloco)."""
+        valores = np.array(valores, dtype=float)
+        i_idx, j_idx = np.indices(valores.shape).reshape(2, -1)
+        orig = np.asarray(pontos_origem, dtype=float).reshape(-1, 2)
+        dest = np.asarray(pontos_destino, dtype=float).reshape(-1, 2)
+        return self.salvar_pares(orig[i_idx], dest[j_idx], valores.ravel(), metrica, perfil, valor_invalido)
+
+    def _despejar(self):
+        """Remove os pares menos usados até caber em max_bytes (chamar com o lock)."""
+        while self._pares and self.bytes_usados > self.max_bytes:
+            chave, item = self._pares.popitem(last=False)
+            self.bytes_usados -= self._tamanho_par(chave, item)
+            self.evictions += 1
+
+    def estatisticas(self):
+        """Retorna contadores de acertos, faltas, despejos (evictions), expirados, pares guardados e bytes usados."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirados': self.expirados,
+                'pares': len(self._pares),
+                'bytes': self.bytes_usados,
+                'taxa_acerto': (self.hits / total) if total else 0.0,
+            }
+
+    def limpar(self):
+        """Remove todos os pares e zera as estatísticas."""
+        with self._lock:
+            self._pares.clear()
+            self.bytes_usados = 0
+            self.hits = self.misses = self.evictions = self.expirados = 0
+
+
+class CacheEmCamadas:
+    """
+    Combina o cache em memória (L1) com o cache persistente SQLite (L2).
+    Leituras consultam o L1 e só vão ao SQLite pelos pares ausentes; pares achados no
+    SQLite são promovidos ao L1. Gravações vão para as duas camadas.
+    """
+
+    def __init__(self, memoria=None, disco=None):
+        self.memoria = memoria or CacheMemoriaPares()
+        self.disco = disco or CacheParesOSRM()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def buscar_pares(self, pontos_origem, pontos_destino, metrica, perfil=PERFIL_PADRAO):
+        valores, encontrados = self.memoria.buscar_pares(pontos_origem, pontos_destino, metrica, perfil)
+        faltam = np.flatnonzero(~encontrados)
+        if len(faltam):
+            orig = np.asarray(pontos_origem, dtype=float).reshape(-1, 2)[faltam]
+            dest = np.asarray(pontos_destino, dtype=float).reshape(-1, 2)[faltam]
+            valores_disco, achados = self.disco.buscar_pares(orig, dest, metrica, perfil)
+            valores[faltam[achados]] = valores_disco[achados]
+            encontrados[faltam[achados]] = True
+            if achados.any():
+                self.memoria.salvar_pares(orig[achados], dest[achados], valores_disco[achados], metrica, perfil)
+        acertos = int(encontrados.sum())
+        with self._lock:
+            self.hits += acertos
+            self.misses += len(encontrados) - acertos
+        return valores, encontrados
+
+    def buscar_matriz(self, pontos, metrica, perfil=PERFIL_PADRAO):
+        n = len(pontos)
+        valores, encontrados = self.memoria.buscar_matriz(pontos, metrica, perfil)
+        ausentes = ~encontrados
+        np.fill_diagonal(ausentes, False)
+        if ausentes.any():
+            valores_disco, achados = self.disco.buscar_matriz(pontos, metrica, perfil)
+            promover = achados & ausentes
+            valores[promover] = valores_disco[promover]
+            encontrados |= achados
+            if promover.any():
+                arr = np.asarray(pontos, dtype=float).reshape(-1, 2)
+                i_idx, j_idx = np.nonzero(promover)
+                self.memoria.salvar_pares(arr[i_idx], arr[j_idx], valores_disco[promover], metrica, perfil)
+        acertos = int(encontrados.sum() - encontrados.diagonal().sum())
+        with self._lock:
+            self.hits += acertos
+            self.misses += n * n - n - acertos
+        return valores, encontrados
+
+    def salvar_bloco(self, pontos_origem, pontos_destino, valores, metrica, perfil=PERFIL_PADRAO, valor_invalido=None):
+        self.memoria.salvar_bloco(pontos_origem, pontos_destino, valores, metrica, perfil, valor_invalido)
+        return self.disco.salvar_bloco(pontos_origem, pontos_destino, valores, metrica, perfil, valor_invalido)
+
+    def listar_pares(self, metrica, perfil=PERFIL_PADRAO, limite=200000):
+        return self.disco.listar_pares(metrica, perfil, limite)
+
+    def estatisticas(self):
+        """Acertos/faltas combinados (par achado em qualquer camada) e estatísticas de cada camada."""
+        with self._lock:
+            total = self.hits + self.misses
+            stats = {'hits': self.hits, 'misses': self.misses, 'taxa_acerto': (self.hits / total) if total else 0.0}
+        stats['memoria'] = self.memoria.estatisticas()
+        stats['disco'] = self.disco.estatisticas()
+        return stats
+
+    def limpar(self):
+        self.memoria.limpar()
+        self.disco.limpar()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+_cache_padrao = None
+_cache_padrao_lock = threading.Lock()
+
+def obter_cache_padrao():
+    """Retorna a instância compartilhada do cache (memória + SQLite), criada sob demanda."""
+    global _cache_padrao
+    with _cache_padrao_lock:
+        if _cache_padrao is None:
+            _cache_padrao = CacheEmCamadas(CacheMemoriaPares(), CacheParesOSRM())
+        return _cache_padrao
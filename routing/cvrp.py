@@ -1,15 +1,90 @@
+import os
+import time
 from routing.utils import get_logger, validar_dataframe, validar_matriz
 
-def solver_cvrp(pedidos, frota, matriz_distancias, pos_processamento=False, tipo_heuristica='2opt', kwargs_heuristica=None, ajuste_capacidade_pct=100):
+# --- Presets de esforço de busca ---
+# primeira_solucao: pares (limite de nós, estratégia); vale o primeiro cujo limite comporta o problema (None = sem limite).
+# Tempo limite (s) = tempo_base + tempo_por_no * nós, até tempo_maximo.
+# limite_solucoes: (base, por nó) soluções encontradas antes de parar; None = só o tempo limita.
+PRESETS_BUSCA = {
+    "rascunho": {
+        "primeira_solucao": [(None, "PATH_CHEAPEST_ARC")],
+        "metaheuristica": "GREEDY_DESCENT",
+        "tempo_base": 1, "tempo_por_no": 0.002, "tempo_maximo": 5,
+        "limite_solucoes": (20, 0.5),
+    },
+    "padrão": {
+        "primeira_solucao": [(None, "PATH_CHEAPEST_ARC")],
+        "metaheuristica": "GUIDED_LOCAL_SEARCH",
+        "tempo_base": 5, "tempo_por_no": 0.05, "tempo_maximo": 120,
+        "limite_solucoes": None,
+    },
+    "intensivo": {
+        # Inserção paralela dá rotas iniciais melhores, mas é cara em problemas grandes
+        "primeira_solucao": [(300, "PARALLEL_CHEAPEST_INSERTION"), (None, "SAVINGS")],
+        "metaheuristica": "GUIDED_LOCAL_SEARCH",
+        "tempo_base": 20, "tempo_por_no": 0.2, "tempo_maximo": 600,
+        "limite_solucoes": None,
+    },
+}
+PRESET_PADRAO = "padrão"
+# Processos simultâneos dos solvers paralelos (decomposição, portfólio e cenários do CVRP Flex)
+MAX_PROCESSOS = int(os.environ.get("CVRP_MAX_PROCESSOS", os.cpu_count() or 1))
+
+
+def parametros_busca(preset=PRESET_PADRAO, n_nos=0, tempo_limite=None, primeira_solucao=None, metaheuristica=None):
+    """
+    Monta os parâmetros de busca do OR-Tools para um preset, escalando pelo tamanho do problema.
+
+    Args:
+        preset (str): "rascunho", "padrão" ou "intensivo".
+        n_nos (int): Número de nós do problema (depósito + pedidos).
+        tempo_limite (float, optional): Sobrescreve o tempo limite do preset (segundos).
+        primeira_solucao (str, optional): Sobrescreve a estratégia inicial (nome em FirstSolutionStrategy, ex: "SAVINGS").
+        metaheuristica (str, optional): Sobrescreve a metaheurística (nome em LocalSearchMetaheuristic, ex: "TABU_SEARCH").
+
+    Returns:
+        RoutingSearchParameters: Parâmetros prontos para RoutingModel.SolveWithParameters.
+    """
+    from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+
+    if preset not in PRESETS_BUSCA:
+        raise ValueError(f"Preset de busca desconhecido: '{preset}'. Use um de {list(PRESETS_BUSCA)}.")
+    config = PRESETS_BUSCA[preset]
+    primeira = primeira_solucao or next(estrategia for limite, estrategia in config["primeira_solucao"] if limite is None or n_nos <= limite)
+    metaheuristica = metaheuristica or config["metaheuristica"]
+    for enum, nome in ((routing_enums_pb2.FirstSolutionStrategy, primeira), (routing_enums_pb2.LocalSearchMetaheuristic, metaheuristica)):
+        if not hasattr(enum, nome):
+            raise ValueError(f"Estratégia de busca desconhecida: '{nome}'.")
+    if tempo_limite is None:
+        tempo_limite = min(config["tempo_maximo"], config["tempo_base"] + config["tempo_por_no"] * n_nos)
+
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    search_parameters.first_solution_strategy = getattr(routing_enums_pb2.FirstSolutionStrategy, primeira)
+    search_parameters.local_search_metaheuristic = getattr(routing_enums_pb2.LocalSearchMetaheuristic, metaheuristica)
+    search_parameters.time_limit.FromMilliseconds(int(tempo_limite * 1000))
+    if config["limite_solucoes"] is not None:
+        base, por_no = config["limite_solucoes"]
+        search_parameters.solution_limit = int(base + por_no * n_nos)
+    return search_parameters
+
+
+def solver_cvrp(pedidos, frota, matriz_distancias, pos_processamento=False, tipo_heuristica='2opt', kwargs_heuristica=None, ajuste_capacidade_pct=100,
+                preset=PRESET_PADRAO, tempo_limite=None, ao_melhorar=None, primeira_solucao=None, metaheuristica=None):
     """
     Capacitated VRP: considera a capacidade máxima de carga dos veículos além da roteirização.
     Se pos_processamento=True, aplica heurística ('2opt', 'merge', 'split') automaticamente nas rotas geradas.
     ajuste_capacidade_pct: percentual de ajuste da capacidade dos veículos (default=100, pode ser até 120).
+    preset: esforço de busca ("rascunho", "padrão", "intensivo"; ver PRESETS_BUSCA); tempo_limite (s) o sobrescreve.
+    primeira_solucao / metaheuristica: sobrescrevem a estratégia do preset (ver parametros_busca).
+    ao_melhorar: função chamada a cada solução melhor encontrada durante a busca (modo anytime) com um dict
+        {'solucao', 'custo', 'segundos', 'rotas': {veículo: [índices de pedidos no DataFrame, em ordem]}}.
+        Se retornar False, a busca termina e a melhor solução até ali é usada.
     """
     import pandas as pd
-    from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+    from ortools.constraint_solver import pywrapcp
     import numpy as np
-    from routing import pos_processamento
+    from routing import pos_processamento as heuristicas_pos  # Alias: o parâmetro pos_processamento não pode ser sobrescrito
 
     logger = get_logger(__name__)
 
@@ -74,29 +149,13 @@ def solver_cvrp(pedidos, frota, matriz_distancias, pos_processamento=False, tipo
         manager = pywrapcp.RoutingIndexManager(num_locations, n_veiculos, depot_index)
         routing = pywrapcp.RoutingModel(manager)
 
-        # Callback de Distância
-        def distance_callback(from_index, to_index):
-            from_node = manager.IndexToNode(from_index)
-            to_node = manager.IndexToNode(to_index)
-            # Validação de índices
-            if 0 <= from_node < num_locations and 0 <= to_node < num_locations:
-                return distance_matrix[from_node][to_node]
-            else:
-                logger.error(f"Índice fora dos limites no distance_callback: {from_node}, {to_node}")
-                return 9999999 # Retorna um valor alto para penalizar rotas inválidas
-        transit_callback_index = routing.RegisterTransitCallback(distance_callback)
+        # Custo dos arcos registrado direto da matriz: a consulta de cada arco é feita em C++,
+        # sem chamar Python (IndexToNode + checagem de limites) a cada avaliação da busca local
+        transit_callback_index = routing.RegisterTransitMatrix(distance_matrix)
         routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
-        # Callback de Demanda e Dimensão de Capacidade
-        def demand_callback(from_index):
-            from_node = manager.IndexToNode(from_index)
-            # Validação de índices
-            if 0 <= from_node < len(demands):
-                return demands[from_node]
-            else:
-                 logger.error(f"Índice fora dos limites no demand_callback: {from_node}")
-                 return 0 # Retorna 0 para evitar falhas, mas indica problema
-        demand_callback_index = routing.RegisterUnaryTransitCallback(demand_callback)
+        # Demanda como vetor pré-calculado (um valor por nó) e Dimensão de Capacidade
+        demand_callback_index = routing.RegisterUnaryTransitVector(demands)
         routing.AddDimensionWithVehicleCapacity(
             demand_callback_index,
             0,  # Sem folga de capacidade
@@ -110,18 +169,57 @@ def solver_cvrp(pedidos, frota, matriz_distancias, pos_processamento=False, tipo
         logger.error(f"Erro na configuração do OR-Tools: {e}")
         return pd.DataFrame()
 
+    veiculos_ids = [
+        frota['ID Veículo'].iloc[vehicle_id]
+        if 'ID Veículo' in frota.columns and not frota.empty else
+        frota['Placa'].iloc[vehicle_id] if 'Placa' in frota.columns and not frota.empty else f'veiculo_{vehicle_id+1}'
+        for vehicle_id in range(n_veiculos)
+    ]
+
+    # --- Modo anytime: repassa cada solução melhor enquanto a busca continua ---
+    if ao_melhorar is not None:
+        inicio_busca = time.monotonic()
+        progresso = {'custo': None, 'solucoes': 0}
+
+        def solucao_encontrada():
+            custo = routing.CostVar().Value()
+            if progresso['custo'] is not None and custo >= progresso['custo']:
+                return
+            progresso['custo'] = custo
+            progresso['solucoes'] += 1
+            rotas_parciais = {}
+            for vehicle_id in range(n_veiculos):
+                paradas = []
+                index = routing.NextVar(routing.Start(vehicle_id)).Value()
+                while not routing.IsEnd(index):
+                    paradas.append(manager.IndexToNode(index) - 1)
+                    index = routing.NextVar(index).Value()
+                if paradas:
+                    rotas_parciais[veiculos_ids[vehicle_id]] = paradas
+            try:
+                continuar = ao_melhorar({
+                    'solucao': progresso['solucoes'],
+                    'custo': custo,
+                    'segundos': time.monotonic() - inicio_busca,
+                    'rotas': rotas_parciais,
+                })
+            except Exception as e:
+                logger.error(f"Erro no callback ao_melhorar (ignorado): {e}")
+                return
+            if continuar is False:
+                logger.info("Busca do CVRP interrompida pelo callback ao_melhorar.")
+                routing.solver().FinishCurrentSearch()
+        routing.AddAtSolutionCallback(solucao_encontrada)
+
     # --- Parâmetros de Busca ---
-    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = (
-        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
-    )
-    search_parameters.local_search_metaheuristic = (
-        routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
-    )
-    search_parameters.time_limit.seconds = 30 # Adiciona um limite de tempo
+    try:
+        search_parameters = parametros_busca(preset, num_locations, tempo_limite, primeira_solucao, metaheuristica)
+    except ValueError as e:
+        logger.error(f"CVRP Solver: {e}")
+        return pd.DataFrame()
 
     # --- Resolução ---
-    logger.info("Iniciando a resolução do CVRP com OR-Tools...")
+    logger.info(f"Iniciando a resolução do CVRP com OR-Tools (preset '{preset}', limite {search_parameters.time_limit.ToTimedelta().total_seconds():.1f}s)...")
     solution = routing.SolveWithParameters(search_parameters)
     logger.info("Resolução do CVRP concluída.")
 
@@ -136,11 +234,7 @@ def solver_cvrp(pedidos, frota, matriz_distancias, pos_processamento=False, tipo
         for vehicle_id in range(n_veiculos):
             index = routing.Start(vehicle_id)
             sequence = 1 # Começa a sequência em 1 para o primeiro cliente
-            vehicle_identifier = (
-                frota['ID Veículo'].iloc[vehicle_id]
-                if 'ID Veículo' in frota.columns and not frota.empty else
-                frota['Placa'].iloc[vehicle_id] if 'Placa' in frota.columns and not frota.empty else f'veiculo_{vehicle_id+1}'
-            )
+            vehicle_identifier = veiculos_ids[vehicle_id]
             route_distance_vehicle = 0
             route_load_vehicle = 0
             rota_indices = [0]  # Começa no depósito
@@ -205,16 +299,16 @@ def solver_cvrp(pedidos, frota, matriz_distancias, pos_processamento=False, tipo
             if tipo_heuristica == '2opt':
                 for rota in rotas_por_veiculo:
                     if len(rota) > 3:
-                        rota_opt = pos_processamento.heuristica_2opt(rota, matriz_np)
+                        rota_opt = heuristicas_pos.heuristica_2opt(rota, matriz_np)
                         rotas_otimizadas.append(rota_opt)
                     else:
                         rotas_otimizadas.append(rota)
             elif tipo_heuristica == 'merge':
-                rotas_otimizadas = pos_processamento.merge(rotas_por_veiculo, matriz_np, **kwargs_heuristica)
+                rotas_otimizadas = heuristicas_pos.merge(rotas_por_veiculo, matriz_np, **kwargs_heuristica)
             elif tipo_heuristica == 'split':
                 max_paradas = kwargs_heuristica.get('max_paradas_por_subrota', 5)
                 for rota in rotas_por_veiculo:
-                    rotas_otimizadas.extend(pos_processamento.split(rota, max_paradas))
+                    rotas_otimizadas.extend(heuristicas_pos.split(rota, max_paradas))
             else:
                 logger.warning(f"Tipo de heurística '{tipo_heuristica}' não reconhecido. Nenhum pós-processamento aplicado.")
                 rotas_otimizadas = rotas_por_veiculo
@@ -1,12 +1,196 @@
 import pandas as pd
-from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+from ortools.constraint_solver import pywrapcp
 import numpy as np
 import time
 import logging
-from routing import pos_processamento
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from routing import pos_processamento as heuristicas_pos  # Alias: o parâmetro pos_processamento não pode ser sobrescrito
 from routing.utils import get_logger, validar_dataframe, validar_matriz
+from routing.cvrp import parametros_busca, PRESETS_BUSCA, PRESET_PADRAO, MAX_PROCESSOS
 
-def solver_cvrp_flex(pedidos, frota, matriz_distancias, depot_index=0, ajuste_capacidade_pct=100, cenarios=None, diagnostico=False, metricas=False, pos_processamento=False, tipo_heuristica='2opt', kwargs_heuristica=None):
+# --- Constantes ---
+TEMPO_LIMITE_FLEX = 60  # Teto em segundos por cenário na busca original (sem preset)
+# Busca original do CVRP Flex: a metaheurística automática para no primeiro ótimo local
+PRIMEIRA_SOLUCAO_FLEX = "PATH_CHEAPEST_ARC"
+METAHEURISTICA_FLEX = "AUTOMATIC"
+
+
+def _resolver_cenario(pedidos, frota, matriz_distancias, depot_index, ajuste_capacidade_pct, preset, opcoes):
+    """
+    Resolve um cenário do CVRP Flex. Função de módulo (e não aninhada) para poder ser executada
+    em um processo de trabalho.
+
+    Args:
+        opcoes (dict): 'tempo_limite', 'diagnostico', 'metricas', 'pos_processamento',
+            'tipo_heuristica' e 'kwargs_heuristica' de solver_cvrp_flex.
+
+    Returns:
+        dict: {'pedidos_result', 'diagnostico', 'metricas'}.
+    """
+    logger = get_logger(__name__)
+    tempo_limite, diagnostico, metricas = opcoes['tempo_limite'], opcoes['diagnostico'], opcoes['metricas']
+    pos_processamento, tipo_heuristica = opcoes['pos_processamento'], opcoes['tipo_heuristica']
+    kwargs_heuristica = opcoes['kwargs_heuristica']
+    start_time = time.time()
+    resultado = {
+        'pedidos_result': None,
+        'diagnostico': None,
+        'metricas': None
+    }
+    if pedidos is None or pedidos.empty or frota is None or frota.empty or matriz_distancias is None:
+        resultado['diagnostico'] = 'Dados de entrada ausentes ou vazios.'
+        return resultado
+
+    num_vehicles = len(frota)
+    num_nodes = len(matriz_distancias)
+    if num_nodes < 2 or num_vehicles < 1:
+        resultado['diagnostico'] = 'Frota ou matriz de distâncias insuficiente.'
+        return resultado
+
+    demanda_total = pedidos['Peso dos Itens'].fillna(0).sum()
+    ajuste = max(0, min(ajuste_capacidade_pct, 120)) / 100.0
+    capacidade_total = (frota['Capacidade (Kg)'].fillna(0).astype(float) * ajuste).sum()
+    if capacidade_total < demanda_total:
+        resultado['diagnostico'] = f"Demanda total ({demanda_total}) excede capacidade total da frota ({capacidade_total})."
+        return resultado
+
+    manager = pywrapcp.RoutingIndexManager(num_nodes, num_vehicles, depot_index)
+    routing = pywrapcp.RoutingModel(manager)
+
+    # Custos e demandas registrados direto como matriz/vetor (consultados em C++), como em solver_cvrp
+    transit_callback_index = routing.RegisterTransitMatrix(np.asarray(matriz_distancias).astype(int).tolist())
+    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+
+    demands = [0] + pedidos['Peso dos Itens'].fillna(0).astype(int).tolist()
+    demand_callback_index = routing.RegisterUnaryTransitVector(demands)
+
+    capacities = (frota['Capacidade (Kg)'].fillna(0).astype(float) * ajuste).astype(int).tolist()
+    routing.AddDimensionWithVehicleCapacity(
+        demand_callback_index,
+        0,
+        capacities,
+        True,
+        'Capacity')
+
+    if preset is None:
+        search_parameters = parametros_busca(PRESET_PADRAO, num_nodes, TEMPO_LIMITE_FLEX if tempo_limite is None else tempo_limite,
+                                             primeira_solucao=PRIMEIRA_SOLUCAO_FLEX, metaheuristica=METAHEURISTICA_FLEX)
+    else:
+        search_parameters = parametros_busca(preset, num_nodes, tempo_limite)
+
+    solution = routing.SolveWithParameters(search_parameters)
+
+    pedidos_result = pedidos.copy()
+    pedidos_result['Veículo'] = None
+    pedidos_result['Sequencia'] = None
+    pedidos_result['Node_Index_OR'] = None
+    pedidos_result['distancia'] = None
+    total_dist = 0
+    veiculos_usados = 0
+    pedidos_atendidos = set()
+    rotas_por_veiculo = []  # Para pós-processamento
+
+    if solution:
+        for vehicle_id in range(num_vehicles):
+            index = routing.Start(vehicle_id)
+            seq = 1
+            placa = frota.iloc[vehicle_id]['Placa'] if 'Placa' in frota.columns and vehicle_id < len(frota) else str(vehicle_id)
+            route_dist = 0
+            used = False
+            rota_indices = [depot_index]
+            while not routing.IsEnd(index):
+                node_index = manager.IndexToNode(index)
+                if node_index != depot_index and node_index-1 < len(pedidos):
+                    pedidos_result.at[node_index-1, 'Veículo'] = placa
+                    pedidos_result.at[node_index-1, 'Sequencia'] = seq
+                    pedidos_result.at[node_index-1, 'Node_Index_OR'] = node_index
+                    next_index = solution.Value(routing.NextVar(index))
+                    dist = matriz_distancias[node_index][manager.IndexToNode(next_index)]
+                    pedidos_result.at[node_index-1, 'distancia'] = dist
+                    route_dist += dist
+                    seq += 1
+                    pedidos_atendidos.add(node_index-1)
+                    used = True
+                    rota_indices.append(node_index)
+                index = solution.Value(routing.NextVar(index))
+            if used:
+                veiculos_usados += 1
+                total_dist += route_dist
+                rota_indices.append(depot_index)
+                rotas_por_veiculo.append(rota_indices)
+        pedidos_result['Pedido_Index_DF'] = pedidos_result.index
+        resultado['pedidos_result'] = pedidos_result
+        if metricas:
+            resultado['metricas'] = {
+                'distancia_total': total_dist,
+                'veiculos_usados': veiculos_usados,
+                'pedidos_atendidos': len(pedidos_atendidos),
+                'pedidos_nao_atendidos': len(pedidos) - len(pedidos_atendidos),
+                'tempo_execucao': time.time() - start_time,
+            }
+        # --- Pós-processamento automático ---
+        if pos_processamento and len(rotas_por_veiculo) > 0:
+            logger.info(f"Aplicando pós-processamento '{tipo_heuristica}' nas rotas...")
+            matriz_np = np.array(matriz_distancias)
+            rotas_otimizadas = []
+            if tipo_heuristica == '2opt':
+                for rota in rotas_por_veiculo:
+                    if len(rota) > 3:
+                        rota_opt = heuristicas_pos.heuristica_2opt(rota, matriz_np)
+                        rotas_otimizadas.append(rota_opt)
+                    else:
+                        rotas_otimizadas.append(rota)
+            elif tipo_heuristica == 'merge':
+                rotas_otimizadas = heuristicas_pos.merge(rotas_por_veiculo, matriz_np, **kwargs_heuristica)
+            elif tipo_heuristica == 'split':
+                max_paradas = kwargs_heuristica.get('max_paradas_por_subrota', 5)
+                for rota in rotas_por_veiculo:
+                    rotas_otimizadas.extend(heuristicas_pos.split(rota, max_paradas))
+            else:
+                logger.warning(f"Tipo de heurística '{tipo_heuristica}' não reconhecido. Nenhum pós-processamento aplicado.")
+                rotas_otimizadas = rotas_por_veiculo
+            logger.info(f"Rotas após pós-processamento: {rotas_otimizadas}")
+            # Opcional: atualizar pedidos_result ou retornar as rotas otimizadas separadamente
+    else:
+        resultado['diagnostico'] = 'Não foi encontrada solução viável para o cenário.'
+        if diagnostico:
+            resultado['diagnostico'] += f' Demanda total: {demanda_total}, Capacidade total: {capacidade_total}, Veículos: {num_vehicles}'
+    return resultado
+
+
+def _matriz_em_memoria_compartilhada(matriz):
+    """
+    Copia a matriz uma única vez para um bloco de memória compartilhada.
+
+    Returns:
+        tuple: (SharedMemory, descritor (nome, shape, dtype) a enviar aos processos de trabalho).
+    """
+    matriz = np.ascontiguousarray(matriz)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, matriz.nbytes))
+    np.ndarray(matriz.shape, dtype=matriz.dtype, buffer=shm.buf)[:] = matriz
+    return shm, (shm.name, matriz.shape, matriz.dtype.str)
+
+
+def _resolver_cenario_compartilhado(pedidos, frota, descritor, depot_index, ajuste_capacidade_pct, preset, opcoes):
+    """Executado no processo de trabalho: anexa a matriz compartilhada (sem cópia) e resolve o cenário."""
+    if descritor is None:
+        return _resolver_cenario(pedidos, frota, None, depot_index, ajuste_capacidade_pct, preset, opcoes)
+    nome, shape, dtype = descritor
+    shm = shared_memory.SharedMemory(name=nome)
+    matriz = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    try:
+        return _resolver_cenario(pedidos, frota, matriz, depot_index, ajuste_capacidade_pct, preset, opcoes)
+    finally:
+        matriz = None  # Nenhuma visão do buffer pode sobreviver ao close()
+        try:
+            shm.close()
+        except BufferError:
+            pass  # Visão ainda presa (ex: no traceback de uma exceção); o mapeamento sai com o processo
+
+
+def solver_cvrp_flex(pedidos, frota, matriz_distancias, depot_index=0, ajuste_capacidade_pct=100, cenarios=None, diagnostico=False, metricas=False, pos_processamento=False, tipo_heuristica='2opt', kwargs_heuristica=None,
+                     preset=None, tempo_limite=None, max_processos=MAX_PROCESSOS, ao_concluir=None):
     """
     Resolve o problema CVRP permitindo ajuste percentual da capacidade dos veículos.
     Suporta simulação de cenários, diagnóstico de inviabilidade e retorno de métricas detalhadas.
@@ -26,6 +210,15 @@ def solver_cvrp_flex(pedidos, frota, matriz_distancias, depot_index=0, ajuste_ca
         pos_processamento (bool): Se True, aplica heurística de pós-processamento nas rotas geradas.
         tipo_heuristica (str): Tipo de heurística de pós-processamento ('2opt', 'merge', 'split').
         kwargs_heuristica (dict): Parâmetros adicionais para a heurística de pós-processamento.
+        preset (str, optional): Esforço de busca ("rascunho", "padrão", "intensivo"; ver routing.cvrp.PRESETS_BUSCA),
+            com o tempo escalado pelo tamanho do problema. Se None, usa a busca original do CVRP Flex
+            (PATH_CHEAPEST_ARC até o primeiro ótimo local), com TEMPO_LIMITE_FLEX (60 s) apenas como teto.
+            Cada cenário pode trocar o preset com a chave 'preset'.
+        tempo_limite (float, optional): Sobrescreve o tempo limite (segundos) de todos os cenários.
+        max_processos (int): Cenários resolvidos ao mesmo tempo, um por processo; a matriz de cada
+            cenário vai uma única vez para memória compartilhada (não é copiada para cada processo).
+        ao_concluir (function, optional): Chamada com (nome do cenário, resultado) assim que cada
+            cenário termina, na ordem de conclusão.
     
     Returns:
         dict: Resultados por cenário, incluindo solução, diagnóstico e métricas.
@@ -45,142 +238,62 @@ def solver_cvrp_flex(pedidos, frota, matriz_distancias, depot_index=0, ajuste_ca
     if not ok_mat:
         logger.error(f"CVRP Flex: {msg_mat}")
         return {'diagnostico': msg_mat}
+    if preset is not None and preset not in PRESETS_BUSCA:
+        logger.error(f"CVRP Flex: preset de busca desconhecido '{preset}'.")
+        return {'diagnostico': f"Preset de busca desconhecido: '{preset}'. Use um de {list(PRESETS_BUSCA)}."}
+    opcoes = {
+        'tempo_limite': tempo_limite, 'diagnostico': diagnostico, 'metricas': metricas,
+        'pos_processamento': pos_processamento, 'tipo_heuristica': tipo_heuristica, 'kwargs_heuristica': kwargs_heuristica,
+    }
+    tarefas = []
+    for i, cenario in enumerate(cenarios or [{}]):
+        tarefas.append((f'Cenário_{i+1}', {
+            'pedidos': cenario.get('pedidos', pedidos),
+            'frota': cenario.get('frota', frota),
+            'matriz_distancias': cenario.get('matriz_distancias', matriz_distancias),
+            'depot_index': cenario.get('depot_index', depot_index),
+            'ajuste_capacidade_pct': cenario.get('ajuste_capacidade_pct', ajuste_capacidade_pct),
+            'preset': cenario.get('preset', preset)
+        }))
 
-    def run_solver(pedidos, frota, matriz_distancias, depot_index, ajuste_capacidade_pct):
-        start_time = time.time()
-        resultado = {
-            'pedidos_result': None,
-            'diagnostico': None,
-            'metricas': None
-        }
-        if pedidos is None or pedidos.empty or frota is None or frota.empty or matriz_distancias is None:
-            resultado['diagnostico'] = 'Dados de entrada ausentes ou vazios.'
-            return resultado
-
-        num_vehicles = len(frota)
-        num_nodes = len(matriz_distancias)
-        if num_nodes < 2 or num_vehicles < 1:
-            resultado['diagnostico'] = 'Frota ou matriz de distâncias insuficiente.'
-            return resultado
-
-        demanda_total = pedidos['Peso dos Itens'].fillna(0).sum()
-        ajuste = max(0, min(ajuste_capacidade_pct, 120)) / 100.0
-        capacidade_total = (frota['Capacidade (Kg)'].fillna(0).astype(float) * ajuste).sum()
-        if capacidade_total < demanda_total:
-            resultado['diagnostico'] = f"Demanda total ({demanda_total}) excede capacidade total da frota ({capacidade_total})."
-            return resultado
-
-        manager = pywrapcp.RoutingIndexManager(num_nodes, num_vehicles, depot_index)
-        routing = pywrapcp.RoutingModel(manager)
-
-        def distance_callback(from_index, to_index):
-            from_node = manager.IndexToNode(from_index)
-            to_node = manager.IndexToNode(to_index)
-            return int(matriz_distancias[from_node][to_node])
-
-        transit_callback_index = routing.RegisterTransitCallback(distance_callback)
-        routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
-
-        demands = [0] + pedidos['Peso dos Itens'].fillna(0).astype(int).tolist()
-        def demand_callback(from_index):
-            from_node = manager.IndexToNode(from_index)
-            return demands[from_node]
-        demand_callback_index = routing.RegisterUnaryTransitCallback(demand_callback)
-
-        capacities = (frota['Capacidade (Kg)'].fillna(0).astype(float) * ajuste).astype(int).tolist()
-        routing.AddDimensionWithVehicleCapacity(
-            demand_callback_index,
-            0,
-            capacities,
-            True,
-            'Capacity')
-
-        search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-        search_parameters.first_solution_strategy = (
-            routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
-        search_parameters.time_limit.seconds = 60
-
-        solution = routing.SolveWithParameters(search_parameters)
-
-        pedidos_result = pedidos.copy()
-        pedidos_result['Veículo'] = None
-        pedidos_result['Sequencia'] = None
-        pedidos_result['Node_Index_OR'] = None
-        pedidos_result['distancia'] = None
-        total_dist = 0
-        veiculos_usados = 0
-        pedidos_atendidos = set()
-        rotas_por_veiculo = []  # Para pós-processamento
-
-        if solution:
-            for vehicle_id in range(num_vehicles):
-                index = routing.Start(vehicle_id)
-                seq = 1
-                placa = frota.iloc[vehicle_id]['Placa'] if 'Placa' in frota.columns and vehicle_id < len(frota) else str(vehicle_id)
-                route_dist = 0
-                used = False
-                rota_indices = [depot_index]
-                while not routing.IsEnd(index):
-                    node_index = manager.IndexToNode(index)
-                    if node_index != depot_index and node_index-1 < len(pedidos):
-                        pedidos_result.at[node_index-1, 'Veículo'] = placa
-                        pedidos_result.at[node_index-1, 'Sequencia'] = seq
-                        pedidos_result.at[node_index-1, 'Node_Index_OR'] = node_index
-                        next_index = solution.Value(routing.NextVar(index))
-                        dist = matriz_distancias[node_index][manager.IndexToNode(next_index)]
-                        pedidos_result.at[node_index-1, 'distancia'] = dist
-                        route_dist += dist
-                        seq += 1
-                        pedidos_atendidos.add(node_index-1)
-                        used = True
-                        rota_indices.append(node_index)
-                    index = solution.Value(routing.NextVar(index))
-                if used:
-                    veiculos_usados += 1
-                    total_dist += route_dist
-                    rota_indices.append(depot_index)
-                    rotas_por_veiculo.append(rota_indices)
-            pedidos_result['Pedido_Index_DF'] = pedidos_result.index
-            # --- Pós-processamento automático ---
-            if pos_processamento and len(rotas_por_veiculo) > 0:
-                logger.info(f"Aplicando pós-processamento '{tipo_heuristica}' nas rotas...")
-                matriz_np = np.array(matriz_distancias)
-                rotas_otimizadas = []
-                if tipo_heuristica == '2opt':
-                    for rota in rotas_por_veiculo:
-                        if len(rota) > 3:
-                            rota_opt = pos_processamento.heuristica_2opt(rota, matriz_np)
-                            rotas_otimizadas.append(rota_opt)
-                        else:
-                            rotas_otimizadas.append(rota)
-                elif tipo_heuristica == 'merge':
-                    rotas_otimizadas = pos_processamento.merge(rotas_por_veiculo, matriz_np, **kwargs_heuristica)
-                elif tipo_heuristica == 'split':
-                    max_paradas = kwargs_heuristica.get('max_paradas_por_subrota', 5)
-                    for rota in rotas_por_veiculo:
-                        rotas_otimizadas.extend(pos_processamento.split(rota, max_paradas))
-                else:
-                    logger.warning(f"Tipo de heurística '{tipo_heuristica}' não reconhecido. Nenhum pós-processamento aplicado.")
-                    rotas_otimizadas = rotas_por_veiculo
-                logger.info(f"Rotas após pós-processamento: {rotas_otimizadas}")
-                # Opcional: atualizar pedidos_result ou retornar as rotas otimizadas separadamente
-        else:
-            resultado['diagnostico'] = 'Não foi encontrada solução viável para o cenário.'
-            if diagnostico:
-                resultado['diagnostico'] += f' Demanda total: {demanda_total}, Capacidade total: {capacidade_total}, Veículos: {num_vehicles}'
-        return resultado
+    def concluido(nome, resultado):
+        resultados[nome] = resultado
+        logger.info(f"CVRP Flex: {nome} concluído ({len(resultados)}/{len(tarefas)}).")
+        if ao_concluir is not None:
+            try:
+                ao_concluir(nome, resultado)
+            except Exception as e:
+                logger.error(f"Erro no callback ao_concluir (ignorado): {e}")
 
     resultados = {}
-    if cenarios:
-        for i, cenario in enumerate(cenarios):
-            params = {
-                'pedidos': cenario.get('pedidos', pedidos),
-                'frota': cenario.get('frota', frota),
-                'matriz_distancias': cenario.get('matriz_distancias', matriz_distancias),
-                'depot_index': cenario.get('depot_index', depot_index),
-                'ajuste_capacidade_pct': cenario.get('ajuste_capacidade_pct', ajuste_capacidade_pct)
-            }
-            resultados[f'Cenário_{i+1}'] = run_solver(**params)
-    else:
-        resultados['Cenário_1'] = run_solver(pedidos, frota, matriz_distancias, depot_index, ajuste_capacidade_pct)
-    return resultados
+    n_processos = min(max_processos, len(tarefas))
+    if n_processos <= 1:
+        for nome, params in tarefas:
+            concluido(nome, _resolver_cenario(opcoes=opcoes, **params))
+        return resultados
+
+    blocos = {}  # id(matriz) -> (SharedMemory, descritor): cenários com a mesma matriz compartilham o bloco
+    try:
+        with ProcessPoolExecutor(max_workers=n_processos) as executor:
+            futuros = {}
+            for nome, params in tarefas:
+                params = dict(params)
+                matriz = params.pop('matriz_distancias')
+                descritor = None
+                if matriz is not None:
+                    if id(matriz) not in blocos:
+                        blocos[id(matriz)] = _matriz_em_memoria_compartilhada(matriz)
+                    descritor = blocos[id(matriz)][1]
+                futuros[executor.submit(_resolver_cenario_compartilhado, descritor=descritor, opcoes=opcoes, **params)] = nome
+            for futuro in as_completed(futuros):
+                try:
+                    resultado = futuro.result()
+                except Exception as e:
+                    logger.error(f"CVRP Flex: erro no {futuros[futuro]}: {e}")
+                    resultado = {'pedidos_result': None, 'diagnostico': f'Erro ao resolver o cenário: {e}', 'metricas': None}
+                concluido(futuros[futuro], resultado)
+    finally:
+        for shm, _ in blocos.values():
+            shm.close()
+            shm.unlink()
+    return {nome: resultados[nome] for nome, _ in tarefas}
@@ -0,0 +1,282 @@
+"""
+Decomposição cluster-first, route-second para CVRPs grandes.
+
+Um único modelo do OR-Tools degrada muito acima de algumas centenas de nós. Aqui os pedidos
+são agrupados (KMeans de routing.utils ou coluna 'Região'), cada grupo recebe veículos
+suficientes para a sua demanda e cada sub-CVRP é resolvido por solver_cvrp em um processo
+próprio, sobre a sub-matriz correspondente. As rotas são costuradas no mesmo DataFrame de
+solver_cvrp e, opcionalmente, um reparo de fronteira move pedidos entre rotas de clusters vizinhos.
+"""
+import math
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from routing.cvrp import solver_cvrp, PRESET_PADRAO, MAX_PROCESSOS
+from routing.utils import get_logger, validar_dataframe, validar_matriz, clusterizar_pedidos_por_regiao_ou_kmeans
+
+# --- Constantes ---
+PEDIDOS_POR_CLUSTER = 200  # Tamanho-alvo de cada sub-problema
+LIMIAR_DECOMPOSICAO = 400  # Acima deste número de pedidos a interface sugere a decomposição
+FOLGA_CAPACIDADE = 1.1  # Capacidade mínima de cada cluster em relação à sua demanda
+K_VIZINHOS_FRONTEIRA = 10  # Pedido é de fronteira se algum dos seus k vizinhos mais próximos está em outro cluster
+
+
+def _demandas(pedidos):
+    """Demanda de cada pedido, com a mesma regra de solver_cvrp."""
+    for coluna in ('Peso dos Itens', 'Qtde. dos Itens'):
+        if coluna in pedidos.columns:
+            return pd.to_numeric(pedidos[coluna], errors='coerce').fillna(1).astype(int).to_numpy()
+    return np.ones(len(pedidos), dtype=int)
+
+
+def _capacidades(frota, ajuste_capacidade_pct=100):
+    """Capacidade de cada veículo, com a mesma regra de solver_cvrp."""
+    ajuste = max(0, min(ajuste_capacidade_pct, 120)) / 100.0
+    for coluna in ('Capacidade (Kg)', 'Capacidade (Cx)'):
+        if coluna in frota.columns:
+            capacidades = pd.to_numeric(frota[coluna], errors='coerce').fillna(1) * ajuste
+            return capacidades.astype(int).clip(lower=1).to_numpy()
+    return np.full(len(frota), int(1000 * ajuste), dtype=int)
+
+
+def particionar(pedidos, frota, matriz_distancias, n_clusters=None, por_regiao=False, ajuste_capacidade_pct=100):
+    """
+    Divide pedidos e veículos em sub-problemas.
+
+    Os pedidos são agrupados pela coluna 'Região' (por_regiao=True) ou por KMeans nas coordenadas.
+    Os veículos são distribuídos pela demanda: cada cluster, do mais pesado ao mais leve, recebe os
+    maiores veículos livres até cobrir FOLGA_CAPACIDADE x sua demanda; os que sobram vão para o
+    cluster mais apertado. Cluster que fica sem veículo é unido ao cluster mais próximo (pela matriz).
+
+    Args:
+        pedidos (pd.DataFrame): Pedidos (índice 0..n-1; nó i+1 na matriz).
+        frota (pd.DataFrame): Frota.
+        matriz_distancias (np.ndarray): Matriz com o depósito no índice 0.
+        n_clusters (int, optional): Número de clusters; padrão ceil(n / PEDIDOS_POR_CLUSTER).
+        por_regiao (bool): Se True e houver coluna 'Região', usa as regiões como clusters.
+        ajuste_capacidade_pct (int): Percentual de ajuste da capacidade dos veículos.
+
+    Returns:
+        list: Tuplas (índices de pedidos, índices de veículos), uma por sub-problema.
+    """
+    logger = get_logger(__name__)
+    n_pedidos = len(pedidos)
+    if por_regiao and 'Região' in pedidos.columns:
+        labels = pd.factorize(pedidos['Região'].fillna('Sem região'))[0]
+    else:
+        if n_clusters is None:
+            n_clusters = math.ceil(n_pedidos / PEDIDOS_POR_CLUSTER)
+        n_clusters = max(1, min(n_clusters, len(frota), n_pedidos))
+        labels = clusterizar_pedidos_por_regiao_ou_kmeans(pedidos, n_clusters) if n_clusters > 1 else np.zeros(n_pedidos, dtype=int)
+    labels = np.asarray(labels)
+    # Pedidos sem coordenada (-1) ficam no maior cluster
+    if (labels < 0).any():
+        maior = np.bincount(labels[labels >= 0]).argmax() if (labels >= 0).any() else 0
+        labels = np.where(labels < 0, maior, labels)
+
+    demandas = _demandas(pedidos)
+    capacidades = _capacidades(frota, ajuste_capacidade_pct)
+    matriz = np.asarray(matriz_distancias, dtype=float)
+    clusters = {c: np.flatnonzero(labels == c) for c in np.unique(labels)}
+
+    while True:
+        demanda_cluster = {c: int(demandas[idx].sum()) for c, idx in clusters.items()}
+        livres = list(np.argsort(-capacidades, kind='stable'))
+        veiculos = {c: [] for c in clusters}
+        for c in sorted(clusters, key=lambda c: -demanda_cluster[c]):
+            while livres and capacidades[veiculos[c]].sum() < FOLGA_CAPACIDADE * demanda_cluster[c]:
+                veiculos[c].append(livres.pop(0))
+        for v in livres:
+            mais_apertado = max(clusters, key=lambda c: demanda_cluster[c] / max(1, capacidades[veiculos[c]].sum()))
+            veiculos[mais_apertado].append(v)
+        sem_veiculo = [c for c in clusters if not veiculos[c]]
+        if not sem_veiculo or len(clusters) == 1:
+            break
+        # Une o cluster sem veículo ao cluster mais próximo (menor distância média entre os pedidos)
+        c = sem_veiculo[0]
+        nos_c = clusters.pop(c) + 1
+        destino = min(clusters, key=lambda o: matriz[np.ix_(nos_c, clusters[o] + 1)].mean())
+        logger.info(f"Decomposição: cluster {c} sem veículo suficiente, unido ao cluster {destino}.")
+        clusters[destino] = np.sort(np.concatenate([clusters[destino], nos_c - 1]))
+
+    return [(clusters[c], np.sort(np.asarray(veiculos[c], dtype=int))) for c in clusters]
+
+
+def _resolver_subproblema(pedidos, frota, sub_matriz, kwargs):
+    """Executado em um processo de trabalho: resolve um sub-CVRP com solver_cvrp."""
+    return solver_cvrp(pedidos, frota, sub_matriz, **kwargs)
+
+
+def reparar_fronteiras(rotas, cluster_do_veiculo, matriz, demandas, capacidades, max_iter=3):
+    """
+    Reparo de fronteira: move pedidos de fronteira para a rota de outro cluster quando a inserção
+    mais barata nela custa menos do que a economia de retirá-los da rota atual e a carga permite.
+
+    Args:
+        rotas (dict): {veículo: [nós em ordem, sem o depósito]}; alterado no lugar.
+        cluster_do_veiculo (dict): {veículo: cluster}.
+        matriz (np.ndarray): Matriz de distâncias completa (depósito no índice 0).
+        demandas (np.ndarray): Demanda por nó (0 no depósito).
+        capacidades (dict): {veículo: capacidade}.
+        max_iter (int): Número máximo de passadas.
+
+    Returns:
+        int: Número de pedidos movidos.
+    """
+    rota_do_no = {no: v for v, nos in rotas.items() for no in nos}
+    if not rota_do_no:
+        return 0
+    nos = np.fromiter(rota_do_no, dtype=int)
+    # Vizinhos mais próximos de cada pedido (sem o depósito e sem ele mesmo)
+    k = min(K_VIZINHOS_FRONTEIRA, len(nos) - 1)
+    if k < 1:
+        return 0
+    sub = matriz[np.ix_(nos, nos)].astype(float)
+    np.fill_diagonal(sub, np.inf)
+    vizinhos = {int(no): nos[np.argpartition(sub[i], k - 1)[:k]] for i, no in enumerate(nos)}
+    carga = {v: int(demandas[nos_v].sum()) for v, nos_v in rotas.items()}
+
+    movidos = 0
+    for _ in range(max_iter):
+        melhorou = False
+        for no, viz in vizinhos.items():
+            v_atual = rota_do_no[no]
+            candidatos = {rota_do_no[int(w)] for w in viz if cluster_do_veiculo[rota_do_no[int(w)]] != cluster_do_veiculo[v_atual]}
+            if not candidatos:
+                continue
+            seq = [0] + rotas[v_atual] + [0]
+            pos = seq.index(no)
+            economia = matriz[seq[pos - 1], no] + matriz[no, seq[pos + 1]] - matriz[seq[pos - 1], seq[pos + 1]]
+            melhor = None
+            for v in candidatos:
+                if carga[v] + demandas[no] > capacidades[v]:
+                    continue
+                seq_v = np.asarray([0] + rotas[v] + [0])
+                custos = matriz[seq_v[:-1], no] + matriz[no, seq_v[1:]] - matriz[seq_v[:-1], seq_v[1:]]
+                i = int(np.argmin(custos))
+                if custos[i] < economia and (melhor is None or custos[i] < melhor[0]):
+                    melhor = (custos[i], v, i)
+            if melhor is None:
+                continue
+            _, v, i = melhor
+            rotas[v_atual].remove(no)
+            rotas[v].insert(i, no)
+            carga[v_atual] -= demandas[no]
+            carga[v] += demandas[no]
+            rota_do_no[no] = v
+            movidos += 1
+            melhorou = True
+        if not melhorou:
+            break
+    return movidos
+
+
+def solver_cvrp_decomposto(pedidos, frota, matriz_distancias, n_clusters=None, por_regiao=False, reparo_fronteira=True,
+                           max_processos=MAX_PROCESSOS, ajuste_capacidade_pct=100, preset=PRESET_PADRAO, tempo_limite=None,
+                           pos_processamento=False, tipo_heuristica='2opt', kwargs_heuristica=None):
+    """
+    CVRP por decomposição: agrupa pedidos e veículos (particionar), resolve cada sub-CVRP com
+    solver_cvrp em paralelo (um processo por cluster) e costura as rotas. O tempo total passa a
+    crescer com o tamanho dos clusters e o número de núcleos, não com o total de pedidos.
+
+    Args:
+        pedidos (pd.DataFrame): Pedidos, na mesma ordem dos nós 1..n da matriz.
+        frota (pd.DataFrame): Frota.
+        matriz_distancias (np.ndarray): Matriz de distâncias com o depósito no índice 0.
+        n_clusters (int, optional): Número de clusters; padrão ceil(n / PEDIDOS_POR_CLUSTER).
+        por_regiao (bool): Se True, usa a coluna 'Região' como clusters.
+        reparo_fronteira (bool): Se True, aplica reparar_fronteiras entre clusters vizinhos.
+        max_processos (int): Processos simultâneos; 1 resolve em sequência no próprio processo.
+        ajuste_capacidade_pct, preset, tempo_limite, pos_processamento, tipo_heuristica, kwargs_heuristica:
+            Repassados a solver_cvrp em cada sub-problema.
+
+    Returns:
+        pd.DataFrame: Mesmo formato de solver_cvrp, com a coluna adicional 'Cluster'.
+    """
+    logger = get_logger(__name__)
+    ok_ped, msg_ped = validar_dataframe(pedidos, None, 'Pedidos')
+    ok_frota, msg_frota = validar_dataframe(frota, None, 'Frota')
+    ok_mat, msg_mat = validar_matriz(matriz_distancias, len(pedidos) + 1 if ok_ped else None)
+    for ok, msg in ((ok_ped, msg_ped), (ok_frota, msg_frota), (ok_mat, msg_mat)):
+        if not ok:
+            logger.error(f"CVRP Decomposto: {msg}")
+            return pd.DataFrame()
+
+    pedidos = pedidos.copy().reset_index(drop=True)
+    frota = frota.copy().reset_index(drop=True)
+    if 'ID Veículo' not in frota.columns and 'Placa' not in frota.columns:
+        # Identificadores globais: nos sub-problemas o padrão de solver_cvrp (veiculo_N) se repetiria entre clusters
+        frota['ID Veículo'] = [f'veiculo_{i+1}' for i in range(len(frota))]
+    matriz = np.asarray(matriz_distancias)
+    kwargs_solver = {
+        'ajuste_capacidade_pct': ajuste_capacidade_pct, 'preset': preset, 'tempo_limite': tempo_limite,
+        'pos_processamento': pos_processamento, 'tipo_heuristica': tipo_heuristica, 'kwargs_heuristica': kwargs_heuristica,
+    }
+
+    partes = particionar(pedidos, frota, matriz, n_clusters, por_regiao, ajuste_capacidade_pct)
+    if len(partes) == 1:
+        logger.info("CVRP Decomposto: um único cluster; resolvendo o problema inteiro.")
+        return solver_cvrp(pedidos, frota, matriz, **kwargs_solver)
+
+    subproblemas = []
+    for idx_pedidos, idx_veiculos in partes:
+        nos = np.concatenate([[0], idx_pedidos + 1])
+        subproblemas.append((pedidos.iloc[idx_pedidos].reset_index(drop=True), frota.iloc[idx_veiculos].reset_index(drop=True),
+                             matriz[np.ix_(nos, nos)], kwargs_solver))
+    logger.info(f"CVRP Decomposto: {len(pedidos)} pedidos em {len(partes)} clusters "
+                f"({', '.join(str(len(p)) for p, _ in partes)} pedidos), até {max_processos} processos.")
+
+    if max_processos > 1:
+        with ProcessPoolExecutor(max_workers=min(max_processos, len(subproblemas))) as executor:
+            futuros = [executor.submit(_resolver_subproblema, *args) for args in subproblemas]
+            resultados = []
+            for c, futuro in enumerate(futuros):
+                try:
+                    resultados.append(futuro.result())
+                except Exception as e:
+                    logger.error(f"CVRP Decomposto: falha no cluster {c}: {e}")
+                    resultados.append(pd.DataFrame())
+    else:
+        resultados = [_resolver_subproblema(*args) for args in subproblemas]
+
+    # --- Costura: índices locais -> globais ---
+    quadros = []
+    for c, ((idx_pedidos, _), rotas_c) in enumerate(zip(partes, resultados)):
+        if rotas_c is None or rotas_c.empty:
+            logger.warning(f"CVRP Decomposto: cluster {c} sem solução ({len(idx_pedidos)} pedidos não roteirizados).")
+            continue
+        rotas_c = rotas_c.copy()
+        rotas_c['Pedido_Index_DF'] = idx_pedidos[rotas_c['Pedido_Index_DF'].to_numpy(dtype=int)]
+        rotas_c['Node_Index_OR'] = rotas_c['Pedido_Index_DF'] + 1
+        rotas_c['Cluster'] = c
+        quadros.append(rotas_c)
+    if not quadros:
+        logger.warning("CVRP Decomposto: nenhum cluster encontrou solução.")
+        return pd.DataFrame()
+    rotas_df = pd.concat(quadros, ignore_index=True)
+
+    if reparo_fronteira:
+        rotas = {v: grupo.sort_values('Sequencia')['Node_Index_OR'].tolist() for v, grupo in rotas_df.groupby('Veículo', sort=False)}
+        cluster_do_veiculo = rotas_df.groupby('Veículo', sort=False)['Cluster'].first().to_dict()
+        demandas = np.concatenate([[0], _demandas(pedidos)])
+        coluna_id = 'ID Veículo' if 'ID Veículo' in frota.columns else 'Placa'
+        capacidades = dict(zip(frota[coluna_id], _capacidades(frota, ajuste_capacidade_pct).tolist()))
+        movidos = reparar_fronteiras(rotas, cluster_do_veiculo, matriz, demandas, capacidades)
+        if movidos:
+            logger.info(f"CVRP Decomposto: reparo de fronteira moveu {movidos} pedidos entre clusters.")
+            linhas = rotas_df.set_index('Node_Index_OR', drop=False)
+            novas = []
+            for veiculo, nos_v in rotas.items():
+                carga = 0
+                for seq, no in enumerate(nos_v, start=1):
+                    linha = linhas.loc[no].copy()
+                    # Como em solver_cvrp: carga acumulada ao chegar no pedido, antes da sua demanda
+                    linha['Veículo'], linha['Sequencia'], linha['Carga_Acumulada'] = veiculo, seq, carga
+                    linha['Cluster'] = cluster_do_veiculo[veiculo]  # O pedido movido passa ao cluster da nova rota
+                    carga += demandas[no]
+                    novas.append(linha)
+            rotas_df = pd.DataFrame(novas).reset_index(drop=True)
+
+    logger.info(f"CVRP Decomposto: {len(rotas_df)} de {len(pedidos)} pedidos roteirizados.")
+    return rotas_df
@@ -0,0 +1,141 @@
+"""
+Disjuntor (circuit breaker) e backoff exponencial com jitter para chamadas ao OSRM.
+
+Quando o servidor está fora do ar, cada bloco da matriz faria MAX_RETRIES tentativas com
+timeout longo. O disjuntor é compartilhado por todos os blocos de um servidor: depois de
+algumas falhas consecutivas ele abre e as chamadas seguintes falham na hora, até que um
+intervalo passe e uma única requisição de teste (meio-aberto) verifique se o servidor voltou.
+"""
+import os
+import time
+import random
+import logging
+import threading
+
+# --- Constantes ---
+LIMITE_FALHAS = int(os.environ.get("OSRM_DISJUNTOR_FALHAS", 5))  # Falhas consecutivas para abrir
+TEMPO_REABERTURA = float(os.environ.get("OSRM_DISJUNTOR_REABERTURA", 30))  # Segundos aberto antes do teste
+BACKOFF_BASE = 0.5  # Segundos da primeira espera entre tentativas
+BACKOFF_MAXIMO = 5  # Teto padrão da espera entre tentativas
+
+FECHADO = "fechado"
+ABERTO = "aberto"
+MEIO_ABERTO = "meio_aberto"
+
+
+def tempo_backoff(tentativa, base=BACKOFF_BASE, maximo=BACKOFF_MAXIMO):
+    """
+    Espera antes da próxima tentativa: backoff exponencial com jitter completo
+    (uniforme entre 0 e min(maximo, base * 2^(tentativa-1))), para que blocos que falharam
+    juntos não voltem a bater no servidor no mesmo instante.
+    """
+    return random.uniform(0, min(maximo, base * 2 ** (tentativa - 1)))
+
+
+class DisjuntorAbertoError(RuntimeError):
+    """Levantada quando o cálculo é abortado porque o disjuntor do servidor está aberto."""
+
+
+class Disjuntor:
+    """
+    Disjuntor thread-safe com os estados fechado -> aberto -> meio_aberto -> fechado.
+
+    - fechado: chamadas liberadas; `limite_falhas` falhas consecutivas abrem o disjuntor.
+    - aberto: chamadas recusadas até passar `tempo_reabertura` segundos.
+    - meio_aberto: libera uma única chamada de teste; sucesso fecha, falha reabre e qualquer
+      outro desfecho (liberar_teste) devolve a vaga para um novo teste.
+    """
+
+    def __init__(self, nome="osrm", limite_falhas=LIMITE_FALHAS, tempo_reabertura=TEMPO_REABERTURA):
+        self.nome = nome
+        self.limite_falhas = limite_falhas
+        self.tempo_reabertura = tempo_reabertura
+        self._lock = threading.Lock()
+        self._estado = FECHADO
+        self._falhas = 0
+        self._aberto_em = 0.0
+        self._teste_em_andamento = False
+
+    @property
+    def estado(self):
+        with self._lock:
+            return self._estado_atual()
+
+    @property
+    def aberto(self):
+        return self.estado == ABERTO
+
+    def _estado_atual(self):
+        if self._estado == ABERTO and time.monotonic() - self._aberto_em >= self.tempo_reabertura:
+            self._estado = MEIO_ABERTO
+            self._teste_em_andamento = False
+        return self._estado
+
+    def permitir(self):
+        """Retorna True se uma chamada pode ser feita agora."""
+        with self._lock:
+            estado = self._estado_atual()
+            if estado == FECHADO:
+                return True
+            if estado == MEIO_ABERTO and not self._teste_em_andamento:
+                self._teste_em_andamento = True
+                logging.info(f"Disjuntor '{self.nome}' meio-aberto: enviando requisição de teste.")
+                return True
+            return False
+
+    def registrar_sucesso(self):
+        with self._lock:
+            if self._estado != FECHADO:
+                logging.info(f"Disjuntor '{self.nome}' fechado: servidor respondeu novamente.")
+            self._estado = FECHADO
+            self._falhas = 0
+            self._teste_em_andamento = False
+
+    def registrar_falha(self):
+        with self._lock:
+            self._falhas += 1
+            if self._estado == MEIO_ABERTO or (self._estado == FECHADO and self._falhas >= self.limite_falhas):
+                self._estado = ABERTO
+                self._aberto_em = time.monotonic()
+                self._teste_em_andamento = False
+                logging.error(f"Disjuntor '{self.nome}' aberto após {self._falhas} falhas consecutivas; "
+                              f"novas chamadas serão recusadas por {self.tempo_reabertura}s.")
+
+    def liberar_teste(self):
+        """
+        Libera a vaga da requisição de teste do meio-aberto sem mudar o estado. Chamada ao fim de
+        toda requisição (ver BalanceadorOSRM.liberar): se o teste terminou sem registrar sucesso
+        nem falha (ex: exceção antes do envio, resposta inválida, cancelamento), outro pode ser feito.
+        """
+        with self._lock:
+            if self._estado == MEIO_ABERTO:
+                self._teste_em_andamento = False
+
+    def abrir(self):
+        """Abre o disjuntor imediatamente (ex: servidor reprovado na verificação de saúde)."""
+        with self._lock:
+            if self._estado != ABERTO:
+                logging.error(f"Disjuntor '{self.nome}' aberto pela verificação de saúde; "
+                              f"novas chamadas serão recusadas por {self.tempo_reabertura}s.")
+            self._estado = ABERTO
+            self._aberto_em = time.monotonic()
+            self._teste_em_andamento = False
+
+    def resetar(self):
+        """Volta ao estado fechado e zera o contador de falhas."""
+        with self._lock:
+            self._estado = FECHADO
+            self._falhas = 0
+            self._teste_em_andamento = False
+
+
+_disjuntores = {}
+_disjuntores_lock = threading.Lock()
+
+
+def obter_disjuntor(servidor):
+    """Retorna o disjuntor compartilhado de um servidor (URL base), criado sob demanda."""
+    with _disjuntores_lock:
+        if servidor not in _disjuntores:
+            _disjuntores[servidor] = Disjuntor(nome=servidor)
+        return _disjuntores[servidor]
@@ -8,44 +8,137 @@ import logging
 import json
 import traceback # Adicionado para log de erro completo
 import os # Adicionado para ler variáveis de ambiente
-from concurrent.futures import ThreadPoolExecutor
-from functools import lru_cache
+import threading
+import weakref
+from urllib.parse import urlsplit, quote, unquote
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from routing.cache_distancias import obter_cache_padrao, PERFIL_PADRAO, PRECISAO_CACHE
+from routing import sessao_http
+from routing.disjuntor import obter_disjuntor, tempo_backoff, DisjuntorAbertoError
+from routing.balanceador_osrm import obter_balanceador, ler_servidores
+from routing import balanceador_osrm
 
 # --- Constantes ---
-# Use a variável de ambiente OSRM_BASE_URL se definida, senão usa o OSRM local
-OSRM_SERVER_URL = os.environ.get("OSRM_BASE_URL", "http://localhost:5000")
+# Use a variável de ambiente OSRM_BASE_URL se definida, senão usa o OSRM local.
+# Aceita vários servidores separados por vírgula; as requisições são balanceadas entre eles
+# (routing.balanceador_osrm). OSRM_SERVER_URL é o primeiro, usado para montar as URLs.
+OSRM_SERVIDORES = ler_servidores(os.environ.get("OSRM_BASE_URL", "http://localhost:5000"))
+OSRM_SERVER_URL = OSRM_SERVIDORES[0]
 MAX_RETRIES = 3
 # --- AJUSTE AQUI ---
-RETRY_DELAY = 5  # Segundos entre retentativas (era 15)
+RETRY_DELAY = 5  # Teto (s) da espera entre retentativas: backoff exponencial com jitter (routing.disjuntor)
 DEFAULT_TIMEOUT = 60  # Timeout para cada requisição OSRM em segundos (era 180)
 # -------------------
 INFINITE_VALUE = 9999999 # Valor para representar "infinito" ou falha
+DTYPE_MATRIZ_PADRAO = np.int32  # int32 comporta INFINITE_VALUE e metade da memória de int64
 MAX_WORKERS = 12  # Número de threads para requisições paralelas (aumentado para mais performance)
+# Limite de coordenadas por requisição Table aceito pelo servidor (osrm-routed --max-table-size, padrão 100).
+# Com coordenadas em polyline6 a URL deixa de ser o gargalo: use o mesmo valor configurado no servidor
+# (ex: --max-table-size 1000 e OSRM_MAX_TABLE_SIZE=1000) para menos requisições, e maiores.
+MAX_TABLE_SIZE = int(os.environ.get("OSRM_MAX_TABLE_SIZE", 100))
+# Formato de {coordinates} nas URLs: "polyline6" (padrão, ~0,1 m), "polyline" (~1 m) ou "texto" (lon,lat;...)
+FORMATO_COORDENADAS = os.environ.get("OSRM_FORMATO_COORDENADAS", "polyline6")
+FORMATOS_COORDENADAS = ("polyline6", "polyline", "texto")
+# Com o disjuntor aberto: "estimativa" preenche os blocos restantes por haversine; "falhar" aborta o cálculo
+MODO_FALHA_OSRM = os.environ.get("OSRM_MODO_FALHA", "estimativa")
+METRICAS_VALIDAS = ("duration", "distance")
+PROVEDORES_VALIDOS = ("osrm", "haversine")
+# --- Estimativa por grande círculo (provider="haversine") ---
+RAIO_TERRA_M = 6371008.8
+VELOCIDADE_MEDIA_KMH = 40  # Mesma velocidade média usada em simulador/mapas para estimar tempo
+FATOR_DESVIO_PADRAO = 1.3  # Razão típica distância por ruas / distância em linha reta
+FATORES_HAVERSINE_PADRAO = {
+    "distance": FATOR_DESVIO_PADRAO,  # metros de rua por metro em linha reta
+    "duration": FATOR_DESVIO_PADRAO / (VELOCIDADE_MEDIA_KMH / 3.6),  # segundos por metro em linha reta
+}
+TAMANHO_REGIAO_GRAUS = 0.5  # Regiões de calibração: células de 0,5° x 0,5° (~55 km)
+MIN_AMOSTRAS_REGIAO = 30
+# --- Modo esparso (k vizinhos mais próximos) ---
+K_VIZINHOS_PADRAO = 20
+LIMIAR_MATRIZ_ESPARSA = 1500  # Acima desse número de pontos a página usa o modo esparso
+BLOCO_ESTIMATIVA = 1000  # Linhas por bloco ao preencher estimativas (limita memória temporária)
+TOLERANCIA_DEDUP_M = 0.0  # Pontos com as mesmas coordenadas (ex: pedidos do mesmo CNPJ) viram um único local
+PERFIL_OSRM = PERFIL_PADRAO  # Perfil usado nas URLs /table/v1/{perfil}/ e na chave do cache
 
 # Configuração do logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Cache para resultados de requisições repetidas
-@lru_cache(maxsize=1000)
-def _cached_osrm_request(url, params_tuple):
-    params = dict(params_tuple)
-    response = requests.get(url, params=params, timeout=DEFAULT_TIMEOUT)
-    response.raise_for_status()
-    return response.json()
+def _extrair_metricas(data, metrica):
+    """
+    Extrai da resposta OSRM Table as matrizes das métricas pedidas.
+    `metrica` pode ser uma métrica ("duration") ou várias separadas por vírgula
+    ("duration,distance"). Retorna dict {metrica: lista de listas} ou None.
+    """
+    resultado = {}
+    for m in metrica.split(","):
+        metric_key = f"{m}s"
+        if metric_key not in data:
+            logging.error(f"Resposta OSRM não contém a chave esperada '{metric_key}'. Resposta: {data}")
+            return None
+        resultado[m] = data[metric_key]
+    return resultado
+
+def _servidor_de(url):
+    """Extrai 'esquema://host:porta' de uma URL (chave do disjuntor por servidor)."""
+    partes = urlsplit(url)
+    return f"{partes.scheme}://{partes.netloc}"
+
+
+def _servidores_para(url, servidores=None):
+    """
+    Servidores entre os quais a requisição para `url` pode ser balanceada: todos os do grupo
+    se a URL apontar para um deles, senão apenas o servidor da própria URL.
+
+    Args:
+        url (str): URL completa da requisição.
+        servidores (list, optional): Grupo de servidores; padrão OSRM_SERVIDORES.
+
+    Returns:
+        tuple: (lista de servidores, caminho da URL após o servidor)
+    """
+    grupo = OSRM_SERVIDORES if servidores is None else servidores
+    servidor = _servidor_de(url)
+    caminho = url[len(servidor):]
+    return (list(grupo) if servidor in grupo else [servidor]), caminho
+
+
+def _aguardar_retentativa(tentativa):
+    """Dorme o backoff exponencial com jitter antes da próxima tentativa."""
+    espera = tempo_backoff(tentativa, maximo=RETRY_DELAY)
+    logging.info(f"Tentando novamente em {espera:.1f}s...")
+    time.sleep(espera)
 
 # --- AJUSTE AQUI: Adicionar extra_params=None ---
-def _get_osrm_table_batch(url_base, coords_str, metrica, timeout=DEFAULT_TIMEOUT, extra_params=None):
-    """Faz a requisição OSRM Table API para um lote, com retentativas."""
+def _get_osrm_table_batch(url_base, coords_str, metrica, timeout=DEFAULT_TIMEOUT, extra_params=None, servidores=None):
+    """
+    Faz a requisição OSRM Table API para um lote, com retentativas.
+    `metrica` aceita várias anotações separadas por vírgula; retorna dict {metrica: matriz}.
+    `servidores` é o grupo balanceado (padrão OSRM_SERVIDORES; ver _servidores_para).
+
+    Raises:
+        DisjuntorAbertoError: Se o disjuntor de todos os servidores recusar a requisição
+            (aberto, ou meio-aberto com a requisição de teste já em andamento).
+    """
     # --- AJUSTE AQUI: Mesclar parâmetros ---
     params = {"annotations": metrica}
     if extra_params:
         params.update(extra_params)
     # --------------------------------------
-    full_url = f"{url_base}{coords_str}"
+    servidores, caminho = _servidores_para(f"{url_base}{coords_str}", servidores)
+    balanceador = obter_balanceador(servidores)
     last_exception = None # Armazena a última exceção para log final
 
     for attempt in range(1, MAX_RETRIES + 1):
         response = None # Garante que response esteja definida
+        retentar = False
+        # Servidor com menos requisições em andamento entre os liberados pelo disjuntor
+        servidor = balanceador.adquirir()
+        if servidor is None:
+            # Disjuntor aberto, ou meio-aberto com a requisição de teste já em andamento
+            logging.warning(f"Disjuntor OSRM aberto ({', '.join(servidores)}): requisição do lote recusada sem chamar o servidor.")
+            raise DisjuntorAbertoError(f"Requisição recusada pelo disjuntor ({', '.join(servidores)}).")
+        disjuntor = obter_disjuntor(servidor)
+        full_url = f"{servidor}{caminho}"
         try:
             # Log da URL completa apenas na primeira tentativa para reduzir verbosidade
             # --- AJUSTE AQUI: Incluir params no log da URL ---
@@ -53,34 +146,29 @@ def _get_osrm_table_batch(url_base, coords_str, metrica, timeout=DEFAULT_TIMEOUT
             log_url = f"{full_url}?{params_str}" if attempt == 1 else f"{url_base}... (params omitidos)"
             # -------------------------------------------------
             logging.info(f"Consultando OSRM Table API via GET (Batch - Tentativa {attempt}/{MAX_RETRIES}): {log_url} (timeout={timeout}s)")
-            # --- AJUSTE: Sempre converte params para tupla ordenada ao usar cache ---
-            params_tuple = tuple(sorted(params.items()))
-            response = requests.get(full_url, params=params, timeout=timeout)
-            # ---------------------------------------------------------
+            response = sessao_http.get(full_url, servico="osrm", params=params, timeout=timeout)
             response.raise_for_status() # Levanta exceção para status HTTP 4xx/5xx
             logging.info(f"OSRM Status Code (Batch): {response.status_code}")
             data = response.json()
-            metric_key = f"{metrica}s"
-            if metric_key not in data:
-                logging.error(f"Resposta OSRM não contém a chave esperada '{metric_key}'. Resposta: {data}")
-                return None # Falha, não retenta (erro de formato de resposta)
-            return data[metric_key] # Sucesso! Retorna os dados
+            disjuntor.registrar_sucesso()
+            return _extrair_metricas(data, metrica) # Sucesso (ou None se faltar chave; não retenta)
 
         except requests.exceptions.Timeout as e:
             last_exception = e
+            disjuntor.registrar_falha()
             logging.warning(f"Timeout na requisição OSRM (Tentativa {attempt}/{MAX_RETRIES}): {e}.")
             if attempt == MAX_RETRIES:
                 logging.error(f"Máximo de retentativas ({MAX_RETRIES}) atingido devido a Timeout.")
             else:
-                logging.info(f"Tentando novamente em {RETRY_DELAY}s...")
-                time.sleep(RETRY_DELAY)
+                retentar = True
 
         except requests.exceptions.RequestException as e:
             last_exception = e
             status_code = e.response.status_code if e.response is not None else "N/A"
 
-            # Erro 400 (Bad Request) - Não retentar
+            # Erro 400 (Bad Request) - Não retentar (o servidor respondeu: não conta como falha no disjuntor)
             if e.response is not None and status_code == 400:
+                 disjuntor.registrar_sucesso()
                  logging.error(f"Erro HTTP 400 (Bad Request) do OSRM API. Verifique a string de coordenadas e a URL.")
                  # Usar e.request.url se disponível para a URL exata enviada
                  # --- AJUSTE AQUI: Incluir params no log da URL ---
@@ -95,7 +183,8 @@ def _get_osrm_table_batch(url_base, coords_str, metrica, timeout=DEFAULT_TIMEOUT
                      logging.error(f"Corpo da Resposta (Erro 400, não JSON): {e.response.text}")
                  return None # Falha, não retenta
 
-            # Outros erros HTTP (5xx, etc.) - Retentar
+            # Outros erros HTTP (5xx, etc.) e de conexão - Retentar
+            disjuntor.registrar_falha()
             logging.warning(f"Erro na requisição OSRM (Tentativa {attempt}/{MAX_RETRIES}): Status={status_code}, Erro={e}.")
             if attempt == MAX_RETRIES:
                  logging.error(f"Máximo de retentativas ({MAX_RETRIES}) atingido. Último erro: Status={status_code}, Erro={e}")
@@ -107,47 +196,27 @@ def _get_osrm_table_batch(url_base, coords_str, metrica, timeout=DEFAULT_TIMEOUT
                      except json.JSONDecodeError:
                          logging.error(f"Corpo da resposta OSRM (falha final, não JSON): {e.response.text}")
             else:
-                 logging.info(f"Tentando novamente em {RETRY_DELAY}s...")
-                 time.sleep(RETRY_DELAY)
+                 retentar = True
 
         except json.JSONDecodeError as e:
              last_exception = e
+             disjuntor.registrar_falha()
              logging.warning(f"Erro ao decodificar JSON da resposta OSRM (Tentativa {attempt}/{MAX_RETRIES}): {e}")
              if response is not None:
                  logging.error(f"Texto da resposta inválida: {response.text}")
              if attempt == MAX_RETRIES:
                  logging.error(f"Máximo de retentativas ({MAX_RETRIES}) atingido após erro de JSON.")
              else:
-                 logging.info(f"Tentando novamente em {RETRY_DELAY}s...")
-                 time.sleep(RETRY_DELAY)
+                 retentar = True
+        finally:
+            balanceador.liberar(servidor)
+        if retentar:
+            _aguardar_retentativa(attempt)  # Depois de liberar o servidor no balanceador
 
     # Se o loop terminar (todas as tentativas falharam), retorna None
     logging.error(f"Falha ao obter dados do OSRM após {MAX_RETRIES} tentativas. Última exceção: {last_exception}")
     return None
 
-# Paralelização das requisições
-def _get_osrm_table_batch_parallel(url_base, coords_str, metrica, timeout=DEFAULT_TIMEOUT, extra_params=None):
-    params = {"annotations": metrica}
-    if extra_params:
-        params.update(extra_params)
-
-    full_url = f"{url_base}{coords_str}"
-    # Transforma params em tupla ordenada para ser hashable
-    params_tuple = tuple(sorted(params.items()))
-
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future = executor.submit(_cached_osrm_request, full_url, params_tuple)
-        try:
-            data = future.result()
-            metric_key = f"{metrica}s"
-            if metric_key not in data:
-                logging.error(f"Resposta OSRM não contém a chave esperada '{metric_key}'. Resposta: {data}")
-                return None
-            return data[metric_key]
-        except Exception as e:
-            logging.error(f"Erro na requisição paralela OSRM: {e}")
-            return None
-
 # --- Funções de Validação Adicionadas ---
 def _is_valid_coord(value):
     """Verifica se um valor é um número finito (não NaN, não infinito)."""
@@ -171,149 +240,1347 @@ def _validar_coordenadas(pontos_lote):
 # --- Fim Funções de Validação ---
 
 
-def calcular_matriz_distancias(pontos, provider="osrm", metrica="duration", progress_callback=None):
+# --- Formato das coordenadas na URL ({coordinates} das APIs OSRM) ---
+def codificar_polyline(pontos, precisao=5):
+    """
+    Codifica [(lat, lon), ...] no formato Encoded Polyline (o mesmo de polyline()/polyline6()
+    do OSRM): deltas inteiros em zigue-zague, 5 bits por caractere.
+    """
+    escala = 10 ** precisao
+    valores = np.rint(np.asarray(pontos, dtype=float).reshape(-1, 2) * escala).astype(np.int64)
+    deltas = np.diff(valores, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel().tolist()
+    partes = []
+    for valor in deltas:
+        valor = ~(valor << 1) if valor < 0 else valor << 1
+        while valor >= 0x20:
+            partes.append(chr((0x20 | (valor & 0x1f)) + 63))
+            valor >>= 5
+        partes.append(chr(valor + 63))
+    return "".join(partes)
+
+
+def decodificar_polyline(texto, precisao=5):
+    """Inverso de codificar_polyline. Returns: lista de tuplas (lat, lon)."""
+    valores = []
+    atual, deslocamento = 0, 0
+    for caractere in texto:
+        b = ord(caractere) - 63
+        if not 0 <= b < 64:
+            raise ValueError(f"Caractere inválido em polyline: {caractere!r}")
+        atual |= (b & 0x1f) << deslocamento
+        deslocamento += 5
+        if b < 0x20:
+            valores.append(~(atual >> 1) if atual & 1 else atual >> 1)
+            atual, deslocamento = 0, 0
+    if deslocamento or len(valores) % 2:
+        raise ValueError("Polyline incompleta.")
+    arr = np.cumsum(np.array(valores, dtype=np.int64).reshape(-1, 2), axis=0) / 10 ** precisao
+    return [tuple(p) for p in arr.tolist()]
+
+
+def formatar_coordenadas(pontos, formato=None):
+    """
+    Monta o trecho {coordinates} da URL OSRM para [(lat, lon), ...]. Em polyline6 a URL fica
+    várias vezes menor que em "lon,lat;lon,lat", o que permite blocos com muito mais coordenadas.
+
+    Args:
+        pontos (list): Lista de tuplas (latitude, longitude).
+        formato (str, optional): "polyline6", "polyline" ou "texto"; padrão FORMATO_COORDENADAS.
+
+    Returns:
+        str: Ex: "polyline6(...)" (já com escape para URL) ou "lon,lat;lon,lat".
+    """
+    formato = formato or FORMATO_COORDENADAS
+    if formato not in FORMATOS_COORDENADAS:
+        raise ValueError(f"Formato de coordenadas desconhecido: '{formato}'. Use um de {FORMATOS_COORDENADAS}.")
+    if formato == "texto":
+        return ";".join(f"{lon},{lat}" for lat, lon in pontos)
+    precisao = 6 if formato == "polyline6" else 5
+    return f"{formato}({quote(codificar_polyline(pontos, precisao), safe='')})"
+
+
+def ler_coordenadas(texto):
+    """
+    Inverso de formatar_coordenadas: aceita "lon,lat;...", "polyline(...)" ou "polyline6(...)",
+    com ou sem escape de URL.
+
+    Returns:
+        list: Tuplas (latitude, longitude). Levanta ValueError se o texto for inválido.
+    """
+    texto = unquote(texto)
+    for formato, precisao in (("polyline6(", 6), ("polyline(", 5)):
+        if texto.startswith(formato) and texto.endswith(")"):
+            return decodificar_polyline(texto[len(formato):-1], precisao)
+    pontos = []
+    for coordenada in texto.split(";"):
+        lon, lat = map(float, coordenada.split(","))
+        pontos.append((lat, lon))
+    return pontos
+
+
+def calcular_matriz_distancias(pontos, provider="osrm", metrica="duration", progress_callback=None, usar_cache=True, cache=None, cancelamento=None, dtype=DTYPE_MATRIZ_PADRAO, k_vizinhos=None, anterior=None, tolerancia_dedup_m=TOLERANCIA_DEDUP_M, retornar_mascara=False):
     """
     Calcula a matriz de distâncias ou tempos usando OSRM Table API em lotes,
     validando coordenadas antes de cada requisição.
+    Pares já presentes no cache persistente não são enviados ao OSRM.
 
     Args:
         pontos (list): Lista de tuplas (latitude, longitude).
-        provider (str): Provedor de roteamento (atualmente apenas "osrm").
+        provider (str): "osrm" (valores exatos por ruas) ou "haversine" (estimativa instantânea por
+                        grande círculo x fator de desvio calibrado com o cache OSRM).
         metrica (str): "duration" (tempo em segundos) ou "distance" (distância em metros).
         progress_callback (function, optional): Função para reportar progresso (recebe float 0.0 a 1.0).
+        usar_cache (bool): Se True, consulta/grava o cache persistente de pares (routing.cache_distancias).
+        cache (CacheParesOSRM, optional): Instância de cache a usar (default: cache compartilhado).
+        cancelamento (threading.Event, optional): Quando sinalizado, interrompe o cálculo e retorna None.
+        dtype (numpy.dtype): Tipo inteiro da matriz (default int32).
+        k_vizinhos (int, optional): Se informado, usa o modo esparso (ver calcular_matriz_knn):
+                                    valores exatos só para os k vizinhos de cada ponto e o depósito.
+        anterior (dict, optional): Resultado anterior {'pontos': [...], 'duration'/'distance': matriz,
+                                   'exatas': máscara NxN opcional}. Os pares exatos entre pontos que
+                                   continuam na lista são reaproveitados e só os demais vão ao OSRM.
+        tolerancia_dedup_m (float, optional): Pontos a até essa distância (metros) são tratados como um
+                                              único local (0 = só coordenadas idênticas; None desativa).
+                                              A matriz é calculada nos locais únicos e expandida ao final.
+        retornar_mascara (bool): Se True, retorna também a máscara dos pares exatos (respondidos pelo
+                                 OSRM, inclusive null -> INFINITE_VALUE de pares sem rota; sem estimativa
+                                 nem falha), a guardar em `anterior['exatas']`.
 
     Returns:
-        numpy.ndarray or None: Matriz NxN com os valores da métrica, ou None se ocorrer erro crítico.
+        numpy.ndarray or tuple or None: Matriz NxN com os valores da métrica (e máscara bool NxN se
+                               retornar_mascara), ou None se ocorrer erro crítico.
                                Retorna INFINITE_VALUE para pares impossíveis de rotear.
     """
-    n = len(pontos)
-    if n == 0:
-        logging.warning("Lista de pontos vazia.")
-        return np.array([[]])
-    if provider != "osrm":
-        raise NotImplementedError("Apenas o provedor 'osrm' é suportado no momento.") # Corrigido: Adicionado raise
-    if metrica not in ["duration", "distance"]:
+    if metrica not in METRICAS_VALIDAS:
         raise ValueError("Métrica deve ser 'duration' ou 'distance'.") # Corrigido: Adicionado raise
+    resultado = _calcular_matrizes(pontos, [metrica], provider, progress_callback, usar_cache, cache, cancelamento, dtype, k_vizinhos, anterior, tolerancia_dedup_m)
+    if resultado is None:
+        return (None, None) if retornar_mascara else None
+    matrizes, exatas = resultado
+    return (matrizes[metrica], exatas) if retornar_mascara else matrizes[metrica]
 
-    url_base = f"{OSRM_SERVER_URL}/table/v1/driving/"
-    final_matrix = np.full((n, n), INFINITE_VALUE, dtype=int) # Usar int para tempos/distâncias
-    np.fill_diagonal(final_matrix, 0)
 
-    # --- AJUSTE AQUI ---
-    max_coords_per_request = 50 # Aumentado para 50 para reduzir número de requisições
-    # -------------------
-    num_batches = (n + max_coords_per_request - 1) // max_coords_per_request
-    batches = [list(range(i * max_coords_per_request, min((i + 1) * max_coords_per_request, n))) for i in range(num_batches)]
-    total_requests = num_batches * num_batches
+def calcular_matrizes_tempo_distancia(pontos, provider="osrm", progress_callback=None, usar_cache=True, cache=None, cancelamento=None, dtype=DTYPE_MATRIZ_PADRAO, k_vizinhos=None, anterior=None, tolerancia_dedup_m=TOLERANCIA_DEDUP_M, retornar_mascara=False):
+    """
+    Calcula as matrizes de tempo (duration) e distância (distance) em uma única
+    passada pela OSRM Table API (annotations=duration,distance).
 
-    logging.info(f"Dividindo {n} pontos em {num_batches} lotes (máx {max_coords_per_request} por lote). Total de {total_requests} requisições OSRM.")
-    request_count = 0
+    Use quando as duas métricas forem necessárias (ex: roteirização por distância e
+    simulação de custos por tempo): metade das requisições de duas chamadas separadas.
 
-    try:
-        for r_idx, batch_origem_indices_global in enumerate(batches):
-            for c_idx, batch_destino_indices_global in enumerate(batches):
-                request_count += 1
-                logging.info(f"Calculando submatriz Lote {r_idx+1}/{num_batches} -> Lote {c_idx+1}/{num_batches} (Req {request_count}/{total_requests})")
-
-                # --- Validação dos Pontos do Lote Combinado ---
-                # Combina índices globais de origem e destino, removendo duplicatas e mantendo a ordem
-                combined_indices_global = sorted(list(set(batch_origem_indices_global + batch_destino_indices_global)))
-                pontos_lote_combinado = [pontos[i] for i in combined_indices_global]
-
-                # Valida as coordenadas *deste lote combinado*
-                osrm_points_coords, indices_validos_no_lote_combinado = _validar_coordenadas(pontos_lote_combinado)
-
-                # Mapeia índices válidos no lote combinado de volta para índices globais
-                indices_globais_validos = [combined_indices_global[i] for i in indices_validos_no_lote_combinado]
-
-                # Mapeia índices globais de origem/destino para índices *dentro da lista de pontos válidos* (osrm_points_coords)
-                # que será enviada ao OSRM. Cria um dicionário para busca rápida.
-                map_global_to_osrm_idx = {osrm_idx: global_idx for osrm_idx, global_idx in enumerate(indices_globais_validos)}
-
-                # Filtra os índices globais de origem/destino para incluir apenas os que são válidos
-                batch_origem_indices_validos_global = [idx for idx in batch_origem_indices_global if idx in map_global_to_osrm_idx]
-                batch_destino_indices_validos_global = [idx for idx in batch_destino_indices_global if idx in map_global_to_osrm_idx]
-
-                # Obtém os índices correspondentes na lista que vai para o OSRM
-                osrm_sources_indices = [map_global_to_osrm_idx[idx] for idx in batch_origem_indices_validos_global]
-                osrm_destinations_indices = [map_global_to_osrm_idx[idx] for idx in batch_destino_indices_validos_global]
-                # --- Fim Validação ---
-
-
-                # --- Requisição OSRM com Pontos Válidos ---
-                # Não faz requisição se houver menos de 2 pontos válidos em sources ou destinations
-                if len(osrm_sources_indices) < 2 or len(osrm_destinations_indices) < 2:
-                    logging.warning(f"Lote ignorado: menos de 2 pontos em sources ou destinations (sources={len(osrm_sources_indices)}, destinations={len(osrm_destinations_indices)}). Pulando requisição OSRM.")
-                    if progress_callback:
-                        progress_callback(request_count / total_requests)
-                    continue
-
-                if not osrm_points_coords or len(osrm_points_coords) < 1 or not osrm_sources_indices or not osrm_destinations_indices:
-                     logging.warning(f"Nenhum ponto válido ou nenhuma origem/destino válido no lote combinado (Req {request_count}). Pulando requisição OSRM.")
-                     if progress_callback:
-                        progress_callback(request_count / total_requests)
-                     continue
-
-                batch_coords_str = ";".join([f"{lon},{lat}" for lat, lon in osrm_points_coords])
-
-                # Adiciona os parâmetros sources e destinations
-                sources_param = ";".join(map(str, osrm_sources_indices))
-                destinations_param = ";".join(map(str, osrm_destinations_indices))
-                params_com_indices = {"sources": sources_param, "destinations": destinations_param}
-
-                # --- AJUSTE AQUI: Usar extra_params ---
-                # Chama a função _get_osrm_table_batch_parallel passando a URL base e os parâmetros extras
-                partial_matrix_raw = _get_osrm_table_batch_parallel(url_base, batch_coords_str, metrica, timeout=DEFAULT_TIMEOUT, extra_params=params_com_indices)
-                # --------------------------------------
-
-
-                if partial_matrix_raw is None:
-                    logging.error(f"Falha ao obter dados do OSRM para o lote (Req {request_count}/{total_requests}). Preenchendo com INFINITE_VALUE e continuando.")
-                    # Preenche todos os pares deste lote com INFINITE_VALUE
-                    for i, source_global_idx in enumerate(batch_origem_indices_validos_global):
-                        for j, dest_global_idx in enumerate(batch_destino_indices_validos_global):
-                            final_matrix[source_global_idx, dest_global_idx] = INFINITE_VALUE
-                    if progress_callback:
-                        progress_callback(request_count / total_requests)
-                    continue
-
-                # --- Preenchimento da Matriz Final ---
-                # A matriz retornada pelo OSRM com sources/destinations tem shape (len(sources), len(destinations))
-                # Iteramos sobre os resultados e colocamos na matriz final usando os índices globais válidos
-                expected_rows = len(osrm_sources_indices)
-                expected_cols = len(osrm_destinations_indices)
-                actual_rows = len(partial_matrix_raw) if partial_matrix_raw is not None else 0
-                actual_cols = len(partial_matrix_raw[0]) if actual_rows > 0 and partial_matrix_raw[0] is not None else 0
-
-                if actual_rows != expected_rows or actual_cols != expected_cols:
-                     logging.error(f"Erro: Dimensões da matriz OSRM ({actual_rows}x{actual_cols}) "
-                                   f"não correspondem aos índices de origem/destino enviados ({expected_rows}x{expected_cols}). Req {request_count}")
-                     # Considerar isso um erro crítico também? Por enquanto, loga e continua, pode preencher errado.
-                     # return None # Descomentar para abortar
-                else:
-                    for i, source_global_idx in enumerate(batch_origem_indices_validos_global):
-                        for j, dest_global_idx in enumerate(batch_destino_indices_validos_global):
-                            value = partial_matrix_raw[i][j]
-                            # OSRM retorna null para rotas impossíveis
-                            final_matrix[source_global_idx, dest_global_idx] = int(value) if value is not None else INFINITE_VALUE
-
-                # Atualiza progresso
+    Args:
+        pontos (list): Lista de tuplas (latitude, longitude).
+        provider (str): "osrm" ou "haversine" (estimativa, ver calcular_matriz_distancias).
+        progress_callback (function, optional): Função para reportar progresso (recebe float 0.0 a 1.0).
+        usar_cache (bool): Se True, consulta/grava o cache persistente de pares.
+        cache (CacheParesOSRM, optional): Instância de cache a usar (default: cache compartilhado).
+        cancelamento (threading.Event, optional): Quando sinalizado, interrompe o cálculo.
+        dtype (numpy.dtype): Tipo inteiro das matrizes (default int32).
+        k_vizinhos (int, optional): Se informado, usa o modo esparso (ver calcular_matriz_knn).
+        anterior (dict, optional): Resultado anterior {'pontos': [...], 'duration': ..., 'distance': ..., 'exatas': ...}
+                                   para reaproveitar os pares exatos (ver calcular_matriz_distancias).
+        tolerancia_dedup_m (float, optional): Tolerância para agrupar pontos repetidos (ver calcular_matriz_distancias).
+        retornar_mascara (bool): Se True, retorna também a máscara dos pares exatos.
+
+    Returns:
+        tuple: (matriz_tempos, matriz_distancias) como numpy.ndarray NxN (e a máscara bool NxN se
+               retornar_mascara), ou Nones em caso de erro crítico.
+    """
+    resultado = _calcular_matrizes(pontos, ["duration", "distance"], provider, progress_callback, usar_cache, cache, cancelamento, dtype, k_vizinhos, anterior, tolerancia_dedup_m)
+    if resultado is None:
+        return (None, None, None) if retornar_mascara else (None, None)
+    matrizes, exatas = resultado
+    if retornar_mascara:
+        return matrizes["duration"], matrizes["distance"], exatas
+    return matrizes["duration"], matrizes["distance"]
+
+
+def _calcular_matrizes(pontos, metricas, provider="osrm", progress_callback=None, usar_cache=True, cache=None, cancelamento=None, dtype=DTYPE_MATRIZ_PADRAO, k_vizinhos=None, anterior=None, tolerancia_dedup_m=TOLERANCIA_DEDUP_M):
+    """
+    Núcleo do cálculo em lotes: obtém todas as `metricas` pedidas na mesma requisição
+    OSRM por bloco. Retorna ({metrica: numpy.ndarray}, máscara NxN dos pares exatos) ou
+    None em caso de erro crítico ou cancelamento.
+    """
+    n = len(pontos)
+    if n == 0:
+        logging.warning("Lista de pontos vazia.")
+        return {m: np.array([[]]) for m in metricas}, np.zeros((0, 0), dtype=bool)
+    if provider not in PROVEDORES_VALIDOS:
+        raise NotImplementedError(f"Provedor '{provider}' não suportado. Use um de {PROVEDORES_VALIDOS}.")
+    for metrica in metricas:
+        if metrica not in METRICAS_VALIDAS:
+            raise ValueError("Métrica deve ser 'duration' ou 'distance'.")
+    if tolerancia_dedup_m is not None and n > 1:
+        unicos, mapa = deduplicar_coordenadas(pontos, tolerancia_dedup_m)
+        if len(unicos) < n:
+            logging.info(f"Deduplicação: {n} pontos -> {len(unicos)} locais únicos (tolerância {tolerancia_dedup_m} m).")
+            resultado = _calcular_matrizes(unicos, metricas, provider, progress_callback, usar_cache, cache, cancelamento,
+                                           dtype, k_vizinhos, anterior, tolerancia_dedup_m=None)
+            if resultado is None:
+                return None
+            matrizes, exatas = resultado
+            return {m: expandir_matriz(matriz, mapa) for m, matriz in matrizes.items()}, expandir_matriz(exatas, mapa)
+    if provider == "osrm" and usar_cache:
+        # Importação local: routing.matriz_universo importa este módulo
+        from routing import matriz_universo
+        if matriz_universo.USAR_UNIVERSO:
+            try:
+                matrizes = matriz_universo.extrair_do_universo(pontos, metricas, dtype)
+            except Exception as e:
+                logging.warning(f"Falha ao consultar o universo pré-calculado, seguindo sem ele: {e}")
+                matrizes = None
+            if matrizes is not None:
+                logging.info(f"Matrizes '{','.join(metricas)}' ({n}x{n}) extraídas do universo pré-calculado, sem chamadas ao OSRM.")
                 if progress_callback:
-                    progress_callback(request_count / total_requests)
-                # --- Fim Preenchimento ---
+                    progress_callback(1.0)
+                return matrizes, np.ones((n, n), dtype=bool)  # O universo só guarda pares exatos
+    if provider == "haversine":
+        matrizes = {m: estimar_matriz_haversine(pontos, m, dtype=dtype) for m in metricas}
+        if progress_callback:
+            progress_callback(1.0)
+        return matrizes, np.eye(n, dtype=bool)
+    if k_vizinhos is not None and k_vizinhos + 1 < n:
+        return _calcular_matrizes_knn(pontos, metricas, k_vizinhos, progress_callback, usar_cache, cache, cancelamento, dtype)
+    annotations = ",".join(metricas)
+
+    url_base = f"{OSRM_SERVER_URL}/table/v1/{PERFIL_OSRM}/"
+    matrizes, tiles, cache, exatas = _preparar_calculo(pontos, metricas, usar_cache, cache, dtype, anterior)
+    total_requests = len(tiles)
+    logging.info(f"Total de {total_requests} requisições OSRM (até {MAX_WORKERS} simultâneas).")
+    if total_requests == 0:
+        if progress_callback:
+            progress_callback(1.0)
+        return matrizes, exatas
+
+    try:
+        concluidas = _executar_tiles(url_base, tiles, annotations, matrizes, pontos, cache, progress_callback, cancelamento, exatas)
+        if concluidas is None:
+            logging.warning("Cálculo da matriz OSRM cancelado.")
+            return None
 
-        logging.info(f"Matriz de '{metrica}' ({final_matrix.shape}) calculada com sucesso usando lotes.")
-        return final_matrix
+        logging.info(f"Matrizes '{annotations}' ({n}x{n}) calculadas com sucesso usando lotes.")
+        if cache is not None:
+            stats = cache.estatisticas()
+            logging.info(f"Cache OSRM acumulado: {stats['hits']} acertos, {stats['misses']} faltas (taxa {stats['taxa_acerto']:.1%}).")
+        return matrizes, exatas
 
     except Exception as e:
         logging.error(f"Erro inesperado durante cálculo da matriz OSRM em lote: {e}")
         logging.error(traceback.format_exc()) # Log completo do traceback
         return None
 
+
+def _preparar_calculo(pontos, metricas, usar_cache=True, cache=None, dtype=DTYPE_MATRIZ_PADRAO, anterior=None):
+    """
+    Etapa síncrona comum ao cálculo em threads e ao cliente assíncrono (routing.osrm_async):
+    cria as matrizes, reaproveita a matriz anterior e o cache persistente, e monta os blocos
+    (tiles) que ainda precisam ir ao OSRM.
+
+    Returns:
+        tuple: (matrizes {metrica: numpy.ndarray}, tiles, cache efetivamente em uso ou None,
+                máscara NxN dos pares já exatos, a completar por _executar_tiles)
+    """
+    n = len(pontos)
+    annotations = ",".join(metricas)
+    matrizes = {}
+    for metrica in metricas:
+        matrizes[metrica] = np.full((n, n), INFINITE_VALUE, dtype=dtype) # Inteiros para tempos/distâncias
+        np.fill_diagonal(matrizes[metrica], 0)
+
+    # --- Matriz anterior: reaproveita os pares exatos entre pontos que continuam na lista ---
+    faltantes = np.ones((n, n), dtype=bool)
+    reaproveitados = np.zeros(n, dtype=bool)
+    if anterior is not None:
+        try:
+            copiados = reaproveitar_matrizes(pontos, anterior, matrizes)
+            faltantes &= ~copiados
+            reaproveitados = copiados.diagonal().copy()  # A diagonal é sempre copiada para os pontos presentes
+            logging.info(f"Matriz anterior: {int(reaproveitados.sum())} de {n} pontos reaproveitados "
+                         f"({int(copiados.sum() - reaproveitados.sum())} pares exatos).")
+        except Exception as e:
+            logging.warning(f"Não foi possível reaproveitar a matriz anterior, recalculando: {e}")
+            faltantes[:] = True
+            reaproveitados[:] = False
+    np.fill_diagonal(faltantes, False)
+
+    # --- Cache persistente: preenche pares conhecidos e marca os que faltam (em qualquer métrica) ---
+    if usar_cache and faltantes.any():
+        antes_cache = faltantes.copy()
+        try:
+            if cache is None:
+                cache = obter_cache_padrao()
+            em_todas = np.ones((n, n), dtype=bool)
+            if faltantes.sum() < n * n // 2:
+                # Poucos pares faltando (ex: atualização incremental): busca só esses pares
+                i_idx, j_idx = np.nonzero(faltantes)
+                orig = [pontos[i] for i in i_idx.tolist()]
+                dest = [pontos[j] for j in j_idx.tolist()]
+                for metrica in metricas:
+                    valores, encontrados = cache.buscar_pares(orig, dest, metrica, PERFIL_OSRM)
+                    matrizes[metrica][i_idx[encontrados], j_idx[encontrados]] = valores[encontrados]
+                    em_todas[i_idx[~encontrados], j_idx[~encontrados]] = False
+            else:
+                for metrica in metricas:
+                    valores_cache, encontrados = cache.buscar_matriz(pontos, metrica, PERFIL_OSRM)
+                    preencher = encontrados & faltantes
+                    matrizes[metrica][preencher] = valores_cache[preencher]
+                    em_todas &= encontrados
+            faltantes &= ~em_todas
+            hits = int(antes_cache.sum() - faltantes.sum())
+            logging.info(f"Cache OSRM ({annotations}): {hits} pares em cache, {int(faltantes.sum())} pares a consultar.")
+        except Exception as e:
+            logging.warning(f"Falha ao consultar o cache OSRM, seguindo sem cache: {e}")
+            faltantes = antes_cache
+            cache = None
+    elif not usar_cache:
+        cache = None
+
+    exatas = ~faltantes  # Diagonal, pares reaproveitados e pares do cache (o cache só guarda valores do OSRM)
+    if not faltantes.any():
+        logging.info(f"Matrizes '{annotations}' ({n}x{n}) obtidas inteiramente do cache.")
+        return matrizes, [], cache, exatas
+
+    # Planeja os blocos apenas sobre as linhas/colunas que têm pares faltantes
+    if reaproveitados.any():
+        # Atualização incremental: faltam as linhas e colunas dos pontos novos (formato em cruz),
+        # cobertas por dois planos retangulares em vez de um plano NxN
+        novos = np.flatnonzero(~reaproveitados).tolist()
+        antigos = np.flatnonzero(reaproveitados).tolist()
+        plano = planejar_tiles(novos, range(n), MAX_TABLE_SIZE) + planejar_tiles(antigos, novos, MAX_TABLE_SIZE)
+        entre_antigos = faltantes[np.ix_(antigos, antigos)]
+        if entre_antigos.any():
+            # Pares entre pontos antigos que não eram exatos na execução anterior
+            antigos = np.asarray(antigos)
+            plano += planejar_tiles(antigos[entre_antigos.any(axis=1)].tolist(), antigos[entre_antigos.any(axis=0)].tolist(), MAX_TABLE_SIZE)
+    else:
+        linhas = np.flatnonzero(faltantes.any(axis=1)).tolist()
+        colunas = np.flatnonzero(faltantes.any(axis=0)).tolist()
+        plano = planejar_tiles(linhas, colunas, MAX_TABLE_SIZE)
+
+    # Monta os blocos (tiles) que realmente precisam ir ao OSRM
+    tiles = []
+    for origens_plano, destinos_plano in plano:
+        # Restringe o bloco às linhas/colunas que ainda têm pares fora do cache
+        bloco_faltantes = faltantes[np.ix_(origens_plano, destinos_plano)]
+        if not bloco_faltantes.any():
+            continue
+        origens = [idx for idx, falta in zip(origens_plano, bloco_faltantes.any(axis=1)) if falta]
+        destinos = [idx for idx, falta in zip(destinos_plano, bloco_faltantes.any(axis=0)) if falta]
+        tile = _preparar_tile(pontos, origens, destinos)
+        if tile is not None:
+            tiles.append(tile)
+
+    custo = estimar_custo_plano([(t['origens'], t['destinos']) for t in tiles])
+    logging.info(f"Plano OSRM para {n} pontos (max-table-size={MAX_TABLE_SIZE}): {custo['requisicoes']} requisições, "
+                 f"{custo['coordenadas']} coordenadas enviadas, {custo['celulas']} células calculadas.")
+    return matrizes, tiles, cache, exatas
+
+
+def chave_ponto(ponto, precisao=PRECISAO_CACHE):
+    """Chave inteira (lat, lon) arredondada usada para identificar um ponto entre execuções."""
+    escala = 10 ** precisao
+    return (int(round(float(ponto[0]) * escala)), int(round(float(ponto[1]) * escala)))
+
+
+def reaproveitar_matrizes(pontos, anterior, matrizes):
+    """
+    Copia para `matrizes` os valores exatos de uma execução anterior para os pares de pontos
+    presentes nas duas listas (comparando as coordenadas arredondadas), com uma única cópia
+    vetorizada (np.ix_) por métrica.
+
+    Só são copiados os pares marcados em `anterior['exatas']` (valores vindos do OSRM) e com valor
+    finito em todas as métricas: pares que falharam ou foram estimados por haversine voltam ao OSRM
+    em vez de virarem arcos "conhecidos". Sem a máscara, todo par finito é tratado como exato.
+
+    Args:
+        pontos (list): Lista atual de tuplas (latitude, longitude).
+        anterior (dict): {'pontos': lista anterior, <metrica>: matriz anterior, ..., 'exatas': máscara opcional}.
+        matrizes (dict): {metrica: numpy.ndarray NxN} a preencher (alterado no lugar).
+
+    Returns:
+        numpy.ndarray: Máscara booleana NxN dos pares copiados (a diagonal dos pontos reaproveitados incluída).
+    """
+    n = len(pontos)
+    copiados = np.zeros((n, n), dtype=bool)
+    posicao_anterior = {}
+    for idx, ponto in enumerate(anterior['pontos']):
+        posicao_anterior.setdefault(chave_ponto(ponto), idx)
+    mapa = np.array([posicao_anterior.get(chave_ponto(p), -1) for p in pontos], dtype=np.intp)
+    reaproveitados = mapa >= 0
+    if not reaproveitados.any():
+        return copiados
+    k = int(reaproveitados.sum())
+    atuais = np.ix_(np.flatnonzero(reaproveitados), np.flatnonzero(reaproveitados))
+    antigos = np.ix_(mapa[reaproveitados], mapa[reaproveitados])
+    exatas = anterior.get('exatas')
+    validos = np.ones((k, k), dtype=bool) if exatas is None else np.asarray(exatas, dtype=bool)[antigos]
+    anteriores = {}
+    for metrica in matrizes:
+        matriz_anterior = anterior.get(metrica)
+        if matriz_anterior is None:
+            return copiados  # Métrica ausente: não há o que reaproveitar
+        anteriores[metrica] = np.asarray(matriz_anterior)[antigos]
+        validos &= anteriores[metrica] < INFINITE_VALUE
+    np.fill_diagonal(validos, True)
+    for metrica, matriz in matrizes.items():
+        bloco = matriz[atuais]
+        bloco[validos] = anteriores[metrica][validos]
+        matriz[atuais] = bloco
+    copiados[atuais] = validos
+    return copiados
+
+
+def _coordenadas_esfera(arr):
+    """Converte (lat, lon) em graus para coordenadas cartesianas na esfera unitária."""
+    lat, lon = np.radians(arr[:, 0]), np.radians(arr[:, 1])
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def deduplicar_coordenadas(pontos, tolerancia_m=TOLERANCIA_DEDUP_M):
+    """
+    Agrupa coordenadas idênticas ou muito próximas em locais únicos.
+
+    Os pontos são percorridos na ordem original: o primeiro ponto de cada grupo é o seu
+    representante, de modo que o índice 0 (depósito) continua sendo o local 0. Coordenadas
+    inválidas nunca são agrupadas.
+
+    Args:
+        pontos (list): Lista de tuplas (latitude, longitude).
+        tolerancia_m (float): Distância máxima (metros) até o representante; 0 agrupa apenas
+                              coordenadas iguais (após arredondamento de PRECISAO_CACHE casas).
+
+    Returns:
+        tuple: (unicos, mapa) — lista de locais únicos e numpy.ndarray (N,) com o índice do local
+               único de cada ponto original (pontos[i] ~ unicos[mapa[i]]).
+    """
+    arr = np.asarray(pontos, dtype=float).reshape(-1, 2)
+    n = len(arr)
+    mapa = np.full(n, -1, dtype=np.intp)
+    validos = _mascara_validos(arr)
+
+    if tolerancia_m and tolerancia_m > 0:
+        from sklearn.neighbors import KDTree
+        idx_validos = np.flatnonzero(validos)
+        xyz = _coordenadas_esfera(arr[idx_validos])
+        corda = 2 * np.sin(tolerancia_m / (2 * RAIO_TERRA_M))  # Raio em linha reta na esfera unitária
+        vizinhos = KDTree(xyz).query_radius(xyz, r=corda) if len(idx_validos) else []
+        grupos = {idx: idx_validos[v] for idx, v in zip(idx_validos.tolist(), vizinhos)}
+    else:
+        por_chave = {}
+        for i in np.flatnonzero(validos).tolist():
+            por_chave.setdefault(chave_ponto(arr[i]), []).append(i)
+        grupos = {i: np.asarray(membros) for membros in por_chave.values() for i in membros}
+
+    unicos = []
+    for i in range(n):
+        if mapa[i] >= 0:
+            continue
+        mapa[i] = len(unicos)
+        if validos[i]:
+            membros = grupos[i]
+            mapa[membros[mapa[membros] < 0]] = len(unicos)
+        unicos.append(tuple(pontos[i]))
+    return unicos, mapa
+
+
+def expandir_matriz(matriz_unicos, mapa):
+    """
+    Expande a matriz dos locais únicos para os pontos originais com um único gather (np.ix_).
+    Pares entre pontos do mesmo local ficam com o valor da diagonal (0).
+    Se o mapa for a identidade (nenhum ponto agrupado), devolve a própria matriz, sem cópia.
+    """
+    matriz_unicos = np.asarray(matriz_unicos)
+    mapa = np.asarray(mapa)
+    if len(mapa) == len(matriz_unicos) and np.array_equal(mapa, np.arange(len(mapa))):
+        return matriz_unicos
+    return matriz_unicos[np.ix_(mapa, mapa)]
+
+
+# --- Modo esparso: valores exatos apenas para os k vizinhos mais próximos ---
+def vizinhos_mais_proximos(pontos, k=K_VIZINHOS_PADRAO):
+    """
+    Encontra os k vizinhos mais próximos (em linha reta) de cada ponto usando uma KD-tree
+    sobre as coordenadas projetadas na esfera unitária (ordem idêntica à do grande círculo).
+
+    Args:
+        pontos (list): Lista de tuplas (latitude, longitude).
+        k (int): Número de vizinhos por ponto (sem contar o próprio ponto).
+
+    Returns:
+        numpy.ndarray: Máscara booleana NxN, simétrica, com True nos pares vizinhos.
+                       Pontos com coordenadas inválidas não têm vizinhos.
+    """
+    from sklearn.neighbors import KDTree
+
+    arr = np.asarray(pontos, dtype=float).reshape(-1, 2)
+    n = len(arr)
+    vizinhos = np.zeros((n, n), dtype=bool)
+    validos = np.flatnonzero(_mascara_validos(arr))
+    k_efetivo = min(int(k) + 1, len(validos))
+    if k_efetivo < 2:
+        return vizinhos
+
+    xyz = _coordenadas_esfera(arr[validos])
+    _, ind = KDTree(xyz).query(xyz, k=k_efetivo)
+    vizinhos[np.repeat(validos, k_efetivo), validos[ind].ravel()] = True
+    vizinhos |= vizinhos.T
+    np.fill_diagonal(vizinhos, False)
+    return vizinhos
+
+
+def _ordem_espacial(pontos, indices):
+    """Ordena índices em faixas de latitude (serpentina em longitude) para agrupar pontos próximos."""
+    indices = np.asarray(indices, dtype=np.intp)
+    if len(indices) == 0:
+        return indices
+    arr = np.asarray(pontos, dtype=float).reshape(-1, 2)[indices]
+    n_faixas = max(1, int(np.sqrt(len(indices))))
+    lat_min, lat_max = arr[:, 0].min(), arr[:, 0].max()
+    faixa = np.minimum(((arr[:, 0] - lat_min) / ((lat_max - lat_min) or 1.0) * n_faixas).astype(int), n_faixas - 1)
+    lon_serpentina = np.where(faixa % 2 == 0, arr[:, 1], -arr[:, 1])
+    return indices[np.lexsort((lon_serpentina, faixa))]
+
+
+def planejar_tiles_esparsos(pontos, mascara, max_table_size=MAX_TABLE_SIZE):
+    """
+    Planeja blocos que cobrem todos os pares True de uma máscara NxN (esparsa), respeitando max-table-size.
+
+    As origens são percorridas em ordem espacial e agrupadas enquanto origens ∪ destinos
+    necessários couberem em uma requisição: vizinhos de pontos próximos se repetem, então cada
+    coordenada enviada é aproveitada por várias origens. Linhas densas (ex: depósito) são
+    divididas com planejar_tiles.
+
+    Returns:
+        list: Lista de tuplas (origens, destinos) com índices globais.
+    """
+    max_table_size = max(2, int(max_table_size))
+    plano = []
+    origens, destinos = [], set()
+    for i in _ordem_espacial(pontos, np.flatnonzero(mascara.any(axis=1))).tolist():
+        destinos_i = set(np.flatnonzero(mascara[i]).tolist())
+        if len(destinos_i | {i}) > max_table_size:
+            plano.extend(planejar_tiles([i], sorted(destinos_i), max_table_size))
+            continue
+        uniao = destinos | destinos_i
+        if origens and len(uniao | set(origens) | {i}) > max_table_size:
+            plano.append((origens, sorted(destinos)))
+            origens, uniao = [], destinos_i
+        origens.append(i)
+        destinos = uniao
+    if origens:
+        plano.append((origens, sorted(destinos)))
+    return plano
+
+
+def calcular_matriz_knn(pontos, k=K_VIZINHOS_PADRAO, metrica="duration", progress_callback=None, usar_cache=True, cache=None, cancelamento=None, dtype=DTYPE_MATRIZ_PADRAO, retornar_mascara=False):
+    """
+    Calcula uma matriz NxN em que apenas os arcos entre cada ponto e seus k vizinhos mais
+    próximos (e todos os arcos de/para o depósito, índice 0) vêm do OSRM; os demais são
+    estimados por haversine x fator de desvio calibrado com os próprios arcos exatos.
+
+    As chamadas ao OSRM crescem com O(N·k) em vez de O(N²), o que torna viável roteirizar
+    milhares de paradas. A matriz resultante é um numpy.ndarray comum (consumível por solver_cvrp).
+
+    Args:
+        pontos (list): Lista de tuplas (latitude, longitude); o índice 0 é o depósito.
+        k (int): Número de vizinhos com valores exatos por ponto.
+        metrica (str): "duration" ou "distance".
+        progress_callback (function, optional): Função para reportar progresso (0.0 a 1.0).
+        usar_cache (bool): Se True, consulta/grava o cache persistente de pares.
+        cache (CacheParesOSRM, optional): Instância de cache a usar.
+        cancelamento (threading.Event, optional): Quando sinalizado, interrompe o cálculo e retorna None.
+        dtype (numpy.dtype): Tipo inteiro da matriz.
+        retornar_mascara (bool): Se True, retorna também a máscara dos arcos exatos.
+
+    Returns:
+        numpy.ndarray or tuple or None: Matriz NxN (e máscara bool NxN se retornar_mascara), ou None em erro/cancelamento.
+    """
+    if metrica not in METRICAS_VALIDAS:
+        raise ValueError("Métrica deve ser 'duration' ou 'distance'.")
+    resultado = _calcular_matrizes_knn(pontos, [metrica], k, progress_callback, usar_cache, cache, cancelamento, dtype)
+    if resultado is None:
+        return (None, None) if retornar_mascara else None
+    matrizes, exatos = resultado
+    return (matrizes[metrica], exatos) if retornar_mascara else matrizes[metrica]
+
+
+def _calcular_matrizes_knn(pontos, metricas, k=K_VIZINHOS_PADRAO, progress_callback=None, usar_cache=True, cache=None, cancelamento=None, dtype=DTYPE_MATRIZ_PADRAO):
+    """
+    Núcleo do modo esparso. Retorna ({metrica: numpy.ndarray}, mascara_exatos) ou None.
+    """
+    n = len(pontos)
+    annotations = ",".join(metricas)
+    url_base = f"{OSRM_SERVER_URL}/table/v1/{PERFIL_OSRM}/"
+
+    necessarios = vizinhos_mais_proximos(pontos, k)
+    if n > 0 and _mascara_validos(pontos[:1])[0]:
+        validos = _mascara_validos(pontos)
+        necessarios[0, validos] = True  # Depósito: todos os arcos de saída e chegada são exatos
+        necessarios[validos, 0] = True
+    np.fill_diagonal(necessarios, False)
+    logging.info(f"Modo esparso (k={k}): {int(necessarios.sum())} arcos exatos necessários de {n * n - n}.")
+
+    matrizes = {m: np.full((n, n), INFINITE_VALUE, dtype=dtype) for m in metricas}
+    exatos = np.zeros((n, n), dtype=bool)
+    faltantes = necessarios.copy()
+
+    if usar_cache and faltantes.any():
+        try:
+            if cache is None:
+                cache = obter_cache_padrao()
+            i_idx, j_idx = np.nonzero(necessarios)
+            orig = [pontos[i] for i in i_idx.tolist()]
+            dest = [pontos[j] for j in j_idx.tolist()]
+            em_todas = np.ones(len(i_idx), dtype=bool)
+            for metrica in metricas:
+                valores, encontrados = cache.buscar_pares(orig, dest, metrica, PERFIL_OSRM)
+                matrizes[metrica][i_idx[encontrados], j_idx[encontrados]] = valores[encontrados]
+                em_todas &= encontrados
+            faltantes[i_idx[em_todas], j_idx[em_todas]] = False
+            exatos[i_idx[em_todas], j_idx[em_todas]] = True
+            logging.info(f"Cache OSRM ({annotations}, esparso): {int(em_todas.sum())} arcos em cache, {int(faltantes.sum())} a consultar.")
+        except Exception as e:
+            logging.warning(f"Falha ao consultar o cache OSRM, seguindo sem cache: {e}")
+            faltantes = necessarios.copy()
+            cache = None
+    elif not usar_cache:
+        cache = None
+
+    tiles = []
+    for origens, destinos in planejar_tiles_esparsos(pontos, faltantes, MAX_TABLE_SIZE):
+        tile = _preparar_tile(pontos, origens, destinos)
+        if tile is not None:
+            tiles.append(tile)
+    custo = estimar_custo_plano([(t['origens'], t['destinos']) for t in tiles])
+    logging.info(f"Plano OSRM esparso para {n} pontos: {custo['requisicoes']} requisições, {custo['celulas']} células calculadas.")
+
+    try:
+        if tiles:
+            # Só os blocos respondidos pelo OSRM viram exatos; os que falharam entram na estimativa abaixo
+            concluidas = _executar_tiles(url_base, tiles, annotations, matrizes, pontos, cache, progress_callback, cancelamento, exatos)
+            if concluidas is None:
+                logging.warning("Cálculo da matriz OSRM esparsa cancelado.")
+                return None
+        np.fill_diagonal(exatos, True)
+
+        # Demais arcos: estimativa calibrada pelos arcos exatos desta mesma execução
+        for metrica, matriz in matrizes.items():
+            fatores = _calibrar_pelos_exatos(pontos, matriz, exatos, metrica)
+            for inicio in range(0, n, BLOCO_ESTIMATIVA):
+                fim = min(inicio + BLOCO_ESTIMATIVA, n)
+                estimados = ~exatos[inicio:fim]
+                if estimados.any():
+                    estimativa = estimar_matriz_haversine(pontos[inicio:fim], metrica, fatores, dtype, destinos=pontos)
+                    matriz[inicio:fim][estimados] = estimativa[estimados]
+            np.fill_diagonal(matriz, 0)
+        if progress_callback:
+            progress_callback(1.0)
+        return matrizes, exatos
+    except Exception as e:
+        logging.error(f"Erro inesperado durante cálculo da matriz OSRM esparsa: {e}")
+        logging.error(traceback.format_exc())
+        return None
+
+
+def _calibrar_pelos_exatos(pontos, matriz, exatos, metrica):
+    """
+    Fator de desvio global (mediana valor/haversine) a partir dos arcos exatos da matriz.
+    Retorna None (usa a calibração do cache) se houver poucas amostras.
+    """
+    arr = np.asarray(pontos, dtype=float).reshape(-1, 2)
+    i_idx, j_idx = np.nonzero(exatos)
+    valores = matriz[i_idx, j_idx].astype(float)
+    hav = _haversine_metros(arr[i_idx, 0], arr[i_idx, 1], arr[j_idx, 0], arr[j_idx, 1])
+    uteis = (hav > 500) & (valores > 0) & (valores < INFINITE_VALUE)
+    if uteis.sum() < MIN_AMOSTRAS_REGIAO:
+        return None
+    fator = float(np.median(valores[uteis] / hav[uteis]))
+    logging.info(f"Fator de desvio '{metrica}' calibrado em {int(uteis.sum())} arcos exatos: {fator:.4f}.")
+    return {metrica: {'global': fator, 'regioes': {}}}
+
+
+# --- Provedor haversine (estimativa sem rede) ---
+_fatores_calibrados = {}
+
+def _haversine_metros(lat1, lon1, lat2, lon2):
+    """Distância de grande círculo em metros (elemento a elemento, com broadcasting; graus)."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RAIO_TERRA_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def _chave_regiao(lat, lon, tamanho=TAMANHO_REGIAO_GRAUS):
+    """Identificador inteiro da célula de calibração de cada ponto (vetorizado)."""
+    return np.floor(np.asarray(lat) / tamanho).astype(np.int64), np.floor(np.asarray(lon) / tamanho).astype(np.int64)
+
+
+def calibrar_fatores_haversine(cache=None, metricas=METRICAS_VALIDAS, tamanho_regiao=TAMANHO_REGIAO_GRAUS):
+    """
+    Calibra, a partir dos pares OSRM já gravados no cache, o fator que converte distância em
+    linha reta (m) em distância por ruas (m) ou tempo de viagem (s), por região.
+
+    Para cada métrica usa a mediana de valor_osrm / haversine, global e por célula de
+    `tamanho_regiao` graus (origem do par). Regiões com poucas amostras usam o fator global.
+
+    Returns:
+        dict: {metrica: {'global': float, 'regioes': {(i, j): float}, 'amostras': int}}
+    """
+    if cache is None:
+        cache = obter_cache_padrao()
+    fatores = {}
+    for metrica in metricas:
+        fator_global = FATORES_HAVERSINE_PADRAO[metrica]
+        regioes = {}
+        amostras = 0
+        dados = cache.listar_pares(metrica, PERFIL_OSRM)
+        if len(dados):
+            hav = _haversine_metros(dados[:, 0], dados[:, 1], dados[:, 2], dados[:, 3])
+            # Pares muito curtos distorcem a razão (acessos, retornos); usa apenas acima de 500 m
+            uteis = (hav > 500) & (dados[:, 4] > 0) & (dados[:, 4] < INFINITE_VALUE)
+            amostras = int(uteis.sum())
+            if amostras:
+                razoes = dados[uteis, 4] / hav[uteis]
+                fator_global = float(np.median(razoes))
+                ri, rj = _chave_regiao(dados[uteis, 0], dados[uteis, 1], tamanho_regiao)
+                for chave in set(zip(ri.tolist(), rj.tolist())):
+                    sel = (ri == chave[0]) & (rj == chave[1])
+                    if sel.sum() >= MIN_AMOSTRAS_REGIAO:
+                        regioes[chave] = float(np.median(razoes[sel]))
+        fatores[metrica] = {'global': fator_global, 'regioes': regioes, 'amostras': amostras}
+        logging.info(f"Fator haversine '{metrica}': global={fator_global:.4f} ({amostras} amostras, {len(regioes)} regiões calibradas).")
+    _fatores_calibrados.clear()
+    _fatores_calibrados.update(fatores)
+    return fatores
+
+
+def _fatores_por_ponto(pontos, metrica, fatores=None, tamanho_regiao=TAMANHO_REGIAO_GRAUS):
+    """Fator de desvio aplicável a cada ponto de origem, de acordo com sua região."""
+    if fatores is None:
+        if not _fatores_calibrados:
+            try:
+                calibrar_fatores_haversine()
+            except Exception as e:
+                logging.warning(f"Não foi possível calibrar fatores haversine pelo cache, usando padrão: {e}")
+        fatores = _fatores_calibrados
+    info = fatores.get(metrica, {'global': FATORES_HAVERSINE_PADRAO[metrica], 'regioes': {}})
+    arr = np.asarray(pontos, dtype=float).reshape(-1, 2)
+    resultado = np.full(len(arr), info['global'])
+    if info['regioes']:
+        ri, rj = _chave_regiao(arr[:, 0], arr[:, 1], tamanho_regiao)
+        for k, chave in enumerate(zip(ri.tolist(), rj.tolist())):
+            resultado[k] = info['regioes'].get(chave, info['global'])
+    return resultado
+
+
+def _mascara_validos(pontos):
+    """Máscara booleana das coordenadas válidas (vetorizada)."""
+    arr = np.asarray(pontos, dtype=float).reshape(-1, 2)
+    return np.isfinite(arr).all(axis=1) & (np.abs(arr[:, 0]) <= 90) & (np.abs(arr[:, 1]) <= 180)
+
+
+def estimar_matriz_haversine(pontos, metrica="distance", fatores=None, dtype=DTYPE_MATRIZ_PADRAO, destinos=None):
+    """
+    Estima a matriz de distâncias (m) ou tempos (s) sem consultar a rede:
+    distância de grande círculo x fator de desvio da região de origem.
+
+    Args:
+        pontos (list): Lista de tuplas (latitude, longitude) — origens.
+        metrica (str): "duration" ou "distance".
+        fatores (dict, optional): Resultado de calibrar_fatores_haversine(); se None usa a
+                                  calibração em memória (calibrando pelo cache na primeira vez).
+        dtype (numpy.dtype): Tipo inteiro da matriz.
+        destinos (list, optional): Destinos, se diferentes das origens (matriz retangular).
+
+    Returns:
+        numpy.ndarray: Matriz len(pontos) x len(destinos), com INFINITE_VALUE para coordenadas inválidas.
+    """
+    origens = np.asarray(pontos, dtype=float).reshape(-1, 2)
+    dest = origens if destinos is None else np.asarray(destinos, dtype=float).reshape(-1, 2)
+    if len(origens) == 0 or len(dest) == 0:
+        return np.zeros((len(origens), len(dest)), dtype=dtype)
+    valores = _haversine_metros(origens[:, None, 0], origens[:, None, 1], dest[None, :, 0], dest[None, :, 1])
+    valores *= _fatores_por_ponto(origens, metrica, fatores)[:, None]
+    valores[~_mascara_validos(origens), :] = INFINITE_VALUE
+    valores[:, ~_mascara_validos(dest)] = INFINITE_VALUE
+    valores = np.nan_to_num(valores, nan=INFINITE_VALUE)
+    return np.minimum(valores, INFINITE_VALUE).astype(dtype)
+
+
+def _dividir(indices, tamanho):
+    """Divide uma lista de índices em pedaços consecutivos de até `tamanho` elementos."""
+    return [indices[i:i + tamanho] for i in range(0, len(indices), tamanho)]
+
+
+def planejar_tiles(linhas, colunas, max_table_size=MAX_TABLE_SIZE):
+    """
+    Planeja os blocos (tiles) de requisições Table que cobrem todos os pares linhas x colunas,
+    respeitando o limite de coordenadas por requisição do servidor (max-table-size).
+
+    - Caso simétrico (mesmo conjunto de linhas e colunas): os pontos são divididos em grupos de
+      max_table_size/2 e cada requisição cobre um par de grupos (A, B) com sources=destinations=A∪B,
+      trazendo de uma vez os blocos A→B, B→A e as diagonais A→A e B→B. Não há requisições
+      separadas para a diagonal e o número de requisições cai para ~k(k-1)/2.
+    - Caso retangular (ex: poucas linhas novas contra todas as colunas): as linhas ocupam o mínimo
+      necessário do limite e o restante é usado para colunas.
+
+    Args:
+        linhas (list): Índices globais de origem.
+        colunas (list): Índices globais de destino.
+        max_table_size (int): Máximo de coordenadas aceitas pelo servidor em uma requisição.
+
+    Returns:
+        list: Lista de tuplas (origens, destinos) com índices globais.
+    """
+    linhas = list(linhas)
+    colunas = list(colunas)
+    if not linhas or not colunas:
+        return []
+    max_table_size = max(2, int(max_table_size))
+
+    uniao = sorted(set(linhas) | set(colunas))
+    if len(uniao) <= max_table_size:
+        return [(linhas, colunas)]
+
+    if set(linhas) == set(colunas):
+        grupos = _dividir(uniao, max_table_size // 2)
+        plano = []
+        for a in range(len(grupos)):
+            for b in range(a + 1, len(grupos)):
+                bloco = grupos[a] + grupos[b]
+                plano.append((bloco, bloco))
+        return plano
+
+    # Caso retangular: reserva para o lado menor o que ele precisa (até metade do limite)
+    if len(linhas) <= len(colunas):
+        tam_linhas = min(len(linhas), max_table_size // 2)
+        tam_colunas = max_table_size - tam_linhas
+    else:
+        tam_colunas = min(len(colunas), max_table_size // 2)
+        tam_linhas = max_table_size - tam_colunas
+    return [(lote_l, lote_c) for lote_l in _dividir(linhas, tam_linhas) for lote_c in _dividir(colunas, tam_colunas)]
+
+
+def estimar_custo_plano(plano):
+    """
+    Estima o custo de um plano de blocos antes de enviá-lo ao OSRM.
+
+    Returns:
+        dict: {'requisicoes', 'coordenadas' (enviadas no total), 'celulas' (sources x destinations),
+               'max_coordenadas' (maior requisição)}
+    """
+    coords_por_req = [len(set(origens) | set(destinos)) for origens, destinos in plano]
+    return {
+        'requisicoes': len(plano),
+        'coordenadas': int(sum(coords_por_req)),
+        'celulas': int(sum(len(o) * len(d) for o, d in plano)),
+        'max_coordenadas': max(coords_por_req) if coords_por_req else 0,
+    }
+
+
+def _preparar_tile(pontos, origens_global, destinos_global):
+    """
+    Valida as coordenadas de um bloco (origens x destinos) e monta os parâmetros da requisição.
+    Cada coordenada é enviada uma única vez; sources/destinations apontam para ela.
+
+    Returns:
+        dict or None: {'coords_str', 'params', 'origens', 'destinos'} com os índices globais válidos,
+                      ou None se o bloco não tiver coordenadas suficientes.
+    """
+    # Combina índices globais de origem e destino, removendo duplicatas e mantendo a ordem
+    combined_indices_global = sorted(set(origens_global) | set(destinos_global))
+    pontos_lote_combinado = [pontos[i] for i in combined_indices_global]
+
+    # Valida as coordenadas *deste lote combinado*
+    osrm_points_coords, indices_validos_no_lote_combinado = _validar_coordenadas(pontos_lote_combinado)
+
+    # Mapeia índices globais válidos para a posição na lista de coordenadas enviada ao OSRM
+    map_global_to_osrm_idx = {combined_indices_global[i]: osrm_idx for osrm_idx, i in enumerate(indices_validos_no_lote_combinado)}
+
+    origens_validas = [idx for idx in origens_global if idx in map_global_to_osrm_idx]
+    destinos_validos = [idx for idx in destinos_global if idx in map_global_to_osrm_idx]
+
+    # Não faz requisição se houver menos de 2 coordenadas válidas ou nenhuma origem/destino
+    if len(osrm_points_coords) < 2 or not origens_validas or not destinos_validos:
+        logging.warning(f"Lote ignorado: coordenadas insuficientes (coords={len(osrm_points_coords)}, sources={len(origens_validas)}, destinations={len(destinos_validos)}). Pulando requisição OSRM.")
+        return None
+
+    return {
+        'coords_str': formatar_coordenadas(osrm_points_coords),
+        'params': {
+            "sources": ";".join(str(map_global_to_osrm_idx[idx]) for idx in origens_validas),
+            "destinations": ";".join(str(map_global_to_osrm_idx[idx]) for idx in destinos_validos),
+        },
+        'origens': origens_validas,
+        'destinos': destinos_validos,
+    }
+
+
+def _buscar_tile(url_base, tile, annotations, cancelamento=None, servidores=None):
+    """Executa a requisição de um bloco (roda nas threads do pool)."""
+    if cancelamento is not None and cancelamento.is_set():
+        return None
+    return _get_osrm_table_batch(url_base, tile['coords_str'], annotations, timeout=DEFAULT_TIMEOUT, extra_params=tile['params'],
+                                 servidores=servidores)
+
+
+def _executar_tiles(url_base, tiles, annotations, matrizes, pontos, cache=None, progress_callback=None, cancelamento=None, exatas=None,
+                    servidores=None):
+    """
+    Envia todos os blocos ao OSRM de forma concorrente (pool limitado a MAX_WORKERS threads)
+    e preenche as matrizes à medida que as respostas chegam.
+
+    O progresso é reportado pelo número de blocos concluídos (sempre crescente), e o
+    preenchimento/gravação em cache acontece apenas na thread chamadora.
+
+    Com vários servidores OSRM, o pool tem MAX_WORKERS threads por servidor e cada bloco vai ao
+    servidor com menos requisições em andamento. Blocos recusados pelos disjuntores (abertos, ou
+    meio-abertos enquanto a requisição de teste está em andamento) falham sem esperar pelo servidor
+    e são preenchidos pela estimativa haversine (MODO_FALHA_OSRM="estimativa") ou o cálculo é
+    abortado com DisjuntorAbertoError (MODO_FALHA_OSRM="falhar"). Se houve recusa, os blocos que
+    esgotaram as tentativas antes de o disjuntor abrir recebem o mesmo tratamento.
+
+    Se `exatas` (máscara bool NxN) for informada, os pares dos blocos preenchidos com a resposta
+    do OSRM são marcados como exatos e os dos blocos que falharam ou foram estimados, como não exatos.
+    `servidores` é o grupo balanceado quando `url_base` não aponta para OSRM_SERVIDORES.
+
+    Returns:
+        int or None: Número de blocos concluídos, ou None se o cálculo foi cancelado.
+    """
+    total = len(tiles)
+    concluidas = 0
+    falhas, houve_recusa = [], False
+    balanceador = obter_balanceador(_servidores_para(url_base, servidores)[0])
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS * len(balanceador.servidores))
+    try:
+        pendentes = {executor.submit(_buscar_tile, url_base, tile, annotations, cancelamento, servidores): tile for tile in tiles}
+        while pendentes:
+            if cancelamento is not None and cancelamento.is_set():
+                for future in pendentes:
+                    future.cancel()
+                return None
+            prontas, _ = wait(pendentes, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in prontas:
+                tile = pendentes.pop(future)
+                concluidas += 1
+                try:
+                    resultado, disjuntor_aberto = future.result(), False
+                except DisjuntorAbertoError:
+                    resultado, disjuntor_aberto = None, True
+                if disjuntor_aberto and MODO_FALHA_OSRM == "falhar":
+                    for pendente in pendentes:
+                        pendente.cancel()
+                    raise DisjuntorAbertoError(f"Servidor OSRM indisponível ({', '.join(balanceador.servidores)}); cálculo abortado.")
+                houve_recusa = houve_recusa or disjuntor_aberto
+                if resultado is None and not disjuntor_aberto:
+                    falhas.append(tile)
+                preenchido = _preencher_tile(matrizes, tile, resultado, pontos, cache, f"{concluidas}/{total}", estimar_falhas=disjuntor_aberto)
+                if exatas is not None:
+                    # O bloco sobrescreve todos os seus pares (inclusive diagonal e pares já exatos)
+                    exatas[np.ix_(tile['origens'], tile['destinos'])] = preenchido
+                if progress_callback:
+                    progress_callback(concluidas / total)
+        if houve_recusa:
+            for tile in falhas:
+                _preencher_tile(matrizes, tile, None, pontos, rotulo="falha antes da abertura do disjuntor", estimar_falhas=True)
+                if exatas is not None:
+                    exatas[np.ix_(tile['origens'], tile['destinos'])] = False
+        return concluidas
+    finally:
+        executor.shutdown(wait=cancelamento is None or not cancelamento.is_set(), cancel_futures=True)
+
+
+def _bloco_para_array(partial_matrix_raw, dtype=DTYPE_MATRIZ_PADRAO):
+    """Converte uma submatriz OSRM (listas com null) em array NumPy, com INFINITE_VALUE no lugar de null."""
+    bloco = np.array(partial_matrix_raw, dtype=float)  # None -> NaN
+    bloco[~np.isfinite(bloco)] = INFINITE_VALUE
+    return bloco.astype(dtype)
+
+
+def _preencher_tile(matrizes, tile, partial_raw, pontos, cache=None, rotulo="", estimar_falhas=False):
+    """
+    Copia a resposta de um bloco para as matrizes finais e grava os pares no cache.
+    Se o bloco falhou e `estimar_falhas` for True, usa a estimativa haversine (não gravada no cache).
+
+    Returns:
+        bool: True se todas as métricas do bloco vieram do OSRM.
+    """
+    destino_ix = np.ix_(tile['origens'], tile['destinos'])
+    if partial_raw is None and estimar_falhas:
+        logging.warning(f"Lote sem resposta do OSRM (Req {rotulo}); preenchendo com estimativa haversine.")
+        origens = [pontos[i] for i in tile['origens']]
+        destinos = [pontos[j] for j in tile['destinos']]
+        for metrica, final_matrix in matrizes.items():
+            final_matrix[destino_ix] = estimar_matriz_haversine(origens, metrica, dtype=final_matrix.dtype, destinos=destinos)
+        return False
+    if partial_raw is None:
+        logging.error(f"Falha ao obter dados do OSRM para o lote (Req {rotulo}). Preenchendo com INFINITE_VALUE e continuando.")
+        # Preenche todos os pares deste lote com INFINITE_VALUE
+        for final_matrix in matrizes.values():
+            final_matrix[destino_ix] = INFINITE_VALUE
+        return False
+
+    # A matriz retornada pelo OSRM com sources/destinations tem shape (len(sources), len(destinations))
+    esperado = (len(tile['origens']), len(tile['destinos']))
+    completo = set(partial_raw) >= set(matrizes)
+    for metrica, partial_matrix_raw in partial_raw.items():
+        final_matrix = matrizes[metrica]
+        try:
+            # OSRM retorna null para rotas impossíveis
+            bloco = _bloco_para_array(partial_matrix_raw, final_matrix.dtype)
+        except (TypeError, ValueError) as e:
+            logging.error(f"Erro: Submatriz OSRM '{metrica}' inválida ({e}). Req {rotulo}")
+            completo = False
+            continue
+        if bloco.shape != esperado:
+            logging.error(f"Erro: Dimensões da matriz OSRM '{metrica}' ({bloco.shape[0]}x{bloco.shape[1] if bloco.ndim > 1 else 0}) "
+                          f"não correspondem aos índices de origem/destino enviados ({esperado[0]}x{esperado[1]}). Req {rotulo}")
+            completo = False
+            continue
+        final_matrix[destino_ix] = bloco
+        if cache is not None:
+            cache.salvar_bloco(
+                [pontos[i] for i in tile['origens']],
+                [pontos[j] for j in tile['destinos']],
+                bloco, metrica, PERFIL_OSRM, valor_invalido=INFINITE_VALUE
+            )
+    return completo
+
+
+class MatrizSobDemanda:
+    """
+    Matriz NxN de tempos/distâncias OSRM calculada sob demanda, com indexação no estilo NumPy.
+
+    A matriz é dividida em blocos de `tamanho_bloco` x `tamanho_bloco`; cada bloco só é buscado
+    (cache de pares e, se faltar, OSRM Table) na primeira vez que uma célula dele é lida, e fica
+    guardado para as leituras seguintes. Os blocos vizinhos do último bloco lido podem ser
+    buscados em segundo plano. Fluxos que só olham parte da matriz (ex: re-sequenciar uma rota,
+    testar uma inserção) pagam apenas pelos blocos que tocam:
+
+        matriz = MatrizSobDemanda(pontos, "distance")
+        custo = matriz[rota[:-1], rota[1:]].sum()   # Só os blocos dos arcos da rota
+        completa = np.asarray(matriz)               # Busca todos os blocos que faltam
+
+    Pares de índices (dois arrays/listas) são lidos ponto a ponto, como em NumPy; com fatias,
+    todos os blocos do retângulo pedido são buscados. Blocos que o OSRM não respondeu são
+    entregues com INFINITE_VALUE (ou a estimativa) e buscados de novo na leitura seguinte.
+
+    A thread de pré-busca é encerrada por `fechar()`, ao sair de um bloco `with` ou quando o
+    objeto é coletado:
+
+        with MatrizSobDemanda(pontos, "distance") as matriz:
+            custo = matriz[rota[:-1], rota[1:]].sum()
+    """
+
+    def __init__(self, pontos, metrica="duration", usar_cache=True, cache=None, dtype=DTYPE_MATRIZ_PADRAO, tamanho_bloco=None, pre_busca=True):
+        """
+        Args:
+            pontos (list): Lista de tuplas (latitude, longitude).
+            metrica (str): "duration" ou "distance".
+            usar_cache (bool): Se True, consulta/grava o cache persistente de pares.
+            cache (CacheParesOSRM, optional): Instância de cache a usar.
+            dtype (numpy.dtype): Tipo inteiro da matriz.
+            tamanho_bloco (int, optional): Lado do bloco; padrão MAX_TABLE_SIZE // 2 (um bloco por requisição).
+            pre_busca (bool): Se True, busca em segundo plano os blocos vizinhos dos blocos lidos.
+        """
+        if metrica not in METRICAS_VALIDAS:
+            raise ValueError("Métrica deve ser 'duration' ou 'distance'.")
+        self.pontos = list(pontos)
+        self.metrica = metrica
+        self.usar_cache = usar_cache
+        self._cache = cache
+        self.tamanho_bloco = max(1, int(tamanho_bloco or MAX_TABLE_SIZE // 2))
+        n = len(self.pontos)
+        n_blocos = -(-n // self.tamanho_bloco)
+        # np.zeros não ocupa RAM para páginas nunca escritas: só os blocos buscados custam memória
+        self._valores = np.zeros((n, n), dtype=dtype)
+        self._carregados = np.zeros((n_blocos, n_blocos), dtype=bool)
+        self._em_andamento = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1) if pre_busca else None
+        # Encerra a pré-busca se o objeto for descartado sem fechar() (o finalizador não referencia self)
+        self._finalizador = weakref.finalize(self, self._executor.shutdown, wait=False, cancel_futures=True) if pre_busca else None
+        self.requisicoes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, rastro):
+        self.fechar()
+        return False
+
+    @property
+    def shape(self):
+        return self._valores.shape
+
+    @property
+    def dtype(self):
+        return self._valores.dtype
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __len__(self):
+        return len(self.pontos)
+
+    @property
+    def fracao_carregada(self):
+        """Fração dos blocos já buscados (0.0 a 1.0)."""
+        with self._lock:
+            return float(self._carregados.mean()) if self._carregados.size else 1.0
+
+    def __getitem__(self, chave):
+        linhas, colunas = self._indices(chave)
+        blocos = self._blocos_de(linhas, colunas)
+        self._garantir_blocos(blocos)
+        if self._executor is not None and blocos:
+            self._agendar_vizinhos(blocos)
+        return self._valores[chave]
+
+    def __array__(self, dtype=None, copy=None):
+        self.carregar_tudo()
+        return self._valores if dtype is None else self._valores.astype(dtype)
+
+    def carregar_tudo(self):
+        """Busca todos os blocos que ainda faltam (equivale ao cálculo completo da matriz)."""
+        n_blocos = self._carregados.shape[0]
+        self._garantir_blocos([(bi, bj) for bi in range(n_blocos) for bj in range(n_blocos)])
+
+    def fechar(self):
+        """Encerra a thread de pré-busca (os blocos já buscados continuam acessíveis)."""
+        if self._finalizador is not None:
+            self._finalizador.detach()
+            self._finalizador = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def _indices(self, chave):
+        """
+        Converte a chave de indexação em (linhas, colunas) globais tocadas.
+        Retorna colunas=None quando linhas e colunas formam pares ponto a ponto (já emparelhados em `linhas`).
+        """
+        n = len(self.pontos)
+        todos = np.arange(n)
+        if not isinstance(chave, tuple):
+            chave = (chave, slice(None))
+        if len(chave) == 1:
+            chave = (chave[0], slice(None))
+        if len(chave) != 2:
+            raise IndexError("MatrizSobDemanda aceita no máximo dois índices.")
+        ind_linhas, ind_colunas = chave
+        linhas = np.atleast_1d(todos[ind_linhas])
+        colunas = np.atleast_1d(todos[ind_colunas])
+        if not isinstance(ind_linhas, slice) and not isinstance(ind_colunas, slice):
+            # Indexação avançada nos dois eixos: NumPy emparelha os índices
+            linhas, colunas = np.broadcast_arrays(linhas, colunas)
+            return np.stack([linhas.ravel(), colunas.ravel()], axis=1), None
+        return linhas, colunas
+
+    def _blocos_de(self, linhas, colunas):
+        b = self.tamanho_bloco
+        if colunas is None:
+            return sorted({(int(i) // b, int(j) // b) for i, j in linhas.tolist()})
+        blocos_l = np.unique(linhas // b).tolist()
+        blocos_c = np.unique(colunas // b).tolist()
+        return [(bi, bj) for bi in blocos_l for bj in blocos_c]
+
+    def _agendar_vizinhos(self, blocos):
+        n_blocos = self._carregados.shape[0]
+        vizinhos = set()
+        for bi, bj in blocos:
+            for di, dj in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                vi, vj = bi + di, bj + dj
+                if 0 <= vi < n_blocos and 0 <= vj < n_blocos:
+                    vizinhos.add((vi, vj))
+        with self._lock:
+            vizinhos = [v for v in vizinhos if not self._carregados[v] and v not in self._em_andamento]
+        if vizinhos:
+            self._executor.submit(self._pre_buscar, sorted(vizinhos))
+
+    def _pre_buscar(self, blocos):
+        try:
+            self._garantir_blocos(blocos)
+        except Exception as e:
+            logging.warning(f"Falha na pré-busca de blocos da matriz sob demanda: {e}")
+
+    def _garantir_blocos(self, blocos):
+        """Busca os blocos ainda não carregados; espera os que outra thread já está buscando."""
+        with self._lock:
+            a_buscar = [b for b in blocos if not self._carregados[b] and b not in self._em_andamento]
+            aguardar = [self._em_andamento[b] for b in blocos if b in self._em_andamento]
+            for b in a_buscar:
+                self._em_andamento[b] = threading.Event()
+        sem_resposta = set(a_buscar)
+        try:
+            if a_buscar:
+                sem_resposta = self._buscar_blocos(a_buscar)
+        finally:
+            with self._lock:
+                for b in a_buscar:
+                    self._carregados[b] = b not in sem_resposta  # Bloco sem resposta do OSRM: buscado de novo depois
+                    self._em_andamento.pop(b).set()
+        for evento in aguardar:
+            evento.wait()
+        with self._lock:
+            falharam = [b for b in blocos if b not in a_buscar and not self._carregados[b] and b not in self._em_andamento]
+        if aguardar and falharam:
+            self._garantir_blocos(falharam)  # A busca da outra thread falhou: tenta nesta
+
+    def _buscar_blocos(self, blocos):
+        """
+        Preenche os blocos a partir do cache e do OSRM (um tile por bloco, em paralelo).
+
+        Returns:
+            set: Blocos com pares que o OSRM não respondeu (falha ou recusa do disjuntor).
+        """
+        b = self.tamanho_bloco
+        n = len(self.pontos)
+        matrizes = {self.metrica: self._valores}
+        faltantes = []
+        for bi, bj in blocos:
+            linhas = np.arange(bi * b, min((bi + 1) * b, n))
+            colunas = np.arange(bj * b, min((bj + 1) * b, n))
+            self._valores[np.ix_(linhas, colunas)] = INFINITE_VALUE
+            falta = linhas[:, None] != colunas[None, :]  # A diagonal não vai ao OSRM
+            diagonal = np.intersect1d(linhas, colunas)
+            self._valores[diagonal, diagonal] = 0
+            faltantes.append((linhas, colunas, falta))
+
+        cache = None
+        if self.usar_cache:
+            try:
+                cache = self._cache if self._cache is not None else obter_cache_padrao()
+                self._cache = cache
+                for k, (linhas, colunas, falta) in enumerate(faltantes):
+                    i_idx, j_idx = np.nonzero(falta)
+                    valores, encontrados = cache.buscar_pares([self.pontos[i] for i in linhas[i_idx].tolist()],
+                                                              [self.pontos[j] for j in colunas[j_idx].tolist()],
+                                                              self.metrica, PERFIL_OSRM)
+                    self._valores[linhas[i_idx[encontrados]], colunas[j_idx[encontrados]]] = valores[encontrados]
+                    falta[i_idx[encontrados], j_idx[encontrados]] = False
+            except Exception as e:
+                logging.warning(f"Falha ao consultar o cache OSRM na matriz sob demanda, seguindo sem cache: {e}")
+                cache = None
+
+        tiles = []
+        for linhas, colunas, falta in faltantes:
+            if not falta.any():
+                continue
+            tile = _preparar_tile(self.pontos, linhas[falta.any(axis=1)].tolist(), colunas[falta.any(axis=0)].tolist())
+            if tile is not None:
+                tiles.append(tile)
+        if not tiles:
+            return set()
+        url_base = f"{OSRM_SERVER_URL}/table/v1/{PERFIL_OSRM}/"
+        logging.info(f"Matriz sob demanda: buscando {len(tiles)} bloco(s) no OSRM ({self.metrica}).")
+        exatas = np.zeros((n, n), dtype=bool)  # Como em _valores, só as páginas tocadas ocupam RAM
+        _executar_tiles(url_base, tiles, self.metrica, matrizes, self.pontos, cache, exatas=exatas)
+        with self._lock:
+            self.requisicoes += len(tiles)
+        return {bloco for bloco, (linhas, colunas, falta) in zip(blocos, faltantes)
+                if (falta & ~exatas[np.ix_(linhas, colunas)]).any()}
+
+
+def calcular_distancias_pares(pares, metrica="duration", usar_cache=True, cache=None, dtype=DTYPE_MATRIZ_PADRAO, osrm_url=None):
+    """
+    Calcula tempo/distância para uma lista arbitrária de pares (origem, destino) com o mínimo de
+    requisições Table, em vez de uma chamada /route por par.
+
+    Os pares viram uma máscara sobre os pontos únicos; os já presentes no cache não são
+    consultados e os demais são cobertos por planejar_tiles_esparsos (sources/destinations).
+    Ex: os trechos consecutivos da rota de um veículo com 40 paradas saem em uma requisição.
+
+    Args:
+        pares (list): Lista de tuplas (origem, destino), cada uma uma tupla (latitude, longitude).
+        metrica (str): "duration", "distance" ou "duration,distance" (ambas na mesma passada).
+        usar_cache (bool): Se True, consulta/grava o cache persistente de pares.
+        cache (CacheParesOSRM, optional): Instância de cache a usar.
+        dtype (numpy.dtype): Tipo inteiro dos valores.
+        osrm_url (str, optional): Servidor(es) OSRM, separados por vírgula; padrão OSRM_SERVIDORES.
+
+    Returns:
+        numpy.ndarray or dict or None: Vetor (len(pares),) na ordem de `pares` (INFINITE_VALUE nos pares
+        sem rota ou com coordenada inválida; 0 quando origem e destino coincidem), ou {metrica: vetor}
+        se várias métricas; None em erro crítico.
+    """
+    metricas = metrica.split(",")
+    for m in metricas:
+        if m not in METRICAS_VALIDAS:
+            raise ValueError("Métrica deve ser 'duration' ou 'distance'.")
+    annotations = ",".join(metricas)
+    if len(pares) == 0:
+        vazios = {m: np.array([], dtype=dtype) for m in metricas}
+        return vazios if len(metricas) > 1 else vazios[metricas[0]]
+
+    # Pontos únicos (pela chave arredondada do cache) e índices de origem/destino de cada par
+    pontos, posicao = [], {}
+    indices = np.empty((len(pares), 2), dtype=np.intp)
+    for k, par in enumerate(pares):
+        for lado, ponto in enumerate(par):
+            ponto = (float(ponto[0]), float(ponto[1]))
+            chave = chave_ponto(ponto) if _mascara_validos([ponto])[0] else ("invalido", len(pontos))
+            if chave not in posicao:
+                posicao[chave] = len(pontos)
+                pontos.append(ponto)
+            indices[k, lado] = posicao[chave]
+    origens, destinos = indices[:, 0], indices[:, 1]
+    n = len(pontos)
+
+    faltantes = np.zeros((n, n), dtype=bool)
+    faltantes[origens, destinos] = True
+    validos = _mascara_validos(pontos)
+    faltantes[~validos, :] = False
+    faltantes[:, ~validos] = False
+    np.fill_diagonal(faltantes, False)
+    matrizes = {m: np.full((n, n), INFINITE_VALUE, dtype=dtype) for m in metricas}
+    for matriz in matrizes.values():
+        np.fill_diagonal(matriz, 0)
+
+    if usar_cache and faltantes.any():
+        try:
+            if cache is None:
+                cache = obter_cache_padrao()
+            i_idx, j_idx = np.nonzero(faltantes)
+            orig = [pontos[i] for i in i_idx.tolist()]
+            dest = [pontos[j] for j in j_idx.tolist()]
+            em_todas = np.ones(len(i_idx), dtype=bool)
+            for m in metricas:
+                valores, encontrados = cache.buscar_pares(orig, dest, m, PERFIL_OSRM)
+                matrizes[m][i_idx[encontrados], j_idx[encontrados]] = valores[encontrados]
+                em_todas &= encontrados
+            faltantes[i_idx[em_todas], j_idx[em_todas]] = False
+            logging.info(f"Cache OSRM ({annotations}, pares): {int(em_todas.sum())} pares em cache, {int(faltantes.sum())} a consultar.")
+        except Exception as e:
+            logging.warning(f"Falha ao consultar o cache OSRM, seguindo sem cache: {e}")
+            cache = None
+    elif not usar_cache:
+        cache = None
+
+    tiles = []
+    for origens_tile, destinos_tile in planejar_tiles_esparsos(pontos, faltantes, MAX_TABLE_SIZE):
+        tile = _preparar_tile(pontos, origens_tile, destinos_tile)
+        if tile is not None:
+            tiles.append(tile)
+    if tiles:
+        logging.info(f"Pares OSRM: {len(pares)} pares ({int(faltantes.sum())} a consultar) em {len(tiles)} requisição(ões) Table.")
+        try:
+            servidores = ler_servidores(osrm_url) if osrm_url else OSRM_SERVIDORES
+            url_base = f"{servidores[0]}/table/v1/{PERFIL_OSRM}/"
+            _executar_tiles(url_base, tiles, annotations, matrizes, pontos, cache, servidores=servidores)
+        except Exception as e:
+            logging.error(f"Erro inesperado durante cálculo de pares OSRM: {e}")
+            logging.error(traceback.format_exc())
+            return None
+
+    resultado = {m: matriz[origens, destinos] for m, matriz in matrizes.items()}
+    return resultado if len(metricas) > 1 else resultado[metricas[0]]
+
+
 def calcular_distancia(ponto_a, ponto_b, provider="osrm", metrica="duration"):
     """
     Calcula a distância ou tempo entre dois pontos específicos.
-    Nota: Menos eficiente que calcular a matriz inteira se precisar de muitos pares.
+    Nota: Faz uma chamada /route por par; para muitos pares use calcular_distancias_pares.
 
     Args:
         ponto_a (tuple): Tupla (latitude, longitude) do ponto de origem.
@@ -334,8 +1601,8 @@ def calcular_distancia(ponto_a, ponto_b, provider="osrm", metrica="duration"):
     lat_a, lon_a = ponto_a
     lat_b, lon_b = ponto_b
 
-    # Formata os pontos para a URL do OSRM: longitude,latitude;longitude,latitude
-    coords_str = f"{lon_a},{lat_a};{lon_b},{lat_b}"
+    # Formata os pontos para a URL do OSRM (polyline6 ou longitude,latitude;longitude,latitude)
+    coords_str = formatar_coordenadas([(lat_a, lon_a), (lat_b, lon_b)])
     # Monta a URL para o serviço 'route'
     url = f"{OSRM_SERVER_URL}/route/v1/driving/{coords_str}"
     params = {
@@ -345,7 +1612,8 @@ def calcular_distancia(ponto_a, ponto_b, provider="osrm", metrica="duration"):
 
     try:
         logging.info(f"Consultando OSRM Route API: {url}")
-        response = requests.get(url, params=params, timeout=30) # Timeout de 30s
+        servidores, caminho = _servidores_para(url)
+        response = balanceador_osrm.get(caminho, servidores, params=params, timeout=30) # Timeout de 30s
         response.raise_for_status()
         data = response.json()
 
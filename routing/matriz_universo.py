@@ -0,0 +1,216 @@
+"""
+Matriz pré-calculada do universo de clientes conhecidos (job offline).
+
+Os clientes mudam pouco de um dia para o outro: todos os locais conhecidos
+(database/coordenadas.csv, tabelas `coordenadas` e `cnpj_enderecos` e o endereço de partida)
+têm suas matrizes de tempo e distância calculadas uma vez e guardadas em .npy. Quando todos
+os pontos do dia já estão no universo, calcular_matriz_distancias monta a matriz do dia por
+indexação NumPy (gather), sem nenhuma chamada ao OSRM. A atualização só consulta as linhas e
+colunas dos clientes novos (mesmo caminho incremental de `anterior` em routing.distancias).
+
+Uso (ex: agendado uma vez por noite):
+    python -m routing.matriz_universo
+"""
+import os
+import sqlite3
+import logging
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+
+from routing import distancias
+from routing.distancias import chave_ponto, _mascara_validos, DTYPE_MATRIZ_PADRAO, METRICAS_VALIDAS
+
+# --- Constantes ---
+UNIVERSO_DIR = os.environ.get(
+    "OSRM_UNIVERSO_DIR",
+    os.path.join(os.path.dirname(__file__), '..', 'database', 'universo')
+)
+CSV_COORDENADAS = os.path.join(os.path.dirname(__file__), '..', 'database', 'coordenadas.csv')
+DB_LOCAIS_PATH = os.environ.get(
+    "WAZELOG_DB_PATH",
+    os.path.join(os.path.dirname(__file__), '..', 'database', 'wazelog.db')
+)
+USAR_UNIVERSO = os.environ.get("OSRM_UNIVERSO", "1") != "0"  # "0" desativa o atalho em calcular_matriz_distancias
+ARQUIVO_PONTOS = "pontos.npy"
+
+_universo = {"diretorio": None, "assinatura": None, "dados": None}
+_universo_lock = threading.Lock()
+
+
+def _ler_tabela(conn, consulta):
+    try:
+        return pd.read_sql_query(consulta, conn)
+    except Exception as e:  # Tabela ausente em bancos antigos
+        logging.info(f"Universo: consulta ignorada ({e}).")
+        return pd.DataFrame(columns=["latitude", "longitude"])
+
+
+def carregar_locais_conhecidos(csv_path=None, db_path=None):
+    """
+    Reúne todos os locais conhecidos: endereço de partida (primeiro), coordenadas.csv e as
+    tabelas `coordenadas` e `cnpj_enderecos` do banco.
+
+    Returns:
+        list: Tuplas (latitude, longitude) únicas (pela chave arredondada do cache) e válidas.
+    """
+    csv_path = csv_path or CSV_COORDENADAS
+    db_path = db_path or DB_LOCAIS_PATH
+    quadros = []
+    if os.path.exists(db_path):
+        conn = sqlite3.connect(db_path, check_same_thread=False)
+        try:
+            quadros.append(_ler_tabela(conn, "SELECT latitude, longitude FROM config WHERE chave = 'endereco_partida'"))
+            quadros.append(_ler_tabela(conn, "SELECT latitude, longitude FROM coordenadas"))
+            quadros.append(_ler_tabela(conn, "SELECT latitude, longitude FROM cnpj_enderecos"))
+        finally:
+            conn.close()
+    if os.path.exists(csv_path):
+        df_csv = pd.read_csv(csv_path, usecols=["Latitude", "Longitude"])
+        quadros.append(df_csv.rename(columns={"Latitude": "latitude", "Longitude": "longitude"}))
+    if not quadros:
+        return []
+
+    coords = pd.concat(quadros, ignore_index=True)[["latitude", "longitude"]]
+    coords = coords.apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    coords = coords[_mascara_validos(coords)]
+    locais, vistos = [], set()
+    for lat, lon in coords.tolist():
+        chave = chave_ponto((lat, lon))
+        if chave not in vistos:
+            vistos.add(chave)
+            locais.append((lat, lon))
+    return locais
+
+
+def _assinatura(diretorio):
+    caminho = os.path.join(diretorio, ARQUIVO_PONTOS)
+    return os.stat(caminho).st_mtime_ns if os.path.exists(caminho) else None
+
+
+def carregar_universo(diretorio=None):
+    """
+    Abre o universo salvo (matrizes com mmap_mode='r'), reaproveitando a última leitura
+    enquanto os arquivos não mudarem.
+
+    Returns:
+        dict or None: {'pontos': ndarray (k, 2), 'indice': {chave_ponto: posição}, 'duration': memmap,
+                       'distance': memmap}, ou None se não houver universo salvo.
+    """
+    diretorio = diretorio or UNIVERSO_DIR
+    assinatura = _assinatura(diretorio)
+    if assinatura is None:
+        return None
+    with _universo_lock:
+        if _universo["diretorio"] == diretorio and _universo["assinatura"] == assinatura:
+            return _universo["dados"]
+        try:
+            pontos = np.load(os.path.join(diretorio, ARQUIVO_PONTOS))
+            dados = {"pontos": pontos, "indice": {chave_ponto(p): i for i, p in enumerate(pontos.tolist())}}
+            for metrica in METRICAS_VALIDAS:
+                matriz = np.load(os.path.join(diretorio, f"{metrica}.npy"), mmap_mode='r')
+                if matriz.shape != (len(pontos), len(pontos)):
+                    raise ValueError(f"matriz '{metrica}' {matriz.shape} não corresponde a {len(pontos)} pontos")
+                dados[metrica] = matriz
+        except Exception as e:
+            logging.error(f"Universo em {diretorio} inválido ou incompleto, ignorando: {e}")
+            dados = None
+        _universo.update(diretorio=diretorio, assinatura=assinatura, dados=dados)
+        return dados
+
+
+def extrair_do_universo(pontos, metricas, dtype=DTYPE_MATRIZ_PADRAO, diretorio=None):
+    """
+    Monta as matrizes dos pontos pedidos por indexação no universo pré-calculado.
+
+    Args:
+        pontos (list): Lista de tuplas (latitude, longitude).
+        metricas (list): Métricas desejadas ("duration" e/ou "distance").
+        dtype (numpy.dtype): Tipo das matrizes retornadas.
+        diretorio (str, optional): Diretório do universo; padrão UNIVERSO_DIR.
+
+    Returns:
+        dict or None: {metrica: numpy.ndarray NxN}, ou None se algum ponto não estiver no universo.
+    """
+    universo = carregar_universo(diretorio)
+    if universo is None:
+        return None
+    indice = universo["indice"]
+    posicoes = [indice.get(chave_ponto(p)) for p in pontos]
+    if any(pos is None for pos in posicoes):
+        return None
+    posicoes = np.asarray(posicoes, dtype=np.intp)
+    return {m: np.asarray(universo[m][np.ix_(posicoes, posicoes)], dtype=dtype) for m in metricas}
+
+
+def atualizar_universo(pontos=None, diretorio=None, progress_callback=None, usar_cache=True):
+    """
+    Calcula (ou atualiza) e grava o universo. Pontos já presentes mantêm suas linhas/colunas;
+    só os pontos novos vão ao OSRM. O universo só é gravado se todos os blocos forem respondidos
+    pelo OSRM: com blocos que falharam ou estimados por haversine, o anterior é mantido. Pares
+    sem rota (null do OSRM) são respostas legítimas e ficam como INFINITE_VALUE.
+
+    Args:
+        pontos (list, optional): Locais do universo; padrão carregar_locais_conhecidos().
+        diretorio (str, optional): Diretório de destino; padrão UNIVERSO_DIR.
+        progress_callback (function, optional): Função para reportar progresso (0.0 a 1.0).
+        usar_cache (bool): Se True, usa também o cache persistente de pares.
+
+    Returns:
+        int or None: Número de pontos no universo salvo, ou None se o cálculo falhar ou tiver pares não exatos.
+    """
+    diretorio = diretorio or UNIVERSO_DIR
+    if pontos is None:
+        pontos = carregar_locais_conhecidos()
+    atual = carregar_universo(diretorio)
+    anterior = None
+    if atual is not None:
+        novos = []
+        vistos = set(atual["indice"])
+        for p in pontos:
+            chave = chave_ponto(p)
+            if chave not in vistos:
+                vistos.add(chave)
+                novos.append(tuple(p))
+        if not novos:
+            logging.info(f"Universo já contém todos os {len(atual['pontos'])} locais conhecidos; nada a atualizar.")
+            return len(atual["pontos"])
+        logging.info(f"Universo: {len(novos)} locais novos além dos {len(atual['pontos'])} existentes.")
+        anterior = {"pontos": atual["pontos"].tolist(), "duration": atual["duration"], "distance": atual["distance"]}
+        pontos = [tuple(p) for p in atual["pontos"].tolist()] + novos
+    if not pontos:
+        logging.warning("Universo: nenhum local conhecido para calcular.")
+        return None
+
+    tempos, dists, exatas = distancias.calcular_matrizes_tempo_distancia(
+        pontos, progress_callback=progress_callback, usar_cache=usar_cache, anterior=anterior,
+        tolerancia_dedup_m=None, retornar_mascara=True
+    )
+    if tempos is None or dists is None:
+        logging.error("Falha ao calcular as matrizes do universo; universo anterior mantido.")
+        return None
+    if not exatas.all():
+        # Estimativas e falhas seriam servidas (e reaproveitadas como `anterior`) como valores do OSRM
+        logging.error(f"Universo com {int((~exatas).sum())} pares sem resposta do OSRM (falha ou estimativa); universo anterior mantido.")
+        return None
+
+    os.makedirs(diretorio, exist_ok=True)
+    # Grava em temporários e renomeia; pontos.npy por último, pois marca a nova versão
+    for nome, dados in (("duration.npy", tempos), ("distance.npy", dists), (ARQUIVO_PONTOS, np.asarray(pontos, dtype=float))):
+        caminho = os.path.join(diretorio, nome)
+        with open(caminho + ".tmp", 'wb') as f:
+            np.save(f, dados)
+        os.replace(caminho + ".tmp", caminho)
+    logging.info(f"Universo salvo em {diretorio}: {len(pontos)} locais.")
+    return len(pontos)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Pré-calcula a matriz de todos os locais conhecidos.")
+    parser.add_argument("--diretorio", default=UNIVERSO_DIR)
+    parser.add_argument("--sem-cache", action="store_true", help="Não usa o cache persistente de pares")
+    args = parser.parse_args()
+    total = atualizar_universo(diretorio=args.diretorio, usar_cache=not args.sem_cache)
+    print(f"Universo com {total} locais." if total is not None else "Falha ao atualizar o universo.")
@@ -0,0 +1,238 @@
+"""
+Cliente assíncrono (asyncio + aiohttp) para a OSRM Table e Route API.
+
+Permite que o backend FastAPI calcule matrizes e geometrias de várias requisições ao mesmo
+tempo sem ocupar uma thread por chamada em andamento. O planejamento dos blocos, o cache
+persistente e o preenchimento das matrizes são os mesmos de routing.distancias.
+"""
+import asyncio
+import logging
+import traceback
+import aiohttp
+import numpy as np
+
+from routing import distancias
+from routing.distancias import (
+    DTYPE_MATRIZ_PADRAO, METRICAS_VALIDAS, MAX_RETRIES, RETRY_DELAY, DEFAULT_TIMEOUT,
+    MAX_WORKERS, PERFIL_OSRM, _extrair_metricas, _preparar_calculo, _preencher_tile, _servidores_para,
+    formatar_coordenadas,
+)
+from routing.disjuntor import obter_disjuntor, tempo_backoff, DisjuntorAbertoError
+from routing.balanceador_osrm import obter_balanceador
+from routing.sessao_http import TIMEOUTS_SERVICO, POOL_MAXSIZE_SERVICO
+
+# --- Constantes ---
+MAX_CONCORRENCIA = MAX_WORKERS  # Requisições OSRM simultâneas por chamada (semáforo)
+
+
+def criar_sessao():
+    """
+    Cria uma aiohttp.ClientSession com pool de conexões por host e timeouts do serviço OSRM.
+    Quem cria a sessão é responsável por fechá-la (ex: `async with criar_sessao() as sessao:`).
+    """
+    conexao, leitura = TIMEOUTS_SERVICO["osrm"]
+    conector = aiohttp.TCPConnector(limit=POOL_MAXSIZE_SERVICO["osrm"] * 4, limit_per_host=POOL_MAXSIZE_SERVICO["osrm"])
+    return aiohttp.ClientSession(connector=conector, timeout=aiohttp.ClientTimeout(sock_connect=conexao, sock_read=leitura))
+
+
+async def _get_json(sessao, url, params=None, semaforo=None, timeout=DEFAULT_TIMEOUT):
+    """
+    GET com retentativas (timeouts, erros de conexão e HTTP 5xx). Erros 4xx não são retentados.
+    Cada tentativa vai ao servidor OSRM com menos requisições em andamento (routing.balanceador_osrm).
+
+    Returns:
+        dict or None: Corpo JSON da resposta, ou None se todas as tentativas falharem.
+
+    Raises:
+        DisjuntorAbertoError: Se o disjuntor de todos os servidores recusar a requisição.
+    """
+    semaforo = semaforo or asyncio.Semaphore(MAX_CONCORRENCIA)
+    servidores, caminho = _servidores_para(url)
+    balanceador = obter_balanceador(servidores)
+    for attempt in range(1, MAX_RETRIES + 1):
+        # O servidor só é reservado depois da vaga no semáforo, para que as requisições na fila
+        # não contem como "em andamento" no balanceador
+        async with semaforo:
+            servidor = balanceador.adquirir()
+            if servidor is None:
+                logging.warning(f"Disjuntor OSRM aberto ({', '.join(servidores)}): requisição assíncrona recusada.")
+                raise DisjuntorAbertoError(f"Requisição recusada pelo disjuntor ({', '.join(servidores)}).")
+            disjuntor = obter_disjuntor(servidor)
+            url = f"{servidor}{caminho}"
+            try:
+                async with sessao.get(url, params=params, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+                    if 400 <= resp.status < 500:
+                        disjuntor.registrar_sucesso()  # O servidor respondeu
+                        logging.error(f"Erro HTTP {resp.status} do OSRM (assíncrono), sem retentativa: {url[:200]}")
+                        return None
+                    resp.raise_for_status()
+                    data = await resp.json(content_type=None)
+                    disjuntor.registrar_sucesso()
+                    return data
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                disjuntor.registrar_falha()
+                logging.warning(f"Falha na requisição OSRM assíncrona (Tentativa {attempt}/{MAX_RETRIES}): {e!r}")
+            finally:
+                balanceador.liberar(servidor)
+        if attempt < MAX_RETRIES:
+            await asyncio.sleep(tempo_backoff(attempt, maximo=RETRY_DELAY))  # Fora do semáforo e do balanceador
+    logging.error(f"Falha definitiva na requisição OSRM assíncrona após {MAX_RETRIES} tentativas: {url[:200]}")
+    return None
+
+
+async def _get_json_ou_none(sessao, url, params=None, semaforo=None, timeout=DEFAULT_TIMEOUT):
+    """_get_json para consultas avulsas (Route/Table): a recusa do disjuntor também vira None."""
+    try:
+        return await _get_json(sessao, url, params, semaforo, timeout)
+    except DisjuntorAbertoError:
+        return None
+
+
+async def _buscar_tile_async(sessao, url_base, tile, annotations, semaforo):
+    """
+    Busca um bloco da Table API.
+
+    Returns:
+        tuple: (tile, dict {metrica: matriz} ou None, True se o disjuntor recusou a requisição).
+    """
+    params = {"annotations": annotations}
+    params.update(tile['params'])
+    try:
+        data = await _get_json(sessao, f"{url_base}{tile['coords_str']}", params, semaforo)
+    except DisjuntorAbertoError:
+        return tile, None, True
+    if data is None:
+        return tile, None, False
+    return tile, _extrair_metricas(data, annotations), False
+
+
+async def calcular_matriz_distancias_async(pontos, metrica="duration", progress_callback=None, usar_cache=True, cache=None, dtype=DTYPE_MATRIZ_PADRAO, sessao=None, max_concorrencia=MAX_CONCORRENCIA):
+    """
+    Versão assíncrona de calcular_matriz_distancias (provedor OSRM).
+
+    Args:
+        pontos (list): Lista de tuplas (latitude, longitude).
+        metrica (str): "duration", "distance" ou "duration,distance" (ambas na mesma passada).
+        progress_callback (function, optional): Função para reportar progresso (0.0 a 1.0).
+        usar_cache (bool): Se True, consulta/grava o cache persistente de pares.
+        cache (CacheParesOSRM, optional): Instância de cache a usar.
+        dtype (numpy.dtype): Tipo inteiro da matriz.
+        sessao (aiohttp.ClientSession, optional): Sessão compartilhada; se None, uma é criada e fechada aqui.
+        max_concorrencia (int): Máximo de requisições OSRM simultâneas por servidor.
+
+    Returns:
+        numpy.ndarray or dict or None: Matriz NxN (ou {metrica: matriz} se várias métricas), ou None em erro crítico.
+    """
+    metricas = metrica.split(",")
+    for m in metricas:
+        if m not in METRICAS_VALIDAS:
+            raise ValueError("Métrica deve ser 'duration' ou 'distance'.")
+    n = len(pontos)
+    if n == 0:
+        logging.warning("Lista de pontos vazia.")
+        vazias = {m: np.array([[]]) for m in metricas}
+        return vazias if len(metricas) > 1 else vazias[metricas[0]]
+
+    # Consulta ao cache (SQLite) e planejamento em thread, para não bloquear o loop de eventos
+    matrizes, tiles, cache, _ = await asyncio.to_thread(_preparar_calculo, pontos, metricas, usar_cache, cache, dtype)
+    annotations = ",".join(metricas)
+    url_base = f"{distancias.OSRM_SERVER_URL}/table/v1/{PERFIL_OSRM}/"
+
+    if tiles:
+        balanceador = obter_balanceador(_servidores_para(url_base)[0])
+        semaforo = asyncio.Semaphore(max_concorrencia * len(balanceador.servidores))
+        sessao_propria = sessao is None
+        if sessao_propria:
+            sessao = criar_sessao()
+        try:
+            tarefas = [asyncio.ensure_future(_buscar_tile_async(sessao, url_base, tile, annotations, semaforo)) for tile in tiles]
+            total = len(tiles)
+            concluidas = 0
+            falhas, houve_recusa = [], False
+            try:
+                for tarefa in asyncio.as_completed(tarefas):
+                    tile, resultado, estimar = await tarefa
+                    concluidas += 1
+                    if estimar and distancias.MODO_FALHA_OSRM == "falhar":
+                        raise DisjuntorAbertoError(f"Servidor OSRM indisponível ({', '.join(balanceador.servidores)}); cálculo abortado.")
+                    houve_recusa = houve_recusa or estimar
+                    if resultado is None and not estimar:
+                        falhas.append(tile)
+                    await asyncio.to_thread(_preencher_tile, matrizes, tile, resultado, pontos, cache, f"{concluidas}/{total}", estimar)
+                    if progress_callback:
+                        progress_callback(concluidas / total)
+            finally:
+                # Em erro (ex: disjuntor aberto no modo "falhar"), os blocos restantes não podem
+                # continuar usando a sessão: são cancelados e aguardados antes de seguir
+                pendentes = [t for t in tarefas if not t.done()]
+                for t in pendentes:
+                    t.cancel()
+                await asyncio.gather(*pendentes, return_exceptions=True)
+            if houve_recusa:
+                # Blocos que esgotaram as tentativas antes de o disjuntor abrir (ver distancias._executar_tiles)
+                for tile in falhas:
+                    await asyncio.to_thread(_preencher_tile, matrizes, tile, None, pontos, None, "falha antes da abertura do disjuntor", True)
+        except Exception as e:
+            logging.error(f"Erro inesperado durante cálculo assíncrono da matriz OSRM: {e}")
+            logging.error(traceback.format_exc())
+            return None
+        finally:
+            if sessao_propria:
+                await sessao.close()
+    elif progress_callback:
+        progress_callback(1.0)
+
+    return matrizes if len(metricas) > 1 else matrizes[metricas[0]]
+
+
+async def consultar_osrm_route_async(coordenadas, osrm_url=None, sessao=None, semaforo=None):
+    """
+    Versão assíncrona de apis_externas.consultar_osrm_route (rota completa com geometria).
+
+    Returns:
+        dict: Resposta da API OSRM ou None em caso de erro.
+    """
+    if not coordenadas or len(coordenadas) < 2:
+        return None
+    osrm_url = osrm_url or distancias.OSRM_SERVER_URL
+    coords_str = formatar_coordenadas(coordenadas)
+    params = {"overview": "full", "geometries": "geojson", "steps": "true"}
+    if sessao is None:
+        async with criar_sessao() as sessao_local:
+            return await _get_json_ou_none(sessao_local, f"{osrm_url}/route/v1/driving/{coords_str}", params, semaforo, timeout=10)
+    return await _get_json_ou_none(sessao, f"{osrm_url}/route/v1/driving/{coords_str}", params, semaforo, timeout=10)
+
+
+async def consultar_osrm_table_async(coordenadas, osrm_url=None, sessao=None, semaforo=None):
+    """
+    Versão assíncrona de apis_externas.consultar_osrm_table (uma única requisição, sem blocos).
+
+    Returns:
+        dict: Resposta da API OSRM ou None em caso de erro.
+    """
+    if not coordenadas or len(coordenadas) < 2:
+        return None
+    osrm_url = osrm_url or distancias.OSRM_SERVER_URL
+    coords_str = formatar_coordenadas(coordenadas)
+    params = {"annotations": "duration,distance"}
+    if sessao is None:
+        async with criar_sessao() as sessao_local:
+            return await _get_json_ou_none(sessao_local, f"{osrm_url}/table/v1/driving/{coords_str}", params, semaforo, timeout=20)
+    return await _get_json_ou_none(sessao, f"{osrm_url}/table/v1/driving/{coords_str}", params, semaforo, timeout=20)
+
+
+async def consultar_rotas_async(rotas, osrm_url=None, sessao=None, max_concorrencia=MAX_CONCORRENCIA):
+    """
+    Busca as geometrias de várias rotas (ex: uma por veículo da frota) simultaneamente.
+
+    Args:
+        rotas (list): Lista de rotas, cada uma uma lista de tuplas (lat, lon) na ordem de visita.
+
+    Returns:
+        list: Respostas da API OSRM na mesma ordem de `rotas` (None para as que falharem).
+    """
+    semaforo = asyncio.Semaphore(max_concorrencia)
+    if sessao is None:
+        async with criar_sessao() as sessao_local:
+            return await asyncio.gather(*(consultar_osrm_route_async(r, osrm_url, sessao_local, semaforo) for r in rotas))
+    return await asyncio.gather(*(consultar_osrm_route_async(r, osrm_url, sessao, semaforo) for r in rotas))
@@ -0,0 +1,229 @@
+"""
+Servidor OSRM simulado para testes e benchmarks sem Docker e sem rede.
+
+Implementa os endpoints usados pelo projeto ({coordinates} como lon,lat;... ou polyline/polyline6):
+    /table/v1/{perfil}/{lon,lat;...}?annotations=duration,distance&sources=...&destinations=...
+    /route/v1/{perfil}/{lon,lat;...}?overview=full|false&geometries=geojson&steps=true|false
+
+As respostas vêm da estimativa haversine x fator de desvio padrão (routing.distancias), no
+mesmo formato JSON do OSRM. Latência, taxa de erro (HTTP 503) e max-table-size são
+configuráveis para exercitar retentativas, disjuntor e planejamento de blocos.
+
+Uso:
+    python -m routing.osrm_local.servidor_simulado --porta 5000 --latencia 0.05 --taxa-erro 0.01
+    python -m routing.osrm_local.servidor_simulado --benchmark 500
+"""
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from routing.distancias import estimar_matriz_haversine, ler_coordenadas, FATORES_HAVERSINE_PADRAO, MAX_TABLE_SIZE
+
+# --- Constantes ---
+# Fatores fixos (sem calibração pelo cache) para respostas reprodutíveis
+FATORES_SIMULADOR = {m: {'global': f, 'regioes': {}} for m, f in FATORES_HAVERSINE_PADRAO.items()}
+PONTOS_GEOMETRIA = 10  # Pontos intermediários por trecho na geometria GeoJSON da rota
+
+
+def _erro(codigo, mensagem, status=400):
+    return status, {"code": codigo, "message": mensagem}
+
+
+def _ler_coordenadas(texto):
+    """Converte 'lon,lat;lon,lat', 'polyline(...)' ou 'polyline6(...)' em array (N, 2) de (lat, lon); None se inválido."""
+    try:
+        pontos = ler_coordenadas(texto)
+    except ValueError:
+        return None
+    if not pontos:
+        return None
+    arr = np.array(pontos, dtype=float)
+    if not np.isfinite(arr).all() or (np.abs(arr[:, 0]) > 90).any() or (np.abs(arr[:, 1]) > 180).any():
+        return None
+    return arr
+
+
+def _ler_indices(params, nome, n):
+    """Lê sources/destinations ('all' ou '0;2;5'); None se algum índice estiver fora do intervalo."""
+    valor = params.get(nome, ["all"])[0]
+    if valor == "all":
+        return list(range(n))
+    indices = [int(i) for i in valor.split(';')]
+    return indices if all(0 <= i < n for i in indices) else None
+
+
+def responder_table(coords, params, max_table_size=MAX_TABLE_SIZE):
+    """Monta a resposta da Table API. Returns: (status HTTP, corpo dict)."""
+    if len(coords) > max_table_size:
+        return _erro("TooBig", f"Too many table coordinates (max {max_table_size})")
+    origens = _ler_indices(params, "sources", len(coords))
+    destinos = _ler_indices(params, "destinations", len(coords))
+    if origens is None or destinos is None:
+        return _erro("InvalidOptions", "Source or destination indices are greater than number of coordinates")
+    corpo = {"code": "Ok"}
+    for metrica in params.get("annotations", ["duration"])[0].split(','):
+        if metrica not in FATORES_SIMULADOR:
+            return _erro("InvalidOptions", f"Unknown annotation '{metrica}'")
+        valores = estimar_matriz_haversine(coords[origens], metrica, FATORES_SIMULADOR, np.float64, destinos=coords[destinos])
+        corpo[f"{metrica}s"] = np.round(valores, 1).tolist()
+    corpo["sources"] = [{"location": [lon, lat]} for lat, lon in coords[origens].tolist()]
+    corpo["destinations"] = [{"location": [lon, lat]} for lat, lon in coords[destinos].tolist()]
+    return 200, corpo
+
+
+def responder_route(coords, params):
+    """Monta a resposta da Route API (uma rota passando pelos pontos na ordem). Returns: (status, corpo)."""
+    if len(coords) < 2:
+        return _erro("InvalidQuery", "Route requires at least two coordinates")
+    legs, geometria = [], []
+    for a, b in zip(coords[:-1], coords[1:]):
+        distancia = float(estimar_matriz_haversine([a], "distance", FATORES_SIMULADOR, np.float64, destinos=[b])[0, 0])
+        duracao = float(estimar_matriz_haversine([a], "duration", FATORES_SIMULADOR, np.float64, destinos=[b])[0, 0])
+        legs.append({"distance": round(distancia, 1), "duration": round(duracao, 1), "steps": [], "summary": ""})
+        passos = np.linspace(0, 1, PONTOS_GEOMETRIA + 1)[:-1]  # Reta interpolada; o ponto final entra no próximo trecho
+        geometria.extend([[float(a[1] + t * (b[1] - a[1])), float(a[0] + t * (b[0] - a[0]))] for t in passos])
+    geometria.append([float(coords[-1][1]), float(coords[-1][0])])
+    rota = {
+        "distance": round(sum(l["distance"] for l in legs), 1),
+        "duration": round(sum(l["duration"] for l in legs), 1),
+        "legs": legs,
+        "weight": round(sum(l["duration"] for l in legs), 1),
+        "weight_name": "routability",
+    }
+    if params.get("overview", ["simplified"])[0] != "false":
+        rota["geometry"] = {"type": "LineString", "coordinates": geometria}
+    waypoints = [{"location": [lon, lat], "name": ""} for lat, lon in coords.tolist()]
+    return 200, {"code": "Ok", "routes": [rota], "waypoints": waypoints}
+
+
+class _Manipulador(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, como o osrm-routed
+
+    def do_GET(self):
+        config = self.server.config
+        with self.server.lock:
+            self.server.contadores["requisicoes"] += 1
+        if config["latencia"] > 0:
+            time.sleep(config["latencia"])
+        if config["taxa_erro"] > 0 and self.server.rng.random() < config["taxa_erro"]:
+            with self.server.lock:
+                self.server.contadores["erros"] += 1
+            return self._enviar(503, {"code": "ServiceUnavailable", "message": "Erro simulado"})
+
+        partes = urlsplit(self.path)
+        params = parse_qs(partes.query)
+        segmentos = partes.path.strip('/').split('/')
+        if len(segmentos) != 4 or segmentos[1] != "v1" or segmentos[0] not in ("table", "route"):
+            return self._enviar(*_erro("InvalidUrl", f"URL string malformed: {partes.path}"))
+        coords = _ler_coordenadas(segmentos[3])
+        if coords is None:
+            return self._enviar(*_erro("InvalidQuery", "Query string malformed"))
+        if segmentos[0] == "table":
+            with self.server.lock:
+                self.server.contadores["table"] += 1
+            return self._enviar(*responder_table(coords, params, config["max_table_size"]))
+        with self.server.lock:
+            self.server.contadores["route"] += 1
+        return self._enviar(*responder_route(coords, params))
+
+    def _enviar(self, status, corpo):
+        dados = json.dumps(corpo).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(dados)))
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def log_message(self, formato, *args):
+        logging.debug(f"Servidor OSRM simulado: {formato % args}")
+
+
+class ServidorOSRMSimulado:
+    """
+    Servidor HTTP em thread de fundo. Pode ser usado como context manager:
+
+        with ServidorOSRMSimulado(max_table_size=100) as servidor:
+            distancias.OSRM_SERVER_URL = servidor.url
+    """
+
+    def __init__(self, host="127.0.0.1", porta=0, latencia=0.0, taxa_erro=0.0, max_table_size=MAX_TABLE_SIZE, semente=None):
+        self._httpd = ThreadingHTTPServer((host, porta), _Manipulador)
+        self._httpd.daemon_threads = True
+        self._httpd.config = {"latencia": latencia, "taxa_erro": taxa_erro, "max_table_size": max_table_size}
+        self._httpd.rng = random.Random(semente)
+        self._httpd.lock = threading.Lock()
+        self._httpd.contadores = {"requisicoes": 0, "table": 0, "route": 0, "erros": 0}
+        self._thread = None
+
+    @property
+    def url(self):
+        host, porta = self._httpd.server_address[:2]
+        return f"http://{host}:{porta}"
+
+    @property
+    def contadores(self):
+        with self._httpd.lock:
+            return dict(self._httpd.contadores)
+
+    def configurar(self, **kwargs):
+        """Altera latencia, taxa_erro ou max_table_size com o servidor em execução."""
+        self._httpd.config.update(kwargs)
+
+    def iniciar(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def parar(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.iniciar()
+
+    def __exit__(self, *exc):
+        self.parar()
+
+
+def _benchmark(n_pontos, servidor):
+    """Mede o tempo de calcular_matrizes_tempo_distancia contra o servidor simulado."""
+    from routing import distancias
+    rng = np.random.default_rng(0)
+    pontos = list(zip(rng.uniform(-23.7, -23.4, n_pontos).tolist(), rng.uniform(-46.8, -46.4, n_pontos).tolist()))
+    distancias.OSRM_SERVER_URL = servidor.url
+    inicio = time.perf_counter()
+    tempos, _ = distancias.calcular_matrizes_tempo_distancia(pontos, usar_cache=False)
+    duracao = time.perf_counter() - inicio
+    contadores = servidor.contadores
+    print(f"{n_pontos} pontos: {duracao:.2f}s, {contadores['table']} requisições Table, "
+          f"{contadores['erros']} erros simulados, matriz {'ok' if tempos is not None else 'FALHOU'}.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Servidor OSRM simulado (haversine) para testes e benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=5000)
+    parser.add_argument("--latencia", type=float, default=0.0, help="Segundos de atraso por requisição")
+    parser.add_argument("--taxa-erro", type=float, default=0.0, help="Fração de requisições respondidas com HTTP 503")
+    parser.add_argument("--max-table-size", type=int, default=MAX_TABLE_SIZE)
+    parser.add_argument("--benchmark", type=int, metavar="N", help="Calcula uma matriz NxN contra o servidor e sai")
+    args = parser.parse_args()
+
+    servidor = ServidorOSRMSimulado(args.host, 0 if args.benchmark else args.porta, args.latencia,
+                                    args.taxa_erro, args.max_table_size, semente=0)
+    if args.benchmark:
+        with servidor:
+            _benchmark(args.benchmark, servidor)
+    else:
+        print(f"Servidor OSRM simulado em {servidor.url} (Ctrl+C para parar)")
+        try:
+            servidor._httpd.serve_forever()
+        except KeyboardInterrupt:
+            servidor.parar()
@@ -0,0 +1,130 @@
+"""
+Portfólio de solvers para o CVRP (multi-start em processos).
+
+A busca do OR-Tools usa um único núcleo, e estratégias diferentes vencem em dias diferentes.
+Aqui K variantes de solver_cvrp (estratégia inicial, metaheurística e semente) rodam ao mesmo
+tempo em um pool de processos sobre a mesma entrada, com o mesmo tempo limite; a melhor
+solução é mantida. Em um servidor com 8 núcleos, os núcleos ociosos viram planos melhores
+sem aumentar o tempo de espera.
+
+O RoutingModel não tem parâmetro de semente aleatória: a semente de uma variante embaralha
+a ordem dos pedidos (e da matriz) antes da resolução, o que muda a trajetória da busca;
+os índices do resultado são devolvidos na ordem original.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from routing.cvrp import solver_cvrp, PRESET_PADRAO, MAX_PROCESSOS
+from routing.utils import get_logger
+
+# --- Constantes ---
+# Variantes (primeira solução, metaheurística, semente), na ordem em que entram no portfólio
+PORTFOLIO_PADRAO = [
+    ("PATH_CHEAPEST_ARC", "GUIDED_LOCAL_SEARCH", None),
+    ("SAVINGS", "GUIDED_LOCAL_SEARCH", None),
+    ("PARALLEL_CHEAPEST_INSERTION", "GUIDED_LOCAL_SEARCH", None),
+    ("PATH_CHEAPEST_ARC", "TABU_SEARCH", None),
+    ("CHRISTOFIDES", "SIMULATED_ANNEALING", None),
+    ("PATH_CHEAPEST_ARC", "GUIDED_LOCAL_SEARCH", 1),
+    ("SAVINGS", "GUIDED_LOCAL_SEARCH", 2),
+    ("LOCAL_CHEAPEST_INSERTION", "GUIDED_LOCAL_SEARCH", 3),
+]
+
+
+def custo_rotas(rotas_df, matriz_distancias, depot_index=0):
+    """
+    Distância total das rotas de um resultado de solver_cvrp: depósito -> paradas na ordem de
+    'Sequencia' -> depósito (o mesmo objetivo minimizado pelo solver).
+
+    Returns:
+        float: Custo total, ou np.inf se o resultado estiver vazio.
+    """
+    if rotas_df is None or rotas_df.empty:
+        return np.inf
+    matriz = np.asarray(matriz_distancias)
+    total = 0
+    for _, grupo in rotas_df.groupby('Veículo', sort=False):
+        seq = [depot_index] + grupo.sort_values('Sequencia')['Node_Index_OR'].astype(int).tolist() + [depot_index]
+        total += matriz[seq[:-1], seq[1:]].sum()
+    return float(total)
+
+
+def _resolver_variante(pedidos, frota, matriz, variante, kwargs):
+    """Executado em um processo de trabalho: resolve uma variante do portfólio com solver_cvrp."""
+    primeira_solucao, metaheuristica, semente = variante
+    permutacao = None
+    if semente is not None:
+        permutacao = np.random.default_rng(semente).permutation(len(pedidos))
+        nos = np.concatenate([[0], permutacao + 1])
+        pedidos, matriz = pedidos.iloc[permutacao].reset_index(drop=True), matriz[np.ix_(nos, nos)]
+    rotas = solver_cvrp(pedidos, frota, matriz, primeira_solucao=primeira_solucao, metaheuristica=metaheuristica, **kwargs)
+    if permutacao is not None and rotas is not None and not rotas.empty:
+        rotas['Pedido_Index_DF'] = permutacao[rotas['Pedido_Index_DF'].to_numpy(dtype=int)]
+        rotas['Node_Index_OR'] = rotas['Pedido_Index_DF'] + 1
+    return rotas
+
+
+def solver_cvrp_portfolio(pedidos, frota, matriz_distancias, k=None, variantes=None, max_processos=MAX_PROCESSOS,
+                          ajuste_capacidade_pct=100, preset=PRESET_PADRAO, tempo_limite=None,
+                          pos_processamento=False, tipo_heuristica='2opt', kwargs_heuristica=None):
+    """
+    Resolve o CVRP com K variantes de solver_cvrp em paralelo e mantém a melhor solução
+    (mais pedidos roteirizados; em empate, menor distância total).
+
+    Args:
+        pedidos (pd.DataFrame): Pedidos, na mesma ordem dos nós 1..n da matriz.
+        frota (pd.DataFrame): Frota.
+        matriz_distancias (np.ndarray): Matriz de distâncias com o depósito no índice 0.
+        k (int, optional): Número de variantes; padrão min(max_processos, len(variantes)), no mínimo 1.
+        variantes (list, optional): Tuplas (primeira solução, metaheurística, semente ou None); padrão PORTFOLIO_PADRAO.
+        max_processos (int): Processos simultâneos; 1 resolve as variantes em sequência (K vezes o tempo limite).
+        ajuste_capacidade_pct, preset, tempo_limite, pos_processamento, tipo_heuristica, kwargs_heuristica:
+            Repassados a solver_cvrp em todas as variantes.
+
+    Returns:
+        pd.DataFrame: Resultado da melhor variante, no formato de solver_cvrp. `attrs` traz
+        'variante' e 'custo' da vencedora.
+    """
+    logger = get_logger(__name__)
+    variantes = list(variantes or PORTFOLIO_PADRAO)
+    if k is None:
+        k = max(1, min(max_processos, len(variantes)))
+    variantes = variantes[:k]
+    pedidos = pedidos.copy().reset_index(drop=True)
+    matriz = np.asarray(matriz_distancias)
+    kwargs_solver = {
+        'ajuste_capacidade_pct': ajuste_capacidade_pct, 'preset': preset, 'tempo_limite': tempo_limite,
+        'pos_processamento': pos_processamento, 'tipo_heuristica': tipo_heuristica, 'kwargs_heuristica': kwargs_heuristica,
+    }
+    logger.info(f"CVRP Portfólio: {len(variantes)} variantes em até {max_processos} processos.")
+
+    if max_processos > 1 and len(variantes) > 1:
+        with ProcessPoolExecutor(max_workers=min(max_processos, len(variantes))) as executor:
+            futuros = [executor.submit(_resolver_variante, pedidos, frota, matriz, v, kwargs_solver) for v in variantes]
+            resultados = []
+            for variante, futuro in zip(variantes, futuros):
+                try:
+                    resultados.append(futuro.result())
+                except Exception as e:
+                    logger.error(f"CVRP Portfólio: falha na variante {variante}: {e}")
+                    resultados.append(pd.DataFrame())
+    else:
+        if len(variantes) > 1:
+            logger.warning("CVRP Portfólio: um único processo; as variantes serão resolvidas em sequência.")
+        resultados = [_resolver_variante(pedidos, frota, matriz, v, kwargs_solver) for v in variantes]
+
+    melhor, melhor_chave = pd.DataFrame(), None
+    for variante, rotas in zip(variantes, resultados):
+        custo = custo_rotas(rotas, matriz)
+        atendidos = 0 if rotas is None or rotas.empty else len(rotas)
+        logger.info(f"CVRP Portfólio: variante {variante}: {atendidos} pedidos, custo {custo}.")
+        chave = (-atendidos, custo)
+        if atendidos and (melhor_chave is None or chave < melhor_chave):
+            melhor, melhor_chave = rotas, chave
+            melhor.attrs = {'variante': variante, 'custo': custo}
+    if melhor_chave is None:
+        logger.warning("CVRP Portfólio: nenhuma variante encontrou solução.")
+    else:
+        logger.info(f"CVRP Portfólio: melhor variante {melhor.attrs['variante']} (custo {melhor.attrs['custo']}).")
+    return melhor
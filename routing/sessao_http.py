@@ -0,0 +1,78 @@
+"""
+Sessões HTTP compartilhadas (requests.Session) para todo o tráfego de saída:
+OSRM, geocodificação, consultas de CNPJ e APIs externas.
+
+Cada serviço tem uma sessão própria com pool de conexões por host e keep-alive, de modo que
+milhares de chamadas pequenas (ex: blocos da Table API) reaproveitam as conexões TCP/TLS em
+vez de abrir uma nova a cada requisição.
+"""
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- Constantes ---
+# (timeout de conexão, timeout de leitura) em segundos, por serviço
+TIMEOUTS_SERVICO = {
+    "osrm": (5, 60),
+    "geocodificacao": (5, 10),
+    "cnpj": (5, 10),
+    "externo": (5, 10),
+}
+# Conexões simultâneas mantidas por host; o OSRM recebe blocos em paralelo (MAX_WORKERS threads)
+POOL_MAXSIZE_SERVICO = {
+    "osrm": int(os.environ.get("OSRM_POOL_MAXSIZE", 16)),
+    "geocodificacao": 4,
+    "cnpj": 4,
+    "externo": 4,
+}
+POOL_HOSTS = 10  # Número de hosts distintos com pool mantido por sessão
+SERVICO_PADRAO = "externo"
+
+_sessoes = {}
+_sessoes_lock = threading.Lock()
+
+
+def obter_sessao(servico=SERVICO_PADRAO):
+    """
+    Retorna a sessão compartilhada do serviço (criada sob demanda).
+
+    Args:
+        servico (str): "osrm", "geocodificacao", "cnpj" ou "externo".
+
+    Returns:
+        requests.Session: Sessão com HTTPAdapter dimensionado para o serviço.
+    """
+    if servico not in TIMEOUTS_SERVICO:
+        raise ValueError(f"Serviço HTTP desconhecido: '{servico}'. Use um de {tuple(TIMEOUTS_SERVICO)}.")
+    with _sessoes_lock:
+        sessao = _sessoes.get(servico)
+        if sessao is None:
+            sessao = requests.Session()
+            # Retentativas ficam a cargo de quem chama (ex: _get_osrm_table_batch)
+            adaptador = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_MAXSIZE_SERVICO[servico],
+                                    max_retries=0, pool_block=False)
+            sessao.mount("http://", adaptador)
+            sessao.mount("https://", adaptador)
+            _sessoes[servico] = sessao
+        return sessao
+
+
+def get(url, servico=SERVICO_PADRAO, **kwargs):
+    """
+    Faz um GET pela sessão compartilhada do serviço, aplicando o timeout padrão do
+    serviço quando `timeout` não for informado.
+
+    Returns:
+        requests.Response: Resposta da requisição.
+    """
+    kwargs.setdefault("timeout", TIMEOUTS_SERVICO[servico])
+    return obter_sessao(servico).get(url, **kwargs)
+
+
+def fechar_sessoes():
+    """Fecha todas as sessões abertas (libera as conexões mantidas no pool)."""
+    with _sessoes_lock:
+        for sessao in _sessoes.values():
+            sessao.close()
+        _sessoes.clear()
@@ -0,0 +1,51 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+
+# As páginas importam o módulo como `database` (app/ no sys.path)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+import database
+
+
+class TestCenarios(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        for nome, valor in (('DB_PATH', os.path.join(self.tmpdir.name, 'teste.db')),
+                            ('CENARIOS_DIR', os.path.join(self.tmpdir.name, 'cenarios'))):
+            patcher = mock.patch.object(database, nome, valor)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        database.init_db()
+
+    def test_salvar_recarregar_com_mmap_e_excluir(self):
+        distancias = np.arange(9, dtype=float).reshape(3, 3)
+        rotas = pd.DataFrame({'Veículo': ['ABC1234', 'ABC1234'], 'Sequencia': [1, 2],
+                              'Node_Index_OR': [2, 1], 'ID_Cenario': '20250101120000000000'})
+        database.salvar_matrizes_cenario('20250101120000000000', {'distancias': distancias, 'tempos': None},
+                                         data='2025-01-01 12:00:00', tipo='CVRP', rotas=rotas)
+
+        cenarios = database.listar_cenarios()
+        self.assertEqual(cenarios['id_cenario'].tolist(), ['20250101120000000000'])
+        self.assertEqual(cenarios['n_pontos'].iloc[0], 3)
+        self.assertEqual(cenarios['matrizes'].iloc[0], 'distancias')
+
+        matrizes = database.carregar_matrizes_cenario('20250101120000000000')
+        self.assertEqual(list(matrizes), ['distancias'])
+        self.assertIsInstance(matrizes['distancias'], np.memmap)
+        np.testing.assert_array_equal(matrizes['distancias'], distancias)
+        pd.testing.assert_frame_equal(database.carregar_rotas_cenario('20250101120000000000'), rotas)
+        del matrizes
+
+        database.excluir_cenario('20250101120000000000')
+        self.assertTrue(database.listar_cenarios().empty)
+        self.assertEqual(database.carregar_matrizes_cenario('20250101120000000000'), {})
+        self.assertTrue(database.carregar_rotas_cenario('20250101120000000000').empty)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,29 @@
+import os
+import tempfile
+import time
 import unittest
+from unittest import mock
 import numpy as np
 import pandas as pd
-from routing import pos_processamento, utils
+from routing import pos_processamento, utils, distancias, sessao_http, disjuntor
+from routing.cache_distancias import CacheParesOSRM, CacheMemoriaPares, CacheEmCamadas
+
+PONTOS_SP = [
+    (-23.5505, -46.6333),
+    (-23.5614, -46.6559),
+    (-23.6825, -46.6994),
+    (-23.5475, -46.6361),
+]
+
+def _tabela_falsa(url_base, coords_str, metrica, timeout=None, extra_params=None, servidores=None):
+    """Simula a OSRM Table API: valor = 1000 * (índice da origem) + índice do destino (0 na diagonal)."""
+    coords = distancias.ler_coordenadas(coords_str)
+    indices = [next(i for i, p in enumerate(PONTOS_SP) if p == c) for c in coords]
+    sources = [int(x) for x in extra_params['sources'].split(';')]
+    destinations = [int(x) for x in extra_params['destinations'].split(';')]
+    fator = {'duration': 1, 'distance': 10}
+    return {m: [[fator[m] * ((1000 * indices[s] + indices[d]) if indices[s] != indices[d] else 0) for d in destinations] for s in sources]
+            for m in metrica.split(',')}
 
 class TestPosProcessamento(unittest.TestCase):
     def setUp(self):
@@ -44,5 +66,723 @@ class TestUtils(unittest.TestCase):
         ok, msg = utils.validar_matriz(mat, tamanho_esperado=4)
         self.assertFalse(ok)
 
+def _tabela_manhattan(url_base, coords_str, metrica, timeout=None, extra_params=None, servidores=None):
+    """Simula a OSRM Table API para pontos arbitrários: valor = |dlat| + |dlon| em 1e-5 graus."""
+    coords = np.array(distancias.ler_coordenadas(coords_str))
+    sources = [int(x) for x in extra_params['sources'].split(';')]
+    destinations = [int(x) for x in extra_params['destinations'].split(';')]
+    valores = np.abs(coords[sources][:, None, :] - coords[destinations][None, :, :]).sum(axis=2) * 1e5
+    return {m: np.rint(valores).tolist() for m in metrica.split(',')}
+
+def _manhattan_esperado(pontos):
+    arr = np.array(pontos)
+    return np.rint(np.abs(arr[:, None, :] - arr[None, :, :]).sum(axis=2) * 1e5).astype(int)
+
+def _pontos_grade(n, seed=0):
+    rng = np.random.default_rng(seed)
+    # 6 casas decimais: a mesma precisão das coordenadas enviadas ao OSRM em polyline6
+    return [(round(float(lat), 6), round(float(lon), 6)) for lat, lon in zip(rng.uniform(-23.7, -23.4, n), rng.uniform(-46.8, -46.4, n))]
+
+
+class TestCacheDistancias(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = CacheParesOSRM(caminho=os.path.join(self.tmpdir.name, 'cache.db'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_segunda_chamada_usa_cache(self):
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_falsa) as fake:
+            m1 = distancias.calcular_matriz_distancias(PONTOS_SP, metrica='distance', cache=self.cache)
+            chamadas = fake.call_count
+            m2 = distancias.calcular_matriz_distancias(PONTOS_SP, metrica='distance', cache=self.cache)
+        self.assertGreater(chamadas, 0)
+        self.assertEqual(fake.call_count, chamadas)  # Nenhuma requisição nova
+        np.testing.assert_array_equal(m1, m2)
+        self.assertEqual(m1[2, 1], 20010)
+        stats = self.cache.estatisticas()
+        self.assertEqual(stats['hits'], 12)
+        self.assertEqual(stats['misses'], 12)
+
+    def test_apenas_pares_novos_sao_consultados(self):
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_falsa):
+            distancias.calcular_matriz_distancias(PONTOS_SP[:3], metrica='duration', cache=self.cache)
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_falsa) as fake:
+            m = distancias.calcular_matriz_distancias(PONTOS_SP, metrica='duration', cache=self.cache)
+        self.assertEqual(fake.call_count, 1)
+        self.assertEqual(self.cache.estatisticas()['hits'], 6)  # 3x3 fora da diagonal já em cache
+        self.assertEqual(m[3, 0], 3000)
+        self.assertEqual(m[0, 3], 3)
+
+class TestCacheMemoria(unittest.TestCase):
+    def test_limite_em_bytes_despeja_menos_usados(self):
+        um_par = CacheMemoriaPares(ttl=0)
+        um_par.salvar_pares(PONTOS_SP[:1], PONTOS_SP[1:2], [1.0], 'duration')
+        por_par = um_par.estatisticas()['bytes']
+        self.assertGreater(por_par, 0)
+        cache = CacheMemoriaPares(max_bytes=10 * por_par, ttl=0)
+        valores = np.arange(16, dtype=float).reshape(4, 4) + 1
+        cache.salvar_bloco(PONTOS_SP, PONTOS_SP, valores, 'duration')
+        stats = cache.estatisticas()
+        self.assertEqual(stats['pares'], 10)
+        self.assertEqual(stats['evictions'], 6)
+        self.assertLessEqual(stats['bytes'], 10 * por_par)
+        cache.salvar_pares(PONTOS_SP[3:], PONTOS_SP[3:], [5.0], 'duration')  # Regravar não conta duas vezes
+        self.assertEqual(cache.estatisticas()['bytes'], stats['bytes'])
+        _, encontrados = cache.buscar_matriz(PONTOS_SP, 'duration')
+        self.assertEqual(encontrados.sum(), 10)
+        self.assertFalse(encontrados[0, 0])  # Primeiros gravados foram despejados
+
+    def test_ttl_expira_pares(self):
+        cache = CacheMemoriaPares(ttl=60)
+        cache.salvar_pares(PONTOS_SP[:1], PONTOS_SP[1:2], [123], 'distance')
+        _, achado = cache.buscar_pares(PONTOS_SP[:1], PONTOS_SP[1:2], 'distance')
+        self.assertTrue(achado.all())
+        with mock.patch('routing.cache_distancias.time.monotonic', return_value=1e12):
+            _, achado = cache.buscar_pares(PONTOS_SP[:1], PONTOS_SP[1:2], 'distance')
+        self.assertFalse(achado.any())
+        self.assertEqual(cache.estatisticas()['expirados'], 1)
+
+    def test_camadas_promovem_do_disco_para_memoria(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            disco = CacheParesOSRM(os.path.join(tmp, 'cache.db'))
+            with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_falsa):
+                distancias.calcular_matriz_distancias(PONTOS_SP, metrica='distance', cache=disco)
+            cache = CacheEmCamadas(CacheMemoriaPares(), disco)
+            v1, e1 = cache.buscar_matriz(PONTOS_SP, 'distance')
+            leituras_disco = disco.estatisticas()['hits']
+            v2, e2 = cache.buscar_matriz(PONTOS_SP, 'distance')
+        self.assertEqual(disco.estatisticas()['hits'], leituras_disco)  # Segunda leitura só na memória
+        fora_diagonal = ~np.eye(4, dtype=bool)
+        self.assertTrue(e2[fora_diagonal].all())
+        np.testing.assert_array_equal(v1[fora_diagonal], v2[fora_diagonal])
+        self.assertEqual(cache.estatisticas()['memoria']['hits'], 12)
+
+class TestMatrizesCombinadas(unittest.TestCase):
+    def test_uma_passada_para_tempo_e_distancia(self):
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_falsa) as fake:
+            tempos, dists = distancias.calcular_matrizes_tempo_distancia(PONTOS_SP, usar_cache=False)
+        self.assertEqual(fake.call_count, 1)
+        self.assertEqual(fake.call_args.args[2], 'duration,distance')
+        self.assertEqual(tempos[1, 3], 1003)
+        self.assertEqual(dists[1, 3], 10030)
+
+class TestAgendadorBlocos(unittest.TestCase):
+    def test_varios_lotes_preenchem_matriz_inteira(self):
+        pontos = _pontos_grade(120)
+        progresso = []
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_manhattan):
+            m = distancias.calcular_matriz_distancias(pontos, metrica='distance', usar_cache=False, progress_callback=progresso.append)
+        np.testing.assert_array_equal(m, _manhattan_esperado(pontos))
+        self.assertEqual(progresso, sorted(progresso))
+        self.assertAlmostEqual(progresso[-1], 1.0)
+
+    def test_cancelamento_retorna_none(self):
+        import threading
+        cancelamento = threading.Event()
+        cancelamento.set()
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_manhattan):
+            m = distancias.calcular_matriz_distancias(_pontos_grade(120), usar_cache=False, cancelamento=cancelamento)
+        self.assertIsNone(m)
+
+class TestPreenchimentoVetorizado(unittest.TestCase):
+    def test_int32_padrao_e_null_vira_infinito(self):
+        def tabela_com_null(url_base, coords_str, metrica, timeout=None, extra_params=None, servidores=None):
+            resultado = _tabela_manhattan(url_base, coords_str, metrica, timeout, extra_params)
+            resultado['duration'][0][1] = None
+            return resultado
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=tabela_com_null):
+            m = distancias.calcular_matriz_distancias(PONTOS_SP, usar_cache=False)
+            m64 = distancias.calcular_matriz_distancias(PONTOS_SP, usar_cache=False, dtype=np.int64)
+        self.assertEqual(m.dtype, np.int32)
+        self.assertEqual(m64.dtype, np.int64)
+        self.assertEqual(m[0, 1], distancias.INFINITE_VALUE)
+        self.assertEqual(m[1, 0], _manhattan_esperado(PONTOS_SP)[1, 0])
+
+
+class TestPlanejadorTiles(unittest.TestCase):
+    def _cobertura(self, plano, n):
+        coberto = np.zeros((n, n), dtype=bool)
+        for origens, destinos in plano:
+            coberto[np.ix_(origens, destinos)] = True
+        return coberto
+
+    def test_plano_simetrico_cobre_tudo_com_menos_requisicoes(self):
+        plano = distancias.planejar_tiles(range(250), range(250), max_table_size=100)
+        self.assertTrue(self._cobertura(plano, 250).all())
+        custo = distancias.estimar_custo_plano(plano)
+        self.assertEqual(custo['requisicoes'], 10)  # C(5, 2) em vez de 5x5 blocos
+        self.assertLessEqual(custo['max_coordenadas'], 100)
+
+    def test_plano_retangular_para_poucas_linhas(self):
+        plano = distancias.planejar_tiles([0, 1, 2], range(300), max_table_size=100)
+        self.assertTrue(self._cobertura(plano, 300)[:3].all())
+        self.assertEqual(len(plano), 4)
+        self.assertLessEqual(distancias.estimar_custo_plano(plano)['max_coordenadas'], 100)
+
+class TestCoordenadasPolyline(unittest.TestCase):
+    def test_codificacao_de_referencia_e_ida_e_volta(self):
+        pontos = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+        self.assertEqual(distancias.codificar_polyline(pontos), "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+        for formato in distancias.FORMATOS_COORDENADAS:
+            np.testing.assert_allclose(distancias.ler_coordenadas(distancias.formatar_coordenadas(pontos, formato)), pontos)
+
+    def test_url_bem_menor_que_texto(self):
+        pontos = _pontos_grade(500, seed=5)
+        polyline6 = distancias.formatar_coordenadas(pontos, "polyline6")
+        self.assertLess(len(polyline6) * 2, len(distancias.formatar_coordenadas(pontos, "texto")))
+        self.assertNotIn("/", polyline6)  # Escapada para caber em um segmento do caminho da URL
+
+class TestDeduplicacao(unittest.TestCase):
+    def test_pedidos_repetidos_calculados_uma_vez(self):
+        base = _pontos_grade(70, seed=2)
+        rng = np.random.default_rng(0)
+        pontos = base + [base[i] for i in rng.integers(1, 70, 30)]  # 30% de endereços repetidos
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_manhattan) as fake:
+            m = distancias.calcular_matriz_distancias(pontos, metrica='distance', usar_cache=False)
+        np.testing.assert_array_equal(m, _manhattan_esperado(pontos))
+        enviados = len(distancias.ler_coordenadas(fake.call_args.args[1]))
+        self.assertEqual(enviados, 70)
+
+    def test_tolerancia_em_metros(self):
+        pontos = [(-23.5505, -46.6333), (-23.55052, -46.6333), (-23.5614, -46.6559), (-23.55, -46.6333)]
+        unicos, mapa = distancias.deduplicar_coordenadas(pontos, tolerancia_m=5)
+        self.assertEqual(mapa.tolist(), [0, 0, 1, 2])  # ~2 m agrupa; ~55 m não
+        self.assertEqual(unicos[0], pontos[0])
+        unicos, mapa = distancias.deduplicar_coordenadas(pontos + [(float('nan'), 0.0)] * 2, tolerancia_m=0)
+        self.assertEqual(mapa.tolist(), [0, 1, 2, 3, 4, 5])
+        expandida = distancias.expandir_matriz(np.array([[0, 7], [9, 0]]), np.array([0, 1, 0]))
+        self.assertEqual(expandida.tolist(), [[0, 7, 0], [9, 0, 9], [0, 7, 0]])
+        matriz = np.array([[0, 7], [9, 0]])
+        self.assertIs(distancias.expandir_matriz(matriz, np.array([0, 1])), matriz)  # Identidade: sem cópia
+
+class TestMatrizEsparsaKnn(unittest.TestCase):
+    def test_arcos_vizinhos_e_deposito_exatos_com_menos_celulas(self):
+        pontos = _pontos_grade(400, seed=7)
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_manhattan) as fake:
+            m, exatos = distancias.calcular_matriz_knn(pontos, k=5, metrica='distance', usar_cache=False, retornar_mascara=True)
+        esperado = _manhattan_esperado(pontos)
+        vizinhos = distancias.vizinhos_mais_proximos(pontos, k=5)
+        self.assertTrue(exatos[vizinhos].all())
+        self.assertTrue(exatos[0].all() and exatos[:, 0].all())
+        np.testing.assert_array_equal(m[exatos], esperado[exatos])
+        self.assertEqual(m.shape, (400, 400))
+        self.assertTrue((m[~exatos] > 0).all())
+        celulas = sum(len(c.kwargs['extra_params']['sources'].split(';')) * len(c.kwargs['extra_params']['destinations'].split(';'))
+                      for c in fake.call_args_list)
+        self.assertLess(celulas, 400 * 400 // 4)
+
+class TestMatrizIncremental(unittest.TestCase):
+    def test_so_pontos_novos_vao_ao_osrm(self):
+        pontos = _pontos_grade(150, seed=11)
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_manhattan):
+            tempos, dists = distancias.calcular_matrizes_tempo_distancia(pontos, usar_cache=False)
+        anterior = {'pontos': pontos, 'duration': tempos, 'distance': dists}
+        # Troca o depósito, remove dois pedidos e adiciona um urgente
+        novos = [(-23.5, -46.5)] + pontos[1:40] + pontos[42:] + [(-23.45, -46.45)]
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_manhattan) as fake:
+            tempos2, dists2 = distancias.calcular_matrizes_tempo_distancia(novos, usar_cache=False, anterior=anterior)
+        np.testing.assert_array_equal(dists2, _manhattan_esperado(novos))
+        np.testing.assert_array_equal(tempos2, _manhattan_esperado(novos))
+        celulas = sum(len(c.kwargs['extra_params']['sources'].split(';')) * len(c.kwargs['extra_params']['destinations'].split(';'))
+                      for c in fake.call_args_list)
+        self.assertLessEqual(celulas, 4 * len(novos))  # Apenas linhas/colunas do depósito e do pedido novo
+
+    def test_pares_que_falharam_nao_sao_reaproveitados(self):
+        pontos = _pontos_grade(150, seed=12)
+        chamadas = []
+        def tabela_com_falha(url_base, coords_str, metrica, timeout=None, extra_params=None, servidores=None):
+            chamadas.append(extra_params)
+            return None if len(chamadas) == 1 else _tabela_manhattan(url_base, coords_str, metrica, timeout, extra_params)
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=tabela_com_falha):
+            tempos, dists, exatas = distancias.calcular_matrizes_tempo_distancia(pontos, usar_cache=False, retornar_mascara=True)
+        falhos = dists == distancias.INFINITE_VALUE
+        self.assertTrue(falhos.any())
+        np.testing.assert_array_equal(exatas, ~falhos)
+        anterior = {'pontos': pontos, 'duration': tempos, 'distance': dists, 'exatas': exatas}
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_manhattan) as fake:
+            _, dists2, exatas2 = distancias.calcular_matrizes_tempo_distancia(pontos, usar_cache=False, anterior=anterior, retornar_mascara=True)
+        np.testing.assert_array_equal(dists2, _manhattan_esperado(pontos))
+        self.assertTrue(exatas2.all())
+        celulas = sum(len(c.kwargs['extra_params']['sources'].split(';')) * len(c.kwargs['extra_params']['destinations'].split(';'))
+                      for c in fake.call_args_list)
+        falhou = chamadas[0]
+        self.assertEqual(celulas, len(falhou['sources'].split(';')) * len(falhou['destinations'].split(';')))  # Só o bloco que falhou
+
+class TestDistanciasPares(unittest.TestCase):
+    def test_pares_em_uma_requisicao_e_depois_do_cache(self):
+        pontos = _pontos_grade(41, seed=13)
+        pares = list(zip(pontos[:-1], pontos[1:])) + [(pontos[3], pontos[3])]
+        esperado = _manhattan_esperado(pontos)
+        cache = CacheMemoriaPares()
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_manhattan) as fake:
+            valores = distancias.calcular_distancias_pares(pares, metrica="duration,distance", cache=cache)
+        self.assertEqual(fake.call_count, 1)
+        np.testing.assert_array_equal(valores['distance'][:-1], [esperado[i, i + 1] for i in range(40)])
+        self.assertEqual(valores['duration'][-1], 0)
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_manhattan) as fake:
+            de_novo = distancias.calcular_distancias_pares(pares, cache=cache)
+        self.assertEqual(fake.call_count, 0)
+        np.testing.assert_array_equal(de_novo, valores['duration'])
+
+    def test_pares_no_servidor_informado(self):
+        pontos = _pontos_grade(5, seed=13)
+        pares = list(zip(pontos[:-1], pontos[1:]))
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_manhattan) as fake:
+            distancias.calcular_distancias_pares(pares, usar_cache=False, osrm_url="http://osrm-a:5000,http://osrm-b:5000")
+        self.assertTrue(fake.call_args.args[0].startswith("http://osrm-a:5000/table/"))
+        self.assertEqual(fake.call_args.kwargs['servidores'], ["http://osrm-a:5000", "http://osrm-b:5000"])
+
+class TestMatrizUniverso(unittest.TestCase):
+    def setUp(self):
+        from routing import matriz_universo
+        self.universo = matriz_universo
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.patch_dir = mock.patch.object(matriz_universo, 'UNIVERSO_DIR', self.tmpdir.name)
+        self.patch_dir.start()
+
+    def tearDown(self):
+        self.patch_dir.stop()
+        self.tmpdir.cleanup()
+
+    def test_pontos_conhecidos_sem_chamadas_e_atualizacao_incremental(self):
+        pontos = _pontos_grade(40, seed=12)
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_manhattan):
+            self.assertEqual(self.universo.atualizar_universo(pontos[:30], usar_cache=False), 30)
+        do_dia = [pontos[5], pontos[0], pontos[17], pontos[5]]
+        with mock.patch.object(distancias, '_get_osrm_table_batch') as fake:
+            tempos, dists = distancias.calcular_matrizes_tempo_distancia(do_dia, cache=CacheMemoriaPares())
+        fake.assert_not_called()
+        np.testing.assert_array_equal(dists, _manhattan_esperado(do_dia))
+        # Clientes novos: só as linhas/colunas deles vão ao OSRM
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_manhattan) as fake:
+            self.assertEqual(self.universo.atualizar_universo(pontos, usar_cache=False), 40)
+        celulas = sum(len(c.kwargs['extra_params']['sources'].split(';')) * len(c.kwargs['extra_params']['destinations'].split(';'))
+                      for c in fake.call_args_list)
+        self.assertLessEqual(celulas, 2 * 10 * 40)
+        extraidas = self.universo.extrair_do_universo(pontos[::-1], ["distance"])
+        np.testing.assert_array_equal(extraidas["distance"], _manhattan_esperado(pontos[::-1]))
+        self.assertIsNone(self.universo.extrair_do_universo(pontos[:3] + [(-23.0, -46.0)], ["distance"]))
+
+    def test_universo_com_pares_nao_exatos_nao_e_gravado(self):
+        pontos = _pontos_grade(30, seed=13)
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=_tabela_manhattan):
+            self.assertEqual(self.universo.atualizar_universo(pontos[:20], usar_cache=False), 20)
+        with mock.patch.object(distancias, '_get_osrm_table_batch', return_value=None):
+            self.assertIsNone(self.universo.atualizar_universo(pontos, usar_cache=False))
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=disjuntor.DisjuntorAbertoError("recusada")):
+            self.assertIsNone(self.universo.atualizar_universo(pontos, usar_cache=False))  # Estimativa haversine
+        self.assertEqual(len(self.universo.carregar_universo(self.tmpdir.name)["pontos"]), 20)  # Anterior mantido
+
+    def test_universo_com_par_sem_rota_e_gravado(self):
+        pontos = _pontos_grade(20, seed=13)
+        def tabela_com_null(url_base, coords_str, metrica, timeout=None, extra_params=None, servidores=None):
+            resultado = _tabela_manhattan(url_base, coords_str, metrica, timeout, extra_params)
+            if len(extra_params['destinations'].split(';')) > 1:
+                for m in resultado:
+                    resultado[m][0][1] = None  # Par sem rota: resposta legítima do OSRM
+            return resultado
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=tabela_com_null):
+            self.assertEqual(self.universo.atualizar_universo(pontos, usar_cache=False), 20)
+        universo = self.universo.carregar_universo(self.tmpdir.name)
+        self.assertEqual((universo["distance"] == distancias.INFINITE_VALUE).sum(), 1)
+        with mock.patch.object(distancias, '_get_osrm_table_batch', side_effect=tabela_com_null):
+            self.assertEqual(self.universo.atualizar_universo(pontos + [(-23.4, -46.4)], usar_cache=False), 21)
+
+class TestProvedorHaversine(unittest.TestCase):
+    def test_calibracao_pelo_cache_e_matriz_sem_rede(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = CacheParesOSRM(os.path.join(tmp, 'cache.db'))
+            pontos = _pontos_grade(40, seed=3)
+            hav = distancias.estimar_matriz_haversine(pontos, "distance", fatores={}, dtype=np.float64)
+            cache.salvar_bloco(pontos, pontos, hav * 1.5 / distancias.FATOR_DESVIO_PADRAO, "distance")
+            fatores = distancias.calibrar_fatores_haversine(cache, metricas=("distance",))
+        self.assertAlmostEqual(fatores['distance']['global'], 1.5, places=3)
+        with mock.patch.object(distancias, '_get_osrm_table_batch') as osrm:
+            matriz = distancias.calcular_matriz_distancias(pontos[:5] + [(999, 0)], provider="haversine", metrica="distance")
+        osrm.assert_not_called()
+        self.assertEqual(matriz.dtype, np.int32)
+        self.assertTrue((np.diag(matriz)[:5] == 0).all())
+        self.assertEqual(matriz[0, 5], distancias.INFINITE_VALUE)
+        distancias._fatores_calibrados.clear()
+
+class TestSessaoHttp(unittest.TestCase):
+    def test_sessao_compartilhada_e_timeout_do_servico(self):
+        sessao = sessao_http.obter_sessao("osrm")
+        self.assertIs(sessao, sessao_http.obter_sessao("osrm"))
+        self.assertIsNot(sessao, sessao_http.obter_sessao("geocodificacao"))
+        self.assertEqual(sessao.get_adapter("http://localhost:5000")._pool_maxsize, sessao_http.POOL_MAXSIZE_SERVICO["osrm"])
+        with mock.patch.object(sessao, 'get') as get:
+            sessao_http.get("http://localhost:5000/route", servico="osrm", params={"a": 1})
+            sessao_http.get("http://localhost:5000/route", servico="osrm", timeout=3)
+        self.assertEqual(get.call_args_list[0].kwargs['timeout'], sessao_http.TIMEOUTS_SERVICO["osrm"])
+        self.assertEqual(get.call_args_list[1].kwargs['timeout'], 3)
+        with self.assertRaises(ValueError):
+            sessao_http.obter_sessao("inexistente")
+
+class TestClienteAssincrono(unittest.TestCase):
+    def test_matriz_assincrona_igual_a_sincrona(self):
+        import asyncio
+        from routing import osrm_async
+
+        async def get_json_falso(sessao, url, params=None, semaforo=None, timeout=None):
+            coords_str = url.rsplit('/', 1)[1]
+            resultado = _tabela_manhattan(url, coords_str, params['annotations'], extra_params=params)
+            return {f"{m}s": v for m, v in resultado.items()}
+
+        pontos = _pontos_grade(130, seed=5)
+        progresso = []
+        with mock.patch.object(osrm_async, '_get_json', side_effect=get_json_falso):
+            matrizes = asyncio.run(osrm_async.calcular_matriz_distancias_async(
+                pontos, "duration,distance", progress_callback=progresso.append, usar_cache=False, sessao=object()))
+        np.testing.assert_array_equal(matrizes['distance'], _manhattan_esperado(pontos))
+        np.testing.assert_array_equal(matrizes['duration'], _manhattan_esperado(pontos))
+        self.assertAlmostEqual(progresso[-1], 1.0)
+
+    def test_disjuntor_aberto_cancela_blocos_restantes(self):
+        import asyncio
+        from routing import osrm_async
+        cancelados = []
+
+        async def buscar_tile_falso(sessao, url_base, tile, annotations, semaforo):
+            if tile is tiles[0]:
+                return tile, None, True  # Recusado pelo disjuntor
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelados.append(tile)
+                raise
+
+        pontos = _pontos_grade(130, seed=5)
+        tiles = distancias._preparar_calculo(pontos, ["distance"], False, None, np.int32)[1]
+        self.assertGreater(len(tiles), 1)
+        preparar = mock.Mock(return_value=(None, tiles, None, None))
+        with mock.patch.object(osrm_async, '_preparar_calculo', preparar), \
+             mock.patch.object(osrm_async, '_buscar_tile_async', side_effect=buscar_tile_falso), \
+             mock.patch.object(distancias, 'MODO_FALHA_OSRM', 'falhar'):
+            async def calcular():
+                resultado = await osrm_async.calcular_matriz_distancias_async(pontos, 'distance', usar_cache=False, sessao=object())
+                return resultado, len(cancelados)  # Cancelados antes do retorno, não na limpeza do asyncio.run
+            resultado, cancelados_no_retorno = asyncio.run(calcular())
+        self.assertIsNone(resultado)
+        self.assertEqual(cancelados_no_retorno, len(tiles) - 1)
+
+class TestDisjuntor(unittest.TestCase):
+    def test_estados_fechado_aberto_meio_aberto(self):
+        d = disjuntor.Disjuntor("teste", limite_falhas=2, tempo_reabertura=10)
+        d.registrar_falha()
+        self.assertTrue(d.permitir())
+        d.registrar_falha()
+        self.assertEqual(d.estado, disjuntor.ABERTO)
+        self.assertFalse(d.permitir())
+        with mock.patch('routing.disjuntor.time.monotonic', return_value=time.monotonic() + 11):
+            self.assertTrue(d.permitir())   # Requisição de teste
+            self.assertFalse(d.permitir())  # Só uma por vez no meio-aberto
+            d.registrar_sucesso()
+        self.assertEqual(d.estado, disjuntor.FECHADO)
+        for tentativa in range(1, 8):
+            self.assertLessEqual(disjuntor.tempo_backoff(tentativa, base=0.5, maximo=5), 5)
+
+    def test_servidor_fora_do_ar_falha_rapido_com_estimativa(self):
+        import requests
+        pontos = _pontos_grade(250, seed=4)
+        servidor = distancias._servidor_de(distancias.OSRM_SERVER_URL)
+        disjuntor.obter_disjuntor(servidor).resetar()
+        with mock.patch.object(sessao_http, 'get', side_effect=requests.exceptions.ConnectionError("recusada")) as get, \
+             mock.patch.object(distancias.time, 'sleep'):
+            m = distancias.calcular_matriz_distancias(pontos, metrica='distance', usar_cache=False)
+        self.assertLess(get.call_count, 10 * distancias.MAX_RETRIES)
+        fora_diagonal = ~np.eye(250, dtype=bool)
+        self.assertTrue((m[fora_diagonal] < distancias.INFINITE_VALUE).all())
+        self.assertTrue((m[fora_diagonal] > 0).all())
+        with mock.patch.object(sessao_http, 'get') as get, mock.patch.object(distancias, 'MODO_FALHA_OSRM', 'falhar'):
+            self.assertIsNone(distancias.calcular_matriz_distancias(pontos, usar_cache=False))
+        get.assert_not_called()
+        disjuntor.obter_disjuntor(servidor).resetar()
+
+    def test_bloco_recusado_no_meio_aberto_usa_estimativa(self):
+        import asyncio
+        from routing import osrm_async
+        servidor = distancias._servidor_de(distancias.OSRM_SERVER_URL)
+        d = disjuntor.obter_disjuntor(servidor)
+        d.resetar()
+        d.abrir()
+        try:
+            with mock.patch('routing.disjuntor.time.monotonic', return_value=time.monotonic() + d.tempo_reabertura + 1), \
+                 mock.patch.object(sessao_http, 'get') as get:
+                self.assertEqual(d.estado, disjuntor.MEIO_ABERTO)
+                self.assertTrue(d.permitir())  # Requisição de teste de outro cálculo em andamento
+                m = distancias.calcular_matriz_distancias(PONTOS_SP, metrica='distance', usar_cache=False)
+                m_async = asyncio.run(osrm_async.calcular_matriz_distancias_async(PONTOS_SP, 'distance', usar_cache=False, sessao=object()))
+                with mock.patch.object(distancias, 'MODO_FALHA_OSRM', 'falhar'):
+                    self.assertIsNone(distancias.calcular_matriz_distancias(PONTOS_SP, usar_cache=False))
+                    self.assertIsNone(asyncio.run(osrm_async.calcular_matriz_distancias_async(PONTOS_SP, usar_cache=False, sessao=object())))
+            get.assert_not_called()
+            esperado = distancias.estimar_matriz_haversine(PONTOS_SP, 'distance', dtype=m.dtype)
+            np.testing.assert_array_equal(m, esperado)
+            np.testing.assert_array_equal(m_async, esperado)
+        finally:
+            d.resetar()
+
+    def test_teste_do_meio_aberto_sem_desfecho_libera_a_vaga(self):
+        servidor = distancias._servidor_de(distancias.OSRM_SERVER_URL)
+        d = disjuntor.obter_disjuntor(servidor)
+        d.resetar()
+        d.abrir()
+        try:
+            with mock.patch('routing.disjuntor.time.monotonic', return_value=time.monotonic() + d.tempo_reabertura + 1), \
+                 mock.patch.object(sessao_http, 'get', side_effect=ValueError("resposta inválida")):
+                with self.assertRaises(ValueError):
+                    distancias._get_osrm_table_batch(distancias.OSRM_SERVER_URL + "/table/v1/driving/",
+                                                     distancias.formatar_coordenadas(PONTOS_SP[:2]), "distance")
+                self.assertEqual(d.estado, disjuntor.MEIO_ABERTO)
+                self.assertTrue(d.permitir())  # A vaga do teste foi devolvida
+        finally:
+            d.resetar()
+
+class TestServidorSimulado(unittest.TestCase):
+    def setUp(self):
+        from routing.osrm_local.servidor_simulado import ServidorOSRMSimulado, FATORES_SIMULADOR
+        self.fatores = FATORES_SIMULADOR
+        self.servidor = ServidorOSRMSimulado(max_table_size=50, semente=1).iniciar()
+        self.url_original = distancias.OSRM_SERVER_URL
+        distancias.OSRM_SERVER_URL = self.servidor.url
+        disjuntor.obter_disjuntor(self.servidor.url).resetar()
+
+    def tearDown(self):
+        distancias.OSRM_SERVER_URL = self.url_original
+        self.servidor.parar()
+
+    def test_matriz_ponta_a_ponta_com_erros_e_max_table_size(self):
+        pontos = _pontos_grade(120, seed=8)
+        self.servidor.configurar(taxa_erro=0.05)
+        with mock.patch.object(distancias, 'MAX_TABLE_SIZE', 50), mock.patch.object(distancias.time, 'sleep'):
+            tempos, dists = distancias.calcular_matrizes_tempo_distancia(pontos, usar_cache=False)
+        esperado = distancias.estimar_matriz_haversine(pontos, "distance", self.fatores, np.float64)
+        np.testing.assert_allclose(dists, esperado, atol=1)
+        contadores = self.servidor.contadores
+        self.assertGreater(contadores['erros'], 0)  # Houve 503 e as retentativas recuperaram
+        self.assertEqual(contadores['table'], distancias.estimar_custo_plano(distancias.planejar_tiles(range(120), range(120), 50))['requisicoes'])
+
+    def test_rota_com_geometria_e_tabela_grande_demais(self):
+        from routing import apis_externas
+        resposta = apis_externas.consultar_osrm_route(PONTOS_SP[:3], osrm_url=self.servidor.url)
+        rota = resposta['routes'][0]
+        self.assertEqual(len(rota['legs']), 2)
+        self.assertEqual(rota['geometry']['coordinates'][0], [PONTOS_SP[0][1], PONTOS_SP[0][0]])
+        self.assertIsNone(apis_externas.consultar_osrm_table(_pontos_grade(60), osrm_url=self.servidor.url))  # TooBig (400)
+
+    def test_balanceamento_entre_servidores_e_remocao_do_que_falha(self):
+        from routing.osrm_local.servidor_simulado import ServidorOSRMSimulado
+        from routing.balanceador_osrm import obter_balanceador
+        segundo = ServidorOSRMSimulado(max_table_size=50, semente=2).iniciar()
+        disjuntor.obter_disjuntor(segundo.url).resetar()
+        pontos = _pontos_grade(120, seed=9)
+        esperado = distancias.estimar_matriz_haversine(pontos, "distance", self.fatores, np.float64)
+        try:
+            with mock.patch.object(distancias, 'OSRM_SERVIDORES', [self.servidor.url, segundo.url]), \
+                 mock.patch.object(distancias, 'MAX_TABLE_SIZE', 50):
+                _, dists = distancias.calcular_matrizes_tempo_distancia(pontos, usar_cache=False)
+                np.testing.assert_allclose(dists, esperado, atol=1)
+                self.assertGreater(self.servidor.contadores['table'], 0)
+                self.assertGreater(segundo.contadores['table'], 0)
+
+                segundo.parar()
+                sessao_http.fechar_sessoes()  # Descarta conexões keep-alive abertas com o servidor parado
+                balanceador = obter_balanceador([self.servidor.url, segundo.url])
+                self.assertEqual(balanceador.verificar_saude(), {self.servidor.url: True, segundo.url: False})
+                antes = self.servidor.contadores['table']
+                _, dists = distancias.calcular_matrizes_tempo_distancia(pontos, usar_cache=False)
+                np.testing.assert_allclose(dists, esperado, atol=1)
+                self.assertEqual(self.servidor.contadores['table'] - antes, 10)  # Todos os blocos no servidor saudável
+        finally:
+            disjuntor.obter_disjuntor(segundo.url).resetar()
+
+    def test_matriz_sob_demanda_busca_so_blocos_lidos(self):
+        pontos = _pontos_grade(60, seed=4)
+        esperado = distancias.estimar_matriz_haversine(pontos, "distance", self.fatores, np.float64)
+        matriz = distancias.MatrizSobDemanda(pontos, "distance", usar_cache=False, tamanho_bloco=20, pre_busca=False)
+        rota = [0, 3, 7, 12, 0]
+        np.testing.assert_allclose(matriz[rota[:-1], rota[1:]], esperado[rota[:-1], rota[1:]], atol=1)
+        self.assertEqual(matriz.requisicoes, 1)  # Todos os arcos da rota estão no bloco (0, 0)
+        self.assertEqual(self.servidor.contadores['table'], 1)
+        np.testing.assert_allclose(matriz[45, :], esperado[45, :], atol=1)
+        self.assertEqual(matriz.requisicoes, 4)  # Linha 45: blocos (2, 0), (2, 1), (2, 2)
+        self.assertAlmostEqual(matriz.fracao_carregada, 4 / 9)
+        np.testing.assert_allclose(np.asarray(matriz), esperado, atol=1)
+        self.assertEqual(matriz.requisicoes, 9)
+
+    def test_matriz_sob_demanda_refaz_bloco_que_falhou(self):
+        pontos = _pontos_grade(40, seed=6)
+        esperado = distancias.estimar_matriz_haversine(pontos, "distance", self.fatores, np.float64)
+        matriz = distancias.MatrizSobDemanda(pontos, "distance", usar_cache=False, tamanho_bloco=20, pre_busca=False)
+        self.servidor.configurar(taxa_erro=1.0)
+        with mock.patch.object(distancias.time, 'sleep'):
+            self.assertEqual(matriz[1, 2], distancias.INFINITE_VALUE)
+        self.assertEqual(matriz.fracao_carregada, 0.0)  # Bloco sem resposta não conta como carregado
+        self.servidor.configurar(taxa_erro=0.0)
+        self.assertAlmostEqual(matriz[1, 2], esperado[1, 2], delta=1)
+        self.assertEqual(matriz.requisicoes, 2)
+
+    def test_matriz_sob_demanda_encerra_pre_busca(self):
+        import gc
+        pontos = _pontos_grade(40, seed=6)
+        with distancias.MatrizSobDemanda(pontos, "distance", usar_cache=False, tamanho_bloco=20) as matriz:
+            matriz[0, 1]
+            executor = matriz._executor
+        self.assertTrue(executor._shutdown)
+        descartada = distancias.MatrizSobDemanda(pontos, "distance", usar_cache=False, tamanho_bloco=20)
+        executor = descartada._executor
+        del descartada  # Sem fechar(): o finalizador encerra a pré-busca
+        gc.collect()
+        self.assertTrue(executor._shutdown)
+
+class TestSolverCVRP(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        pontos = rng.uniform(0, 10000, (31, 2))
+        self.matriz = np.rint(np.abs(pontos[:, None] - pontos[None]).sum(axis=2)).astype(int)
+        self.pedidos = pd.DataFrame({'ID Pedido': range(30), 'Peso dos Itens': rng.integers(10, 50, 30)})
+        self.frota = pd.DataFrame({'Placa': ['A', 'B', 'C', 'D'], 'Capacidade (Kg)': [400] * 4})
+
+    def test_parametros_escalam_com_tamanho(self):
+        from routing.cvrp import parametros_busca
+        pequeno, grande = parametros_busca("padrão", 16), parametros_busca("padrão", 1501)
+        self.assertLess(pequeno.time_limit.ToTimedelta(), grande.time_limit.ToTimedelta())
+        self.assertNotEqual(parametros_busca("intensivo", 100).first_solution_strategy,
+                            parametros_busca("intensivo", 1000).first_solution_strategy)
+        with self.assertRaises(ValueError):
+            parametros_busca("turbo", 10)
+
+    def test_anytime_repassa_solucoes_melhores_e_pode_parar(self):
+        from routing.cvrp import solver_cvrp
+        recebidas = []
+        def ao_melhorar(info):
+            recebidas.append(info)
+            return len(recebidas) < 3
+        inicio = time.monotonic()
+        rotas = solver_cvrp(self.pedidos, self.frota, self.matriz, preset="padrão", ao_melhorar=ao_melhorar)
+        self.assertLess(time.monotonic() - inicio, 5)  # Parou no retorno False, antes do tempo limite
+        self.assertEqual(len(recebidas), 3)
+        custos = [info['custo'] for info in recebidas]
+        self.assertEqual(custos, sorted(custos, reverse=True))
+        self.assertEqual(sorted(p for paradas in recebidas[0]['rotas'].values() for p in paradas), list(range(30)))
+        self.assertEqual(len(rotas), 30)
+        self.assertTrue((rotas.groupby('Veículo')['Demanda'].sum() <= 400).all())
+
+class TestDecomposicao(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(5)
+        # Três grupos de clientes bem separados ao redor do depósito
+        centros = np.array([[-20000, 0], [20000, 0], [0, 20000]])
+        pontos = np.vstack([[0, 0]] + [c + rng.normal(0, 2000, (30, 2)) for c in centros])
+        self.matriz = np.rint(np.hypot(*(pontos[:, None] - pontos[None]).transpose(2, 0, 1))).astype(int)
+        self.pedidos = pd.DataFrame({'Latitude': pontos[1:, 0], 'Longitude': pontos[1:, 1], 'Peso dos Itens': rng.integers(10, 50, 90)})
+        self.frota = pd.DataFrame({'Placa': [f'V{i}' for i in range(9)], 'Capacidade (Kg)': [600] * 9})
+
+    def test_particionar_cobre_demanda_de_cada_cluster(self):
+        from routing.decomposicao import particionar
+        partes = particionar(self.pedidos, self.frota, self.matriz, n_clusters=3)
+        self.assertEqual(len(partes), 3)
+        self.assertEqual(sorted(np.concatenate([p for p, _ in partes]).tolist()), list(range(90)))
+        self.assertEqual(sorted(np.concatenate([v for _, v in partes]).tolist()), list(range(9)))
+        for idx_pedidos, idx_veiculos in partes:
+            self.assertGreaterEqual(600 * len(idx_veiculos), self.pedidos['Peso dos Itens'].iloc[idx_pedidos].sum())
+
+    def test_costura_no_formato_de_solver_cvrp(self):
+        from routing.decomposicao import solver_cvrp_decomposto
+        rotas = solver_cvrp_decomposto(self.pedidos, self.frota, self.matriz, n_clusters=3, preset="rascunho", max_processos=2)
+        self.assertEqual(sorted(rotas['Pedido_Index_DF'].tolist()), list(range(90)))
+        np.testing.assert_array_equal(rotas['Node_Index_OR'], rotas['Pedido_Index_DF'] + 1)
+        np.testing.assert_array_equal(rotas['Demanda'], self.pedidos['Peso dos Itens'].to_numpy()[rotas['Pedido_Index_DF']])
+        self.assertTrue((rotas.groupby('Veículo')['Demanda'].sum() <= 600).all())
+        # Cada veículo atende um único cluster e clusters não compartilham veículos
+        self.assertTrue((rotas.groupby('Veículo')['Cluster'].nunique() == 1).all())
+
+    def test_reparo_de_fronteira_move_pedido_para_rota_vizinha(self):
+        from routing.decomposicao import reparar_fronteiras
+        pontos = np.array([[0, 0], [10, 0], [11, 0], [-10, 0], [-11, 0], [9, 0]])
+        matriz = np.abs(pontos[:, None, 0] - pontos[None, :, 0])
+        rotas = {'A': [1, 2], 'B': [3, 5, 4]}  # O nó 5 (x=9) foi parar no cluster do lado oposto
+        movidos = reparar_fronteiras(rotas, {'A': 0, 'B': 1}, matriz, np.ones(6, dtype=int), {'A': 10, 'B': 10})
+        self.assertEqual(movidos, 1)
+        self.assertEqual(rotas, {'A': [5, 1, 2], 'B': [3, 4]})
+        self.assertEqual(reparar_fronteiras({'A': [1, 2], 'B': [3, 5, 4]}, {'A': 0, 'B': 1}, matriz, np.ones(6, dtype=int), {'A': 2, 'B': 10}), 0)
+
+class TestPortfolio(unittest.TestCase):
+    def test_mantem_a_melhor_variante(self):
+        from routing.portfolio import solver_cvrp_portfolio, _resolver_variante, custo_rotas
+        rng = np.random.default_rng(9)
+        pontos = rng.uniform(0, 10000, (41, 2))
+        matriz = np.rint(np.abs(pontos[:, None] - pontos[None]).sum(axis=2)).astype(int)
+        pedidos = pd.DataFrame({'ID Pedido': range(40), 'Peso dos Itens': rng.integers(10, 50, 40)})
+        frota = pd.DataFrame({'Placa': [f'V{i}' for i in range(5)], 'Capacidade (Kg)': [400] * 5})
+        # Descida gulosa: cada variante é determinística, então o vencedor pode ser conferido
+        variantes = [("PATH_CHEAPEST_ARC", "GREEDY_DESCENT", None), ("SAVINGS", "GREEDY_DESCENT", None),
+                     ("PATH_CHEAPEST_ARC", "GREEDY_DESCENT", 5)]
+        kwargs = {'preset': "rascunho", 'tempo_limite': 10}
+        rotas = solver_cvrp_portfolio(pedidos, frota, matriz, variantes=variantes, max_processos=3, **kwargs)
+        custos = [custo_rotas(_resolver_variante(pedidos, frota, matriz, v, kwargs), matriz) for v in variantes]
+        self.assertEqual(rotas.attrs['custo'], min(custos))
+        self.assertEqual(rotas.attrs['variante'], variantes[int(np.argmin(custos))])
+        self.assertEqual(custo_rotas(rotas, matriz), min(custos))
+        # Variante com semente: índices devolvidos na ordem original dos pedidos
+        com_semente = _resolver_variante(pedidos, frota, matriz, variantes[2], kwargs)
+        self.assertEqual(sorted(com_semente['Pedido_Index_DF']), list(range(40)))
+        np.testing.assert_array_equal(com_semente['ID Pedido'], com_semente['Pedido_Index_DF'])
+
+class TestCVRPFlexCenarios(unittest.TestCase):
+    def test_cenarios_em_paralelo_com_matriz_compartilhada(self):
+        from multiprocessing import shared_memory
+        from routing import cvrp_flex
+        rng = np.random.default_rng(2)
+        pontos = rng.uniform(0, 10000, (31, 2))
+        matriz = np.rint(np.abs(pontos[:, None] - pontos[None]).sum(axis=2)).astype(int)
+        pedidos = pd.DataFrame({'Peso dos Itens': rng.integers(10, 50, 30)})
+        frota = pd.DataFrame({'Placa': ['A', 'B', 'C', 'D'], 'Capacidade (Kg)': [400] * 4})
+        cenarios = [{'ajuste_capacidade_pct': 100}, {'ajuste_capacidade_pct': 120}, {'frota': frota.iloc[:1]}]
+        kwargs = {'cenarios': cenarios, 'metricas': True, 'preset': "rascunho", 'tempo_limite': 5}
+        concluidos = []
+        blocos = []
+        original = cvrp_flex._matriz_em_memoria_compartilhada
+        def registrar(m):
+            shm, descritor = original(m)
+            blocos.append(shm.name)
+            return shm, descritor
+        with mock.patch.object(cvrp_flex, '_matriz_em_memoria_compartilhada', side_effect=registrar):
+            paralelo = cvrp_flex.solver_cvrp_flex(pedidos, frota, matriz, max_processos=3,
+                                                  ao_concluir=lambda nome, res: concluidos.append(nome), **kwargs)
+        serial = cvrp_flex.solver_cvrp_flex(pedidos, frota, matriz, max_processos=1, **kwargs)
+        self.assertEqual(list(paralelo), ['Cenário_1', 'Cenário_2', 'Cenário_3'])
+        self.assertEqual(sorted(concluidos), list(paralelo))
+        self.assertEqual(len(blocos), 1)  # Uma única cópia da matriz para os três cenários
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=blocos[0])  # Liberada ao final
+        for nome in ('Cenário_1', 'Cenário_2'):
+            self.assertEqual(paralelo[nome]['metricas']['pedidos_atendidos'], 30)
+            self.assertEqual(paralelo[nome]['metricas']['distancia_total'], serial[nome]['metricas']['distancia_total'])
+        self.assertIn('excede capacidade', paralelo['Cenário_3']['diagnostico'])
+
+    def test_busca_original_por_padrao_e_preset_do_cenario_com_tempo_escalado(self):
+        from routing import cvrp_flex, cvrp
+        rng = np.random.default_rng(3)
+        pontos = rng.uniform(0, 10000, (31, 2))
+        matriz = np.rint(np.abs(pontos[:, None] - pontos[None]).sum(axis=2)).astype(int)
+        pedidos = pd.DataFrame({'Peso dos Itens': rng.integers(10, 50, 30)})
+        frota = pd.DataFrame({'Placa': ['A', 'B', 'C', 'D'], 'Capacidade (Kg)': [400] * 4})
+        with mock.patch.object(cvrp_flex, 'parametros_busca', wraps=cvrp.parametros_busca) as parametros:
+            inicio = time.monotonic()
+            resultado = cvrp_flex.solver_cvrp_flex(pedidos, frota, matriz, metricas=True, max_processos=1,
+                                                   cenarios=[{}, {'preset': "rascunho"}])
+            decorrido = time.monotonic() - inicio
+        self.assertLess(decorrido, 30)  # A busca original para no ótimo local; 60 s é só o teto
+        padrao, rascunho = parametros.call_args_list
+        self.assertEqual(padrao.args, (cvrp.PRESET_PADRAO, 31, cvrp_flex.TEMPO_LIMITE_FLEX))
+        self.assertEqual(padrao.kwargs, {'primeira_solucao': "PATH_CHEAPEST_ARC", 'metaheuristica': "AUTOMATIC"})
+        self.assertEqual(rascunho.args, ("rascunho", 31, None))  # Tempo escalado do preset, sem o teto global
+        for nome in ('Cenário_1', 'Cenário_2'):
+            self.assertEqual(resultado[nome]['metricas']['pedidos_atendidos'], 30)
+
 if __name__ == '__main__':
     unittest.main()